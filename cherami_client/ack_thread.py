@@ -22,63 +22,123 @@ from __future__ import absolute_import
 
 import traceback
 from threading import Thread, Event
-from six.moves.queue import Empty
+from six.moves.queue import Empty, Full, Queue
 
 from cherami_client.lib import util, cherami
 from cherami_client.ack_message_result import AckMessageResult
+from cherami_client.callback_executor import run_callback
+from cherami_client.timeouts import get_call_timeout, get_latency_observer
 
 
 class AckThread(Thread):
-    def __init__(self, tchannel, headers, logger, ack_queue, timeout_seconds):
+    # timeouts: optional timeouts.AdaptiveTimeouts giving the ackMessages timeouts instead of timeout_seconds
+    # max_batch_size: most acks and nacks sent in one ackMessages call
+    def __init__(self, tchannel, headers, logger, ack_queue, timeout_seconds, timeouts=None, max_batch_size=100):
         Thread.__init__(self)
         self.tchannel = tchannel
         self.headers = headers
         self.logger = logger
         self.ack_queue = ack_queue
         self.timeout_seconds = timeout_seconds
+        self.timeouts = timeouts
+        self.max_batch_size = max_batch_size
         self.stop_signal = Event()
 
     def stop(self):
         self.stop_signal.set()
 
+    # The acks and nacks waiting in the queue are sent together, with one ackMessages call per outputhost
     def run(self):
         while not self.stop_signal.is_set():
+            host_items = {}
+            for item in self._take_items():
+                hostport = util.get_hostport_from_delivery_token(item[1])
+                util.stats_count(self.tchannel.name, 'consumer_ack_queue.dequeue', hostport, 1)
+                host_items.setdefault(hostport, []).append(item)
+
+            for hostport, items in host_items.items():
+                self._send(hostport, items)
+
+    # wait for an ack, then take the ones queued behind it
+    def _take_items(self):
+        try:
+            item = self.ack_queue.get(block=True, timeout=self.timeout_seconds)
+        except Empty:
+            return []
+
+        items = []
+        # None only wakes up the thread
+        while item is not None:
+            items.append(item)
+            if len(items) >= self.max_batch_size:
+                break
             try:
-                hostport = None
+                item = self.ack_queue.get(block=False)
+            except Empty:
+                break
+        else:
+            if items:
+                # the wake up call is for another thread
                 try:
-                    is_ack, delivery_token, callback \
-                        = self.ack_queue.get(block=True, timeout=self.timeout_seconds)
-                    hostport = util.get_hostport_from_delivery_token(delivery_token)
-                    util.stats_count(self.tchannel.name, 'consumer_ack_queue.dequeue', hostport, 1)
-                except Empty:
-                    continue
-
-                ack_id = util.get_ack_id_from_delivery_token(delivery_token)
-                request = cherami.AckMessagesRequest(ackIds=[ack_id] if is_ack else [],
-                                                     nackIds=[ack_id] if not is_ack else [])
-
-                util.execute_output_host(tchannel=self.tchannel,
-                                         headers=self.headers,
-                                         hostport=hostport,
-                                         timeout=self.timeout_seconds,
-                                         method_name='ackMessages',
-                                         request=request)
-
-                callback(AckMessageResult(call_success=True,
-                                          is_ack=is_ack,
-                                          delivery_token=delivery_token,
-                                          error_msg=None))
-
-            except Exception as e:
-                self.logger.info({
-                    'msg': 'error ack msg from output host',
-                    'hostport': hostport,
-                    'ack id': ack_id,
-                    'is ack': is_ack,
-                    'traceback': traceback.format_exc(),
-                    'exception': str(e)
-                })
-                callback(AckMessageResult(call_success=False,
-                                          is_ack=is_ack,
-                                          delivery_token=delivery_token,
-                                          error_msg=str(e)))
+                    self.ack_queue.put(None, block=False)
+                except Full:
+                    pass
+        return items
+
+    def _send(self, hostport, items):
+        ack_ids = [util.get_ack_id_from_delivery_token(token) for is_ack, token, callback in items if is_ack]
+        nack_ids = [util.get_ack_id_from_delivery_token(token) for is_ack, token, callback in items if not is_ack]
+        try:
+            util.execute_output_host(tchannel=self.tchannel,
+                                     headers=self.headers,
+                                     hostport=hostport,
+                                     timeout=get_call_timeout(self.timeouts, self.timeout_seconds, hostport,
+                                                              'ackMessages'),
+                                     method_name='ackMessages',
+                                     request=cherami.AckMessagesRequest(ackIds=ack_ids, nackIds=nack_ids),
+                                     latency_observer=get_latency_observer(self.timeouts))
+            error_msg = None
+        except Exception as e:
+            self.logger.info({
+                'msg': 'error ack msg from output host',
+                'hostport': hostport,
+                'ack ids': ack_ids,
+                'nack ids': nack_ids,
+                'traceback': traceback.format_exc(),
+                'exception': str(e)
+            })
+            error_msg = str(e)
+
+        # an exception of a callback isn't an ack failure
+        for is_ack, delivery_token, callback in items:
+            run_callback(self.logger, callback, AckMessageResult(call_success=error_msg is None,
+                                                                 is_ack=is_ack,
+                                                                 delivery_token=delivery_token,
+                                                                 error_msg=error_msg))
+
+
+# Ack threads shared by the consumers of a client. Acks of all the consumers go through one queue,
+# the delivery token tells the outputhost to send each one to
+class AckThreadPool(object):
+    def __init__(self, tchannel, headers, logger, ack_queue_size, thread_count, timeout_seconds, timeouts=None):
+        self.ack_queue = Queue(ack_queue_size)
+        self.threads = [AckThread(tchannel=tchannel,
+                                  headers=headers,
+                                  logger=logger,
+                                  ack_queue=self.ack_queue,
+                                  timeout_seconds=timeout_seconds,
+                                  timeouts=timeouts)
+                        for i in range(thread_count)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        for thread in self.threads:
+            thread.stop()
+            try:
+                # wake up the ack thread waiting for an ack
+                self.ack_queue.put(None, block=False)
+            except Full:
+                pass
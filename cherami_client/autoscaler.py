@@ -0,0 +1,118 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import json
+
+
+# backlog fields of the queue depth info reported by the controller for a consumer group
+BACKLOG_AVAILABLE = 'BacklogAvailable'
+BACKLOG_UNAVAILABLE = 'BacklogUnavailable'
+BACKLOG_INFLIGHT = 'BacklogInflight'
+BACKLOG_DLQ = 'BacklogDLQ'
+
+
+# parse the value returned by getQueueDepthInfo, a json object of backlog counts
+def parse_queue_depth_info(value):
+    info = json.loads(value) if value else {}
+    if not isinstance(info, dict):
+        raise Exception("Unexpected queue depth info: {0}".format(value))
+    return info
+
+
+# linear interpolation between the minimum and maximum of a setting for a scale level
+def scale_value(min_value, max_value, level, max_level):
+    if max_level <= 0:
+        return min_value
+    return min_value + int(round(float(max_value - min_value) * level / max_level))
+
+
+# Scales the resources of a consumer with the backlog of its consumer group.
+# The scale level goes from 0 (the minimum of each setting) to steps (the maximum):
+# it goes one step up on each poll that sees a backlog of at least scale_up_backlog,
+# and one step down only after scale_down_polls consecutive polls see a backlog of at most scale_down_backlog.
+# A backlog between the two thresholds keeps the current level
+class ConsumerAutoscaler(object):
+    def __init__(self,
+                 consumer,
+                 backlog_func,
+                 min_pre_fetch_count,
+                 max_pre_fetch_count,
+                 min_ack_thread_count,
+                 max_ack_thread_count,
+                 min_handler_concurrency,
+                 max_handler_concurrency,
+                 handler_concurrency_callback,
+                 scale_up_backlog,
+                 scale_down_backlog,
+                 scale_down_polls,
+                 steps,
+                 logger):
+        if scale_down_backlog > scale_up_backlog:
+            raise Exception("Scale down backlog can't be higher than scale up backlog")
+        if steps < 1:
+            raise Exception("Steps must be positive: {0}".format(steps))
+
+        self.consumer = consumer
+        self.backlog_func = backlog_func
+        self.min_pre_fetch_count = min_pre_fetch_count
+        self.max_pre_fetch_count = max(max_pre_fetch_count, min_pre_fetch_count)
+        self.min_ack_thread_count = min_ack_thread_count
+        self.max_ack_thread_count = max(max_ack_thread_count, min_ack_thread_count)
+        self.min_handler_concurrency = min_handler_concurrency
+        self.max_handler_concurrency = max(max_handler_concurrency, min_handler_concurrency)
+        self.handler_concurrency_callback = handler_concurrency_callback
+        self.scale_up_backlog = scale_up_backlog
+        self.scale_down_backlog = scale_down_backlog
+        self.scale_down_polls = scale_down_polls
+        self.steps = steps
+        self.logger = logger
+        self.level = 0
+        self.low_backlog_polls = 0
+        self.last_backlog = None
+
+    # read the backlog and move the scale level if needed. Called periodically
+    def poll(self):
+        backlog = self.backlog_func()
+        self.last_backlog = backlog
+
+        level = self.level
+        if backlog >= self.scale_up_backlog:
+            self.low_backlog_polls = 0
+            level = min(self.level + 1, self.steps)
+        elif backlog <= self.scale_down_backlog:
+            self.low_backlog_polls += 1
+            if self.low_backlog_polls >= self.scale_down_polls:
+                self.low_backlog_polls = 0
+                level = max(self.level - 1, 0)
+        else:
+            self.low_backlog_polls = 0
+
+        if level != self.level:
+            self.logger.info('consumer autoscaling from level %s to %s, backlog %s', self.level, level, backlog)
+            self.level = level
+            self.apply()
+
+    def apply(self):
+        self.consumer.set_pre_fetch_count(
+            scale_value(self.min_pre_fetch_count, self.max_pre_fetch_count, self.level, self.steps))
+        self.consumer.set_ack_thread_count(
+            scale_value(self.min_ack_thread_count, self.max_ack_thread_count, self.level, self.steps))
+        if callable(self.handler_concurrency_callback):
+            self.handler_concurrency_callback(
+                scale_value(self.min_handler_concurrency, self.max_handler_concurrency, self.level, self.steps))
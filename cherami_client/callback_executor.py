@@ -0,0 +1,106 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import functools
+import traceback
+from threading import Thread, Event
+from six.moves.queue import Empty, Full, Queue
+
+from cherami_client.lib import util
+
+
+# Call an application callback. Its exceptions are logged, they don't affect the publish or ack it's called for
+def run_callback(logger, callback, arg):
+    try:
+        callback(arg)
+    except Exception as e:
+        logger.info({
+            'msg': 'error in application callback',
+            'traceback': traceback.format_exc(),
+            'exception': str(e)
+        })
+
+
+# Returns the callback the publisher and consumer threads call instead of an application callback: it runs the
+# application callback on the executor if any, otherwise inline with its exceptions caught
+def wrap_callback(logger, callback, executor=None):
+    if not callable(callback):
+        return callback
+    if executor:
+        return functools.partial(executor.submit, callback)
+    return functools.partial(run_callback, logger, callback)
+
+
+class CallbackThread(Thread):
+    def __init__(self, logger, callback_queue):
+        Thread.__init__(self)
+        self.logger = logger
+        self.callback_queue = callback_queue
+        self.stop_signal = Event()
+
+    def stop(self):
+        self.stop_signal.set()
+
+    # callbacks already queued when the thread is stopped are still run
+    def run(self):
+        while True:
+            try:
+                item = self.callback_queue.get(block=True, timeout=5)
+            except Empty:
+                if self.stop_signal.is_set():
+                    return
+                continue
+            if item is None:
+                if self.stop_signal.is_set() and self.callback_queue.empty():
+                    return
+                # only wakes up the thread
+                continue
+
+            callback, arg = item
+            run_callback(self.logger, callback, arg)
+
+
+# Threads running the application callbacks of the publishers and consumers of a client, so a slow callback
+# doesn't hold up sending and acking. The queue is bounded: when it's full the publisher and consumer threads
+# wait for the callbacks to catch up. With more than one thread, callbacks can run out of order
+class CallbackExecutor(object):
+    def __init__(self, logger, thread_count, queue_size):
+        self.callback_queue = Queue(queue_size)
+        self.threads = [CallbackThread(logger, self.callback_queue) for i in range(thread_count)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        for thread in self.threads:
+            thread.stop()
+            try:
+                # wake up the thread waiting for a callback
+                self.callback_queue.put(None, block=False)
+            except Full:
+                pass
+
+    # wait for the threads to run the queued callbacks and exit, no longer than the deadline(a time.time() value)
+    def join(self, deadline):
+        for thread in self.threads:
+            util.join_thread(thread, deadline)
+
+    def submit(self, callback, arg):
+        self.callback_queue.put((callback, arg))
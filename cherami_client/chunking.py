@@ -0,0 +1,193 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import
+
+import threading
+import time
+import uuid
+
+from cherami_client.lib import cherami, util
+from cherami_client.ack_message_result import AckMessageResult
+
+
+# userContext keys describing how a large message was split
+CHUNK_GROUP_CONTEXT_KEY = 'cherami-chunk-group'
+CHUNK_INDEX_CONTEXT_KEY = 'cherami-chunk-index'
+CHUNK_COUNT_CONTEXT_KEY = 'cherami-chunk-count'
+CHUNK_MESSAGE_ID_CONTEXT_KEY = 'cherami-chunk-message-id'
+
+CHUNK_CONTEXT_KEYS = (CHUNK_GROUP_CONTEXT_KEY,
+                      CHUNK_INDEX_CONTEXT_KEY,
+                      CHUNK_COUNT_CONTEXT_KEY,
+                      CHUNK_MESSAGE_ID_CONTEXT_KEY)
+
+
+def is_chunk(msg):
+    return msg.payload is not None and msg.payload.userContext is not None \
+        and CHUNK_GROUP_CONTEXT_KEY in msg.payload.userContext
+
+
+# split a message into chunks of at most chunk_size_bytes. Each chunk carries the user context
+# plus the chunk metadata, and gets its own id so acks of the batch can be told apart
+def split(msg, chunk_size_bytes):
+    data = msg.data or b''
+    if len(data) <= chunk_size_bytes:
+        return [msg]
+
+    group = uuid.uuid4().hex
+    count = (len(data) + chunk_size_bytes - 1) // chunk_size_bytes
+    chunks = []
+    for index in range(count):
+        context = dict(msg.userContext) if msg.userContext else {}
+        context[CHUNK_GROUP_CONTEXT_KEY] = group
+        context[CHUNK_INDEX_CONTEXT_KEY] = str(index)
+        context[CHUNK_COUNT_CONTEXT_KEY] = str(count)
+        context[CHUNK_MESSAGE_ID_CONTEXT_KEY] = msg.id or ''
+        chunks.append(cherami.PutMessage(
+            id='{0}#{1}'.format(msg.id, index),
+            delayMessageInSeconds=msg.delayMessageInSeconds,
+            data=data[index * chunk_size_bytes:(index + 1) * chunk_size_bytes],
+            userContext=context,
+            schemaVersion=msg.schemaVersion,
+        ))
+    return chunks
+
+
+# collects the acks of all chunks of a message and calls the callback once with a single ack for the message
+class ChunkAckAggregator(object):
+    def __init__(self, id, count, callback):
+        self.id = id
+        self.count = count
+        self.callback = callback
+        self.acks = []
+        self.lock = threading.Lock()
+
+    def __call__(self, ack):
+        with self.lock:
+            self.acks.append(ack)
+            if len(self.acks) != self.count:
+                return
+
+        for ack in self.acks:
+            if ack.status != cherami.Status.OK:
+                self.callback(cherami.PutMessageAck(id=self.id, status=ack.status, message=ack.message))
+                return
+        self.callback(cherami.PutMessageAck(id=self.id, status=cherami.Status.OK, receipt=self.acks[-1].receipt))
+
+
+# Buffers the chunks of large messages until all of them arrived, used by consumers created with
+# reassemble_chunks. The chunks of a message are reassembled only if they're all delivered to the same consumer
+# instance, so a consumer group reading chunked messages must have a single consumer instance: with several,
+# the chunks are spread across them, each instance gives up its part after timeout_seconds and the message
+# ends up in the DLQ once the delivery limit is reached
+class ChunkReassembler(object):
+
+    # timeout_seconds: incomplete messages older than this are given up
+    # max_bytes: upper bound of the chunk data buffered. The oldest incomplete messages are given up beyond it
+    def __init__(self, timeout_seconds, max_bytes):
+        self.timeout_seconds = timeout_seconds
+        self.max_bytes = max_bytes
+        self.buffered_bytes = 0
+        # group -> [first seen time, {index: (delivery_token, msg)}]
+        self.groups = {}
+        self.lock = threading.Lock()
+
+    # buffer a chunk. Returns a (delivery_token, msg) tuple for the whole message once all its chunks
+    # arrived, otherwise None. The delivery token of the whole message acks all of its chunks
+    def add(self, delivery_token, msg):
+        context = msg.payload.userContext
+        group = context[CHUNK_GROUP_CONTEXT_KEY]
+        index = int(context[CHUNK_INDEX_CONTEXT_KEY])
+        count = int(context[CHUNK_COUNT_CONTEXT_KEY])
+
+        with self.lock:
+            if group not in self.groups:
+                self.groups[group] = [time.time(), {}]
+            parts = self.groups[group][1]
+            if index in parts:
+                # redelivered chunk, keep the latest delivery
+                self.buffered_bytes -= len(parts[index][1].payload.data or b'')
+            parts[index] = (delivery_token, msg)
+            self.buffered_bytes += len(msg.payload.data or b'')
+
+            if len(parts) < count:
+                return None
+            del self.groups[group]
+            ordered = [parts[i] for i in range(count)]
+            self.buffered_bytes -= sum(len(m.payload.data or b'') for _, m in ordered)
+
+        first = ordered[0][1]
+        user_context = dict((k, v) for k, v in first.payload.userContext.items() if k not in CHUNK_CONTEXT_KEYS)
+        payload = cherami.PutMessage(
+            id=context[CHUNK_MESSAGE_ID_CONTEXT_KEY],
+            delayMessageInSeconds=first.payload.delayMessageInSeconds,
+            data=b''.join(m.payload.data or b'' for _, m in ordered),
+            userContext=user_context,
+            schemaVersion=first.payload.schemaVersion,
+        )
+        msg = cherami.ConsumerMessage(enqueueTimeUtc=first.enqueueTimeUtc, payload=payload)
+        return util.create_chunked_delivery_token([token for token, _ in ordered]), msg
+
+    # give up incomplete messages that timed out or don't fit in the memory bound.
+    # Returns the delivery tokens of their chunks, which should be nacked so they are redelivered
+    def expire(self):
+        expired_tokens = []
+        now = time.time()
+        with self.lock:
+            by_age = sorted(self.groups.items(), key=lambda g: g[1][0])
+            for group, (first_seen, parts) in by_age:
+                if now - first_seen < self.timeout_seconds and self.buffered_bytes <= self.max_bytes:
+                    break
+                del self.groups[group]
+                for token, msg in parts.values():
+                    self.buffered_bytes -= len(msg.payload.data or b'')
+                    expired_tokens.append(token)
+        return expired_tokens
+
+    # give up all incomplete messages. Returns the delivery tokens of their chunks
+    def clear(self):
+        with self.lock:
+            tokens = [token for first_seen, parts in self.groups.values() for token, msg in parts.values()]
+            self.groups = {}
+            self.buffered_bytes = 0
+        return tokens
+
+
+# collects the ack results of all chunks of a reassembled message and calls the callback once
+class ChunkAckResultAggregator(object):
+    def __init__(self, delivery_token, callback):
+        self.delivery_token = delivery_token
+        self.count = len(delivery_token)
+        self.callback = callback
+        self.results = []
+        self.lock = threading.Lock()
+
+    def __call__(self, ack_result):
+        with self.lock:
+            self.results.append(ack_result)
+            if len(self.results) != self.count:
+                return
+
+        failed = [r for r in self.results if not r.call_success]
+        self.callback(AckMessageResult(call_success=not failed,
+                                       is_ack=self.results[0].is_ack,
+                                       delivery_token=self.delivery_token,
+                                       error_msg=failed[0].error_msg if failed else None))
@@ -19,10 +19,18 @@
 # THE SOFTWARE.
 
 import socket
+import time
+from collections import deque
 
 from tchannel.sync import TChannel as TChannelSyncClient
-from cherami_client.lib import util
-from cherami_client import publisher, consumer
+from cherami_client.lib import cherami, util
+from cherami_client.lib.cache import TtlLruCache
+from cherami_client import publisher, consumer, codec, hedging, streaming_consumer, log_publisher
+from cherami_client.ack_thread import AckThreadPool
+from cherami_client.callback_executor import CallbackExecutor
+from cherami_client.publish_pool import PublishPool
+from cherami_client.scheduler import Scheduler
+from cherami_client.timeouts import AdaptiveTimeouts
 
 
 class Client(object):
@@ -47,6 +55,30 @@ class Client(object):
     # For example:
     # tchannel = TChannelSyncClient(name='my_service', known_peers=['172.17.0.2:4922'])
     # client = Client(tchannel, logger)
+    #
+    # metadata_cache_ttl_seconds: when set, read_destination, read_consumer_group and the list calls are
+    # cached for that long. The cache entries are dropped by this client's own create/update/delete calls
+    # metadata_cache_negative_ttl_seconds: how long an entity that doesn't exist is remembered
+    # metadata_cache_size: maximum number of cached entries
+    #
+    # shared_thread_pools: when set, the publishers and consumers created by this client share one scheduler thread
+    # for their periodic work(e.g. reconfiguration), publish_pool_thread_count threads to publish, taking turns
+    # between destinations, and ack_pool_thread_count threads to ack, instead of threads per destination and host.
+    # Consumers still have a receiving thread per outputhost, and log publishers a thread each
+    # ack_pool_buffer_size: size of the ack queue shared by the consumers
+    #
+    # callback_thread_count: when set, the publish and ack callbacks of the publishers and consumers created by this
+    # client run on that many threads instead of the threads sending and acking, so slow callbacks don't hold them up.
+    # With more than one thread callbacks can run out of order
+    # callback_queue_size: how many callbacks can wait for a callback thread before sending and acking wait too
+    #
+    # local_zone: zone of this client. With zone_resolver, a function returning the zone of a host:port,
+    # publishers send to the inputhosts of the local zone, and to the other zones only when the local ones
+    # are failing or backed up. Not supported with shared_thread_pools, raises ValueError.
+    # Consumers read from all outputhosts, as each one serves its own part of the destination
+    #
+    # adaptive_timeouts: when set, the timeouts of the putMessageBatch and ackMessages calls of each host follow
+    # its recent latencies, between min_call_timeout_seconds and timeout_seconds
     def __init__(self,
                  tchannel,
                  logger,
@@ -56,6 +88,19 @@ class Client(object):
                  reconfigure_interval_seconds=10,
                  deployment_str='prod',
                  hyperbahn_host='',
+                 metadata_cache_ttl_seconds=0,
+                 metadata_cache_negative_ttl_seconds=5,
+                 metadata_cache_size=1000,
+                 shared_thread_pools=False,
+                 publish_pool_thread_count=8,
+                 ack_pool_thread_count=4,
+                 ack_pool_buffer_size=200,
+                 callback_thread_count=0,
+                 callback_queue_size=1000,
+                 local_zone=None,
+                 zone_resolver=None,
+                 adaptive_timeouts=False,
+                 min_call_timeout_seconds=0.5,
                  ):
         self.logger = logger
         self.headers = headers
@@ -64,6 +109,21 @@ class Client(object):
         self.headers['host-name'] = socket.gethostname()
         self.timeout_seconds = timeout_seconds
         self.reconfigure_interval_seconds = reconfigure_interval_seconds
+        if shared_thread_pools and local_zone and zone_resolver:
+            raise ValueError('local_zone is not supported with shared_thread_pools')
+        self.local_zone = local_zone
+        self.zone_resolver = zone_resolver
+        self.timeouts = None
+        if adaptive_timeouts:
+            self.timeouts = AdaptiveTimeouts(min_call_timeout_seconds, timeout_seconds)
+
+        self.metadata_cache = None
+        self.metadata_list_cache = None
+        self.metadata_cache_negative_ttl_seconds = metadata_cache_negative_ttl_seconds
+        if metadata_cache_ttl_seconds:
+            self.metadata_cache = TtlLruCache(metadata_cache_size, metadata_cache_ttl_seconds)
+            # list results are invalidated by any change, so they're kept apart
+            self.metadata_list_cache = TtlLruCache(metadata_cache_size, metadata_cache_ttl_seconds)
 
         if not tchannel:
             if not client_name:
@@ -76,22 +136,79 @@ class Client(object):
         else:
             self.tchannel = tchannel
 
-    # close the client connection
+        self.scheduler = None
+        self.publish_pool = None
+        self.ack_pool = None
+        if shared_thread_pools:
+            self.scheduler = Scheduler(self.logger)
+            self.scheduler.start()
+            self.publish_pool = PublishPool(publish_pool_thread_count, self.logger)
+            self.publish_pool.start()
+            self.ack_pool = AckThreadPool(tchannel=self.tchannel,
+                                          headers=self.headers,
+                                          logger=self.logger,
+                                          ack_queue_size=ack_pool_buffer_size,
+                                          thread_count=ack_pool_thread_count,
+                                          timeout_seconds=self.timeout_seconds,
+                                          timeouts=self.timeouts)
+            self.ack_pool.start()
+
+        self.callback_executor = None
+        if callback_thread_count:
+            self.callback_executor = CallbackExecutor(self.logger, callback_thread_count, callback_queue_size)
+            self.callback_executor.start()
+
+    # close the client connection. Publishers and consumers should be closed first
     def close(self):
-        pass
+        if self.scheduler:
+            self.scheduler.stop()
+        if self.publish_pool:
+            self.publish_pool.stop()
+        if self.ack_pool:
+            self.ack_pool.stop()
+        if self.callback_executor:
+            self.callback_executor.stop()
+            self.callback_executor.join(time.time() + self.timeout_seconds)
 
     # create a consumer
     # Note consumer object should be a singleton
     # pre_fetch_count: This controls how many messages we can pre-fetch in total
     # ack_message_buffer_size: This controls the ack messages buffer size.i.e.count of pending ack messages
     # ack_message_thread_count: This controls how many threads we can have to send ack messages to Cherami.
+    # payload_codec: codec.PayloadCodec used to decode compressed payloads. Only needed for dictionaries,
+    # payloads compressed without a dictionary are always decoded transparently
+    # serializer_registry: serializer.SerializerRegistry used by decode_batch to decode payloads
+    # reassemble_chunks: when set, the chunks of messages published with chunk_size_bytes are buffered and returned
+    # as one message. Only for consumer groups with a single consumer instance, see chunking.ChunkReassembler.
+    # Otherwise chunks are returned as they are, with the chunk metadata in userContext
+    # chunk_reassembly_timeout_seconds: how long chunks of a large message are buffered waiting for the rest.
+    # Incomplete messages given up aren't nacked, they're redelivered once their lock times out
+    # chunk_reassembly_max_bytes: upper bound of the memory used to buffer chunks of large messages
+    # dedupe_cache_size: when set, remember the ids of that many recent messages and ack duplicates automatically
+    # dedupe_ttl_seconds: how long a message id is remembered
+    # dedupe_key_func: function returning the key identifying a message, by default the id given by the publisher
+    # max_inflight_receives: how many receiveMessageBatch long polls can be in flight to each outputhost,
+    # each one asking for no more messages than the pre-fetch buffer has room for
+    # nack_backoff_seconds: when set, nacks without a delay are held client side, the first nack of a message for
+    # that long, doubling with each nack of the same message up to nack_backoff_max_seconds
     def create_consumer(
             self,
             path,
             consumer_group_name,
             pre_fetch_count=50,
             ack_message_buffer_size=50,
-            ack_message_thread_count=4,):
+            ack_message_thread_count=4,
+            payload_codec=None,
+            serializer_registry=None,
+            reassemble_chunks=False,
+            chunk_reassembly_timeout_seconds=60,
+            chunk_reassembly_max_bytes=64 * 1024 * 1024,
+            dedupe_cache_size=0,
+            dedupe_ttl_seconds=600,
+            dedupe_key_func=None,
+            max_inflight_receives=1,
+            nack_backoff_seconds=0,
+            nack_backoff_max_seconds=300,):
         return consumer.Consumer(
             logger=self.logger,
             deployment_str=self.deployment_str,
@@ -104,11 +221,75 @@ class Client(object):
             ack_message_buffer_size=ack_message_buffer_size,
             ack_message_thread_count=ack_message_thread_count,
             reconfigure_interval_seconds=self.reconfigure_interval_seconds,
+            codec=payload_codec or codec.PayloadCodec(),
+            serializer_registry=serializer_registry,
+            reassemble_chunks=reassemble_chunks,
+            chunk_reassembly_timeout_seconds=chunk_reassembly_timeout_seconds,
+            chunk_reassembly_max_bytes=chunk_reassembly_max_bytes,
+            dedupe_cache_size=dedupe_cache_size,
+            dedupe_ttl_seconds=dedupe_ttl_seconds,
+            dedupe_key_func=dedupe_key_func,
+            scheduler=self.scheduler,
+            ack_pool=self.ack_pool,
+            max_inflight_receives=max_inflight_receives,
+            callback_executor=self.callback_executor,
+            timeouts=self.timeouts,
+            nack_backoff_seconds=nack_backoff_seconds,
+            nack_backoff_max_seconds=nack_backoff_max_seconds,
+        )
+
+    # create a consumer for a STREAMING consumer group. Instead of acking every message, the consumer
+    # checkpoints the address up to which all messages were acked with one setConsumedMessages call per interval.
+    # Each outputhost is expected to deliver gapless lsns, see streaming_consumer.Watermark
+    # start_address: messages with a lower address are skipped
+    # checkpoint_interval_seconds: how often the consumed address is checkpointed
+    # reassemble_chunks: see create_consumer. Incomplete messages given up are skipped
+    def create_streaming_consumer(
+            self,
+            path,
+            consumer_group_name,
+            start_address=None,
+            checkpoint_interval_seconds=5,
+            pre_fetch_count=50,
+            payload_codec=None,
+            serializer_registry=None,
+            reassemble_chunks=False,):
+        return streaming_consumer.StreamingConsumer(
+            start_address=start_address,
+            checkpoint_interval_seconds=checkpoint_interval_seconds,
+            logger=self.logger,
+            deployment_str=self.deployment_str,
+            path=path,
+            consumer_group_name=consumer_group_name,
+            tchannel=self.tchannel,
+            headers=self.headers,
+            pre_fetch_count=pre_fetch_count,
+            timeout_seconds=self.timeout_seconds,
+            ack_message_buffer_size=0,
+            ack_message_thread_count=0,
+            reconfigure_interval_seconds=self.reconfigure_interval_seconds,
+            codec=payload_codec or codec.PayloadCodec(),
+            serializer_registry=serializer_registry,
+            reassemble_chunks=reassemble_chunks,
+            scheduler=self.scheduler,
         )
 
     # create a publisher
     # Note publisher object should be a singleton
-    def create_publisher(self, path):
+    # payload_codec: optional codec.PayloadCodec to compress payloads above its size threshold
+    # serializer_registry: optional serializer.SerializerRegistry to encode payloads published with a schema version
+    # chunk_size_bytes: optional size above which messages are split into chunks, reassembled by consumers created
+    # with reassemble_chunks. The consumer group must have a single consumer instance, see chunking.ChunkReassembler
+    # max_inflight_batches: how many putMessageBatch calls can be in flight to each inputhost. With more than one,
+    # messages sent to the same inputhost can be stored out of order
+    # routing: optional policy queueing messages per inputhost, router.LEAST_OUTSTANDING or
+    # router.POWER_OF_TWO_CHOICES (by outstanding calls and latency). Idle inputhosts take messages queued
+    # for busy ones. Not supported with shared thread pools, raises ValueError
+    # hedge_percentile: optional percentile of putMessageBatch latencies after which a batch is sent again to
+    # another inputhost, the first OK ack of each message wins. The same message can then be stored twice.
+    # hedge_budget_percent caps the share of hedged batches. Not supported with shared thread pools, raises ValueError
+    def create_publisher(self, path, payload_codec=None, serializer_registry=None, chunk_size_bytes=None,
+                         max_inflight_batches=1, routing=None, hedge_percentile=None, hedge_budget_percent=5):
         if not path:
             raise Exception("Path is needed")
         return publisher.Publisher(
@@ -118,59 +299,283 @@ class Client(object):
             tchannel=self.tchannel,
             headers=self.headers,
             timeout_seconds=self.timeout_seconds,
-            reconfigure_interval_seconds=self.reconfigure_interval_seconds
+            reconfigure_interval_seconds=self.reconfigure_interval_seconds,
+            codec=payload_codec,
+            serializer_registry=serializer_registry,
+            chunk_size_bytes=chunk_size_bytes,
+            scheduler=self.scheduler,
+            publish_pool=self.publish_pool,
+            max_inflight_batches=max_inflight_batches,
+            routing=routing,
+            hedge_policy=hedging.HedgePolicy(hedge_percentile, hedge_budget_percent) if hedge_percentile else None,
+            callback_executor=self.callback_executor,
+            local_zone=self.local_zone,
+            zone_resolver=self.zone_resolver,
+            timeouts=self.timeouts,
         )
 
-    def create_destination(self, create_destination_request):
+    # create a publisher for a LOG destination. Messages are appended in order, chained with previousMessageId,
+    # and pipelined in batches. The acks carry the lsn and address of the messages
+    # batch_size: maximum number of messages per putMessageBatch call
+    # pipeline_depth: maximum number of putMessageBatch calls in flight
+    # max_retries: how many times messages are resent after a rejected append before failing them
+    # previous_message_id: id of the last message already in the log, if any
+    def create_log_publisher(self,
+                             path,
+                             batch_size=16,
+                             pipeline_depth=4,
+                             max_retries=3,
+                             previous_message_id=None,
+                             payload_codec=None,
+                             serializer_registry=None):
+        if not path:
+            raise Exception("Path is needed")
+        return log_publisher.LogPublisher(
+            batch_size=batch_size,
+            pipeline_depth=pipeline_depth,
+            max_retries=max_retries,
+            previous_message_id=previous_message_id,
+            logger=self.logger,
+            path=path,
+            deployment_str=self.deployment_str,
+            tchannel=self.tchannel,
+            headers=self.headers,
+            timeout_seconds=self.timeout_seconds,
+            reconfigure_interval_seconds=self.reconfigure_interval_seconds,
+            codec=payload_codec,
+            serializer_registry=serializer_registry,
+            scheduler=self.scheduler,
+        )
+
+    def _execute_frontend(self, method_name, request):
         return util.execute_frontend(
             self.tchannel,
             self.deployment_str,
             self.headers,
             self.timeout_seconds,
-            'createDestination',
-            create_destination_request)
+            method_name,
+            request)
+
+    # execute the call, or return its cached result. An entity that doesn't exist is cached too,
+    # for a shorter time, and the error is raised again on hits
+    def _execute_frontend_cached(self, cache, key, method_name, request):
+        if cache is None:
+            return self._execute_frontend(method_name, request)
+
+        cached = cache.get(key)
+        if cached is not None:
+            util.stats_count(self.tchannel.name, 'metadata_cache.hit', None, 1)
+            if isinstance(cached, Exception):
+                raise cached
+            return cached
+
+        util.stats_count(self.tchannel.name, 'metadata_cache.miss', None, 1)
+        try:
+            result = self._execute_frontend(method_name, request)
+        except cherami.EntityNotExistsError as e:
+            cache.put(key, e, ttl_seconds=self.metadata_cache_negative_ttl_seconds)
+            raise
+        if result is not None:
+            cache.put(key, result)
+        return result
+
+    def _invalidate_destination(self, path):
+        if self.metadata_cache is not None:
+            self.metadata_cache.pop(('destination', path))
+            self.metadata_list_cache.clear()
+
+    def _invalidate_consumer_group(self, destination_path, consumer_group_name):
+        if self.metadata_cache is not None:
+            self.metadata_cache.pop(('consumer_group', destination_path, consumer_group_name))
+            self.metadata_list_cache.clear()
+
+    def create_destination(self, create_destination_request):
+        try:
+            return self._execute_frontend('createDestination', create_destination_request)
+        finally:
+            self._invalidate_destination(create_destination_request.path)
 
     def read_destination(self, read_destination_request):
-        return util.execute_frontend(
-            self.tchannel,
-            self.deployment_str,
-            self.headers,
-            self.timeout_seconds,
+        return self._execute_frontend_cached(
+            self.metadata_cache,
+            ('destination', read_destination_request.path),
             'readDestination',
             read_destination_request)
 
+    def update_destination(self, update_destination_request):
+        try:
+            return self._execute_frontend('updateDestination', update_destination_request)
+        finally:
+            self._invalidate_destination(update_destination_request.path)
+
+    def delete_destination(self, delete_destination_request):
+        try:
+            return self._execute_frontend('deleteDestination', delete_destination_request)
+        finally:
+            self._invalidate_destination(delete_destination_request.path)
+
+    def list_destinations(self, list_destinations_request):
+        return self._execute_frontend_cached(
+            self.metadata_list_cache,
+            ('destinations',
+             list_destinations_request.prefix,
+             list_destinations_request.pageToken,
+             list_destinations_request.limit),
+            'listDestinations',
+            list_destinations_request)
+
+    # iterate over all destinations whose path starts with prefix, page_size destinations at a time.
+    # The next page is fetched while the current one is consumed
+    def iter_destinations(self, prefix='', page_size=100):
+        return self._iter_pages(
+            'listDestinations',
+            lambda page_token: cherami.ListDestinationsRequest(prefix=prefix, pageToken=page_token, limit=page_size),
+            lambda result: result.destinations)
+
     def create_consumer_group(self, create_consumer_group_request):
-        return util.execute_frontend(
-            self.tchannel,
-            self.deployment_str,
-            self.headers,
-            self.timeout_seconds,
-            'createConsumerGroup',
-            create_consumer_group_request)
+        try:
+            return self._execute_frontend('createConsumerGroup', create_consumer_group_request)
+        finally:
+            self._invalidate_consumer_group(create_consumer_group_request.destinationPath,
+                                            create_consumer_group_request.consumerGroupName)
 
     def read_consumer_group(self, read_consumer_group_request):
-        return util.execute_frontend(
-            self.tchannel,
-            self.deployment_str,
-            self.headers,
-            self.timeout_seconds,
+        return self._execute_frontend_cached(
+            self.metadata_cache,
+            ('consumer_group',
+             read_consumer_group_request.destinationPath,
+             read_consumer_group_request.consumerGroupName),
             'readConsumerGroup',
             read_consumer_group_request)
 
+    def update_consumer_group(self, update_consumer_group_request):
+        try:
+            return self._execute_frontend('updateConsumerGroup', update_consumer_group_request)
+        finally:
+            self._invalidate_consumer_group(update_consumer_group_request.destinationPath,
+                                            update_consumer_group_request.consumerGroupName)
+
+    def delete_consumer_group(self, delete_consumer_group_request):
+        try:
+            return self._execute_frontend('deleteConsumerGroup', delete_consumer_group_request)
+        finally:
+            self._invalidate_consumer_group(delete_consumer_group_request.destinationPath,
+                                            delete_consumer_group_request.consumerGroupName)
+
+    def list_consumer_groups(self, list_consumer_groups_request):
+        return self._execute_frontend_cached(
+            self.metadata_list_cache,
+            ('consumer_groups',
+             list_consumer_groups_request.destinationPath,
+             list_consumer_groups_request.consumerGroupName,
+             list_consumer_groups_request.pageToken,
+             list_consumer_groups_request.limit),
+            'listConsumerGroups',
+            list_consumer_groups_request)
+
+    # iterate over all consumer groups of a destination, page_size consumer groups at a time.
+    # The next page is fetched while the current one is consumed
+    def iter_consumer_groups(self, path, page_size=100):
+        return self._iter_pages(
+            'listConsumerGroups',
+            lambda page_token: cherami.ListConsumerGroupRequest(destinationPath=path,
+                                                                pageToken=page_token,
+                                                                limit=page_size),
+            lambda result: result.consumerGroups)
+
+    # pages are never cached, and only the current and the next page are held in memory
+    def _iter_pages(self, method_name, create_request, get_items):
+        call = util.start_frontend_call(self.tchannel, self.deployment_str, self.headers, self.timeout_seconds,
+                                        method_name, create_request(None))
+        while call is not None:
+            result = call.result()
+            items = get_items(result) if result else None
+
+            # a page can be empty while more follow, the listing ends without a next page token
+            call = None
+            if result and result.nextPageToken:
+                call = util.start_frontend_call(self.tchannel, self.deployment_str, self.headers,
+                                                self.timeout_seconds, method_name,
+                                                create_request(result.nextPageToken))
+
+            for item in items or []:
+                yield item
+
     def purge_DLQ_for_consumer_group(self, purge_DLQ_for_consumer_group_request):
-        return util.execute_frontend(
-            self.tchannel,
-            self.deployment_str,
-            self.headers,
-            self.timeout_seconds,
-            'purgeDLQForConsumerGroup',
-            purge_DLQ_for_consumer_group_request)
+        return self._execute_frontend('purgeDLQForConsumerGroup', purge_DLQ_for_consumer_group_request)
 
     def merge_DLQ_for_consumer_group(self, merge_DLQ_for_consumer_group_request):
-        return util.execute_frontend(
-            self.tchannel,
-            self.deployment_str,
-            self.headers,
-            self.timeout_seconds,
-            'mergeDLQForConsumerGroup',
-            merge_DLQ_for_consumer_group_request)
+        return self._execute_frontend('mergeDLQForConsumerGroup', merge_DLQ_for_consumer_group_request)
+
+    # returns the queue depth info of a consumer group. The key is the consumerGroupUUID,
+    # and the value of the result is a json object of backlog counts
+    def get_queue_depth_info(self, get_queue_depth_info_request):
+        return self._execute_frontend('getQueueDepthInfo', get_queue_depth_info_request)
+
+    # bulk variants of the admin calls, for provisioning or DLQ operations over many entities.
+    # They return a generator of (request, result, error) tuples, in the order of the requests.
+    # error is None if the call succeeded, otherwise result is None
+    # max_concurrency: maximum number of calls in flight
+    # max_calls_per_second: maximum rate at which calls are started, unlimited if 0
+    def bulk_create_destinations(self, create_destination_requests, max_concurrency=8, max_calls_per_second=0):
+        return self._execute_bulk('createDestination', create_destination_requests,
+                                  max_concurrency, max_calls_per_second,
+                                  lambda request: self._invalidate_destination(request.path))
+
+    def bulk_create_consumer_groups(self, create_consumer_group_requests, max_concurrency=8, max_calls_per_second=0):
+        return self._execute_bulk('createConsumerGroup', create_consumer_group_requests,
+                                  max_concurrency, max_calls_per_second,
+                                  lambda request: self._invalidate_consumer_group(request.destinationPath,
+                                                                                  request.consumerGroupName))
+
+    def bulk_purge_DLQ_for_consumer_groups(self, purge_DLQ_for_consumer_group_requests,
+                                           max_concurrency=8, max_calls_per_second=0):
+        return self._execute_bulk('purgeDLQForConsumerGroup', purge_DLQ_for_consumer_group_requests,
+                                  max_concurrency, max_calls_per_second)
+
+    def bulk_merge_DLQ_for_consumer_groups(self, merge_DLQ_for_consumer_group_requests,
+                                           max_concurrency=8, max_calls_per_second=0):
+        return self._execute_bulk('mergeDLQForConsumerGroup', merge_DLQ_for_consumer_group_requests,
+                                  max_concurrency, max_calls_per_second)
+
+    # the requests are consumed lazily, so a large iterable is never held in memory
+    def _execute_bulk(self, method_name, requests, max_concurrency, max_calls_per_second, invalidate_func=None):
+        if max_concurrency < 1:
+            raise Exception("Max concurrency must be positive: {0}".format(max_concurrency))
+
+        interval = 1.0 / max_calls_per_second if max_calls_per_second else 0
+        next_start_time = time.time()
+        requests = iter(requests)
+        inflight = deque()
+
+        while True:
+            while len(inflight) < max_concurrency:
+                request = next(requests, None)
+                if request is None:
+                    break
+
+                wait_seconds = next_start_time - time.time()
+                if wait_seconds > 0:
+                    time.sleep(wait_seconds)
+                next_start_time = max(next_start_time, time.time()) + interval
+
+                try:
+                    call = util.start_frontend_call(self.tchannel, self.deployment_str, self.headers,
+                                                    self.timeout_seconds, method_name, request)
+                    inflight.append((request, call, None))
+                except Exception as e:
+                    inflight.append((request, None, e))
+
+            if not inflight:
+                return
+
+            request, call, error = inflight.popleft()
+            result = None
+            if call is not None:
+                try:
+                    result = call.result()
+                except Exception as e:
+                    error = e
+            if invalidate_func:
+                invalidate_func(request)
+            yield request, result, error
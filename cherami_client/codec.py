@@ -0,0 +1,168 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import
+
+import sys
+import zlib
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# userContext keys used to tell consumers how the payload was encoded
+CODEC_CONTEXT_KEY = 'cherami-codec'
+CODEC_DICTIONARY_CONTEXT_KEY = 'cherami-codec-dict'
+
+ZLIB = 'zlib'
+LZ4 = 'lz4'
+ZSTD = 'zstd'
+
+
+def available_codecs():
+    codecs = [ZLIB]
+    if lz4_frame is not None:
+        codecs.append(LZ4)
+    if zstandard is not None:
+        codecs.append(ZSTD)
+    return codecs
+
+
+def default_codec_name():
+    if zstandard is not None:
+        return ZSTD
+    if lz4_frame is not None:
+        return LZ4
+    return ZLIB
+
+
+def get_dictionary_id(dictionary):
+    return '{0:08x}'.format(zlib.crc32(dictionary) & 0xffffffff)
+
+
+class PayloadCodec(object):
+
+    # name: 'zlib', 'lz4' or 'zstd'. Defaults to the best codec installed
+    # threshold_bytes: payloads smaller than this are sent as is
+    # level: compression level, None means the codec default
+    # dictionary: a pre-trained dictionary (bytes) used to compress small messages.
+    #     Supported by zstd, and by zlib on python 3. Consumers need the same dictionary to decode.
+    def __init__(self, name=None, threshold_bytes=1024, level=None, dictionary=None):
+        self.name = name or default_codec_name()
+        if self.name not in available_codecs():
+            raise Exception('Codec is not available: {0}'.format(self.name))
+        if dictionary is not None and self.name == LZ4:
+            raise Exception('lz4 codec does not support dictionaries')
+        if dictionary is not None and self.name == ZLIB and sys.version_info < (3, 3):
+            raise Exception('zlib dictionaries require python 3.3 or above')
+
+        self.threshold_bytes = threshold_bytes
+        self.level = level
+        self.dictionary = dictionary
+        self.dictionary_id = get_dictionary_id(dictionary) if dictionary is not None else None
+        self.dictionaries = {}
+        if dictionary is not None:
+            self.dictionaries[self.dictionary_id] = dictionary
+
+        self.zstd_dicts = {}
+
+    # register an extra dictionary that can be used to decode messages
+    def add_dictionary(self, dictionary):
+        self.dictionaries[get_dictionary_id(dictionary)] = dictionary
+
+    # encode the data if it is worth it. Returns a tuple of (data, userContext)
+    # The userContext returned is a copy that records the codec, the caller's dict is never modified
+    def encode(self, data, user_context):
+        if not data or len(data) < self.threshold_bytes:
+            return data, user_context
+
+        encoded = self._compress(data)
+        if len(encoded) >= len(data):
+            return data, user_context
+
+        context = dict(user_context) if user_context else {}
+        context[CODEC_CONTEXT_KEY] = self.name
+        if self.dictionary_id:
+            context[CODEC_DICTIONARY_CONTEXT_KEY] = self.dictionary_id
+        return encoded, context
+
+    # decode the data based on the codec recorded in the userContext. Returns a tuple of (data, userContext)
+    # where the userContext no longer contains the codec keys
+    def decode(self, data, user_context):
+        if not user_context or CODEC_CONTEXT_KEY not in user_context:
+            return data, user_context
+
+        context = dict(user_context)
+        name = context.pop(CODEC_CONTEXT_KEY)
+        dictionary_id = context.pop(CODEC_DICTIONARY_CONTEXT_KEY, None)
+        if dictionary_id and dictionary_id not in self.dictionaries:
+            raise Exception('Unknown codec dictionary: {0}'.format(dictionary_id))
+
+        return self._decompress(name, data, dictionary_id), context
+
+    def _get_zstd_dict(self, dictionary_id, dictionary):
+        if dictionary is None:
+            return None
+        if dictionary_id not in self.zstd_dicts:
+            self.zstd_dicts[dictionary_id] = zstandard.ZstdCompressionDict(dictionary)
+        return self.zstd_dicts[dictionary_id]
+
+    def _compress(self, data):
+        if self.name == ZSTD:
+            compressor = zstandard.ZstdCompressor(
+                level=self.level if self.level is not None else 3,
+                dict_data=self._get_zstd_dict(self.dictionary_id, self.dictionary))
+            return compressor.compress(data)
+        if self.name == LZ4:
+            if self.level is not None:
+                return lz4_frame.compress(data, compression_level=self.level)
+            return lz4_frame.compress(data)
+
+        level = self.level if self.level is not None else zlib.Z_DEFAULT_COMPRESSION
+        if self.dictionary is not None:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                          zlib.Z_DEFAULT_STRATEGY, self.dictionary)
+            return compressor.compress(data) + compressor.flush()
+        return zlib.compress(data, level)
+
+    def _decompress(self, name, data, dictionary_id):
+        dictionary = self.dictionaries.get(dictionary_id) if dictionary_id else None
+        if name == ZSTD:
+            if zstandard is None:
+                raise Exception('zstd codec is not available')
+            dict_data = self._get_zstd_dict(dictionary_id, dictionary)
+            return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(data)
+        if name == LZ4:
+            if lz4_frame is None:
+                raise Exception('lz4 codec is not available')
+            return lz4_frame.decompress(data)
+        if name == ZLIB:
+            if dictionary is not None:
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS, dictionary)
+                return decompressor.decompress(data) + decompressor.flush()
+            return zlib.decompress(data)
+        raise Exception('Unknown codec: {0}'.format(name))
@@ -18,20 +18,40 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import functools
 import time
 
-from threading import Event
+from threading import Event, Lock
 from six.moves import queue
 
 from clay import stats
+from cherami_client import autoscaler, chunking, codec, serializer
 from cherami_client.lib import cherami, util
+from cherami_client.lib.cache import TtlLruCache
 from cherami_client.consumer_thread import ConsumerThread
 from cherami_client.ack_thread import AckThread
-from cherami_client.reconfigure_thread import ReconfigureThread
+from cherami_client.callback_executor import run_callback, wrap_callback
+from cherami_client.delayed_nack import DelayedNackThread
+from cherami_client.fair_queue import FairMessageQueue
+from cherami_client.dispatch_thread import DispatchThread, DispatchFeederThread, get_context_key
+from cherami_client.scheduler import start_periodic_task
+from cherami_client.timeouts import get_call_timeout, get_latency_observer
 from cherami_client.ack_message_result import AckMessageResult
 
 
+# messages are identified by the id given by the publisher, or by their ack id when there's none
+def get_dedupe_key(msg):
+    if msg.payload is not None and msg.payload.id:
+        return msg.payload.id
+    return msg.ackId
+
+
 class Consumer(object):
+    # how often receive checks its stop signal while waiting for messages
+    stop_poll_interval_seconds = 0.1
+    # COMPETING consumer groups ack each message, STREAMING ones checkpoint an address instead
+    streaming = False
+
     def __init__(self,
                  logger,
                  deployment_str,
@@ -44,6 +64,22 @@ class Consumer(object):
                  ack_message_buffer_size,
                  ack_message_thread_count,
                  reconfigure_interval_seconds,
+                 codec=None,
+                 serializer_registry=None,
+                 reassemble_chunks=False,
+                 chunk_reassembly_timeout_seconds=60,
+                 chunk_reassembly_max_bytes=64 * 1024 * 1024,
+                 dedupe_cache_size=0,
+                 dedupe_ttl_seconds=600,
+                 dedupe_key_func=None,
+                 scheduler=None,
+                 ack_pool=None,
+                 max_inflight_receives=1,
+                 callback_executor=None,
+                 timeouts=None,
+                 nack_backoff_seconds=0,
+                 nack_backoff_max_seconds=300,
+                 nack_backoff_cache_size=10000,
                  ):
         self.logger = logger
         self.deployment_str = deployment_str
@@ -52,17 +88,67 @@ class Consumer(object):
         self.tchannel = tchannel
         self.headers = headers
         self.pre_fetch_count = pre_fetch_count
-        self.msg_queue = queue.Queue(pre_fetch_count)
+        # messages of each outputhost are buffered separately and returned in turn
+        self.msg_queue = FairMessageQueue(pre_fetch_count)
         self.msg_batch_size = max(pre_fetch_count / 10, 1)
         self.timeout_seconds = timeout_seconds
+        self.max_inflight_receives = max_inflight_receives
+        # optional callback_executor.CallbackExecutor running the application ack callbacks
+        self.callback_executor = callback_executor
+        # optional timeouts.AdaptiveTimeouts giving the ackMessages timeouts
+        self.timeouts = timeouts
         self.consumer_threads = {}
         self.ack_queue = queue.Queue(ack_message_buffer_size)
         self.ack_threads_count = ack_message_thread_count
         self.ack_threads = []
+        # shared by the consumers of a client, see Client(shared_thread_pools=True)
+        self.scheduler = scheduler
+        if ack_pool is not None:
+            self.ack_queue = ack_pool.ack_queue
+            self.ack_threads_count = 0
 
         self.reconfigure_signal = Event()
         self.reconfigure_interval_seconds = reconfigure_interval_seconds
         self.reconfigure_thread = None
+        self.dispatch_threads = []
+        self.dispatch_feeder_thread = None
+        self.codec = codec
+        self.serializer_registry = serializer_registry
+        # chunks of large messages are returned as they are unless reassembly was asked for
+        self.chunk_reassembler = None
+        if reassemble_chunks:
+            self.chunk_reassembler = chunking.ChunkReassembler(timeout_seconds=chunk_reassembly_timeout_seconds,
+                                                               max_bytes=chunk_reassembly_max_bytes)
+
+        # duplicate suppression: keys of the messages seen recently, and the keys of the messages
+        # delivered but not acked yet, so that a nacked message is not suppressed when redelivered
+        self.dedupe_seen_keys = TtlLruCache(dedupe_cache_size, dedupe_ttl_seconds) if dedupe_cache_size else None
+        self.dedupe_pending_keys = TtlLruCache(dedupe_cache_size, dedupe_ttl_seconds) if dedupe_cache_size else None
+        self.dedupe_key_func = dedupe_key_func or get_dedupe_key
+        self.dedupe_lookups = 0
+        self.dedupe_hits = 0
+
+        # nacks with a delay are held client side until it passes, and sent in batches.
+        # The thread is only started with the first delayed nack
+        self.delayed_nack_thread = None
+        self.delayed_nack_lock = Lock()
+        # nack backoff: how many times the messages were nacked by their key, and the keys of the messages
+        # delivered but not acked or nacked yet
+        self.nack_backoff_seconds = nack_backoff_seconds
+        self.nack_backoff_max_seconds = nack_backoff_max_seconds
+        self.nack_counts = None
+        self.nack_pending_keys = None
+        if nack_backoff_seconds:
+            # a message is redelivered within the backoff, after that its count isn't needed any more
+            ttl_seconds = nack_backoff_max_seconds * 2 + timeout_seconds
+            self.nack_counts = TtlLruCache(nack_backoff_cache_size, ttl_seconds)
+            self.nack_pending_keys = TtlLruCache(nack_backoff_cache_size, ttl_seconds)
+
+        self.consumer_group_uuid = None
+        self.autoscaler = None
+        self.autoscale_signal = Event()
+        self.autoscale_thread = None
+        self.opened = False
 
         # whether to start the consumer thread. Only set to false in unit test
         self.start_consumer_thread = True
@@ -83,15 +169,17 @@ class Consumer(object):
         host_connections = map(lambda h: util.get_connection_key(h), hosts.hostAddresses) \
             if hosts.hostAddresses is not None else []
         host_connection_set = set(host_connections)
+        self.msg_queue.set_host_count(len(host_connection_set))
         existing_connection_set = set(self.consumer_threads.keys())
         missing_connection_set = host_connection_set - existing_connection_set
         extra_connection_set = existing_connection_set - host_connection_set
 
-        # clean up
+        # clean up. Messages already received from the removed hosts are released right away
         for extra_conn in extra_connection_set:
             self.logger.info('cleaning up connection %s', extra_conn)
             self.consumer_threads[extra_conn].stop()
             del self.consumer_threads[extra_conn]
+            self._release_buffered_messages(extra_conn)
 
         # start up
         for missing_conn in missing_connection_set:
@@ -104,7 +192,10 @@ class Consumer(object):
                                              path=self.path,
                                              consumer_group_name=self.consumer_group_name,
                                              timeout_seconds=self.timeout_seconds,
-                                             msg_batch_size=self.msg_batch_size
+                                             msg_batch_size=self.msg_batch_size,
+                                             streaming=self.streaming,
+                                             max_inflight_receives=self.max_inflight_receives,
+                                             release_func=self._release_messages,
                                              )
             self.consumer_threads[missing_conn] = consumer_thread
             if self.start_consumer_thread:
@@ -114,28 +205,31 @@ class Consumer(object):
 
     def _start_ack_threads(self):
         for i in range(0, self.ack_threads_count):
-            ack_thread = AckThread(tchannel=self.tchannel,
-                                   headers=self.headers,
-                                   logger=self.logger,
-                                   ack_queue=self.ack_queue,
-                                   timeout_seconds=self.timeout_seconds)
-            ack_thread.start()
-            self.ack_threads.append(ack_thread)
+            self._start_ack_thread()
+
+    def _start_ack_thread(self):
+        ack_thread = AckThread(tchannel=self.tchannel,
+                               headers=self.headers,
+                               logger=self.logger,
+                               ack_queue=self.ack_queue,
+                               timeout_seconds=self.timeout_seconds,
+                               timeouts=self.timeouts)
+        ack_thread.start()
+        self.ack_threads.append(ack_thread)
 
     # open the consumer. If succeed, we can start to consume messages
     # Otherwise, we should retry opening (with backoff)
     def open(self):
         try:
             self._reconfigure()
-            self.reconfigure_thread = ReconfigureThread(
-                interval_seconds=self.reconfigure_interval_seconds,
-                reconfigure_signal=self.reconfigure_signal,
-                reconfigure_func=self._reconfigure,
-                logger=self.logger,
-            )
-            self.reconfigure_thread.start()
+            self.reconfigure_thread = start_periodic_task(scheduler=self.scheduler,
+                                                          interval_seconds=self.reconfigure_interval_seconds,
+                                                          signal=self.reconfigure_signal,
+                                                          func=self._reconfigure,
+                                                          logger=self.logger)
 
             self._start_ack_threads()
+            self.opened = True
 
             self.logger.info('consumer opened')
         except Exception as e:
@@ -143,25 +237,245 @@ class Consumer(object):
             self.close()
             raise e
 
-    # close the consumer
-    def close(self):
+    # close the consumer. Messages received but not delivered to the application yet are nacked,
+    # so that they're redelivered right away, and pending acks are flushed.
+    # Threads are joined, waiting no longer than drain_timeout_seconds (by default the call timeout).
+    # The consumer threads wait for their long polls in flight and nack the messages they return,
+    # so close can take that long even with no message buffered
+    def close(self, drain_timeout_seconds=None):
+        if drain_timeout_seconds is None:
+            drain_timeout_seconds = self.timeout_seconds
+        deadline = time.time() + drain_timeout_seconds
+
+        self.opened = False
+        self.stop_autoscaling()
+        self.stop_dispatch(deadline)
+
         if self.reconfigure_thread:
             self.reconfigure_thread.stop()
+            util.join_thread(self.reconfigure_thread, deadline)
 
-        for worker in self.consumer_threads.itervalues():
+        consumer_threads = list(self.consumer_threads.values())
+        for worker in consumer_threads:
             worker.stop()
+        for worker in consumer_threads:
+            util.join_thread(worker, deadline)
+
+        self._release_buffered_messages()
+        if self.chunk_reassembler is not None and not self.streaming:
+            for delivery_token in self.chunk_reassembler.clear():
+                self.nack_async(delivery_token, self._log_failed_response)
+
+        # delayed nacks are sent right away, the ones not sent by the deadline are counted
+        with self.delayed_nack_lock:
+            delayed_nack_thread = self.delayed_nack_thread
+            if delayed_nack_thread is not None:
+                delayed_nack_thread.stop()
+        if delayed_nack_thread is not None:
+            util.join_thread(delayed_nack_thread, deadline)
+            unsent = len(delayed_nack_thread)
+            if unsent:
+                util.stats_count(self.tchannel.name, 'consumer_delayed_nack.unsent', None, unsent)
+                self.logger.info({
+                    'msg': 'delayed nacks not sent before closing',
+                    'count': unsent
+                })
 
+        util.wait_until(self.ack_queue.empty, deadline)
         for ack_thread in self.ack_threads:
             ack_thread.stop()
+            try:
+                # wake up the ack thread waiting for an ack
+                self.ack_queue.put(None, block=False)
+            except queue.Full:
+                pass
+        for ack_thread in self.ack_threads:
+            util.join_thread(ack_thread, deadline)
+
+    # Start dispatching received messages to handler(delivery_token, msg) on lane_count threads.
+    # Messages with the same key are handled one at a time in order, messages with different keys in parallel.
+    # key_func(msg) returns the key of a message, by default the value of context_key in the userContext.
+    # Messages without a key are spread evenly across lanes.
+    # lane_buffer_size: how many messages can wait on each lane before dispatching blocks
+    # auto_ack: ack the message when the handler returns, nack it when the handler raises
+    def start_dispatch(self,
+                       handler,
+                       lane_count=4,
+                       key_func=None,
+                       context_key='partition-key',
+                       lane_buffer_size=10,
+                       auto_ack=True):
+        if self.dispatch_feeder_thread:
+            raise Exception("Dispatch already started")
+
+        lane_queues = []
+        for i in range(0, lane_count):
+            lane_queue = queue.Queue(lane_buffer_size)
+            dispatch_thread = DispatchThread(consumer=self,
+                                             lane_queue=lane_queue,
+                                             handler=handler,
+                                             auto_ack=auto_ack,
+                                             logger=self.logger)
+            dispatch_thread.start()
+            lane_queues.append(lane_queue)
+            self.dispatch_threads.append(dispatch_thread)
+
+        self.dispatch_feeder_thread = DispatchFeederThread(consumer=self,
+                                                           lane_queues=lane_queues,
+                                                           key_func=key_func or get_context_key(context_key),
+                                                           receive_batch_size=self.msg_batch_size,
+                                                           logger=self.logger)
+        self.dispatch_feeder_thread.start()
+
+    # Start adjusting the consumer to the backlog of the consumer group, polled every interval_seconds.
+    # pre-fetch count and ack thread count are scaled between the values the consumer was created with
+    # and the given maximums. When the backlog reaches scale_up_backlog the consumer is scaled up one step per poll,
+    # when it stays at or below scale_down_backlog for scale_down_polls polls it's scaled down one step.
+    # handler_concurrency_callback: optional function called with the number of handlers the application should run,
+    # between min_handler_concurrency and max_handler_concurrency
+    # backlog_func: optional function returning the backlog, by default get_backlog
+    def start_autoscaling(self,
+                          max_pre_fetch_count,
+                          max_ack_message_thread_count=None,
+                          scale_up_backlog=1000,
+                          scale_down_backlog=100,
+                          scale_down_polls=3,
+                          steps=4,
+                          interval_seconds=30,
+                          handler_concurrency_callback=None,
+                          min_handler_concurrency=1,
+                          max_handler_concurrency=1,
+                          backlog_func=None):
+        if self.autoscale_thread:
+            raise Exception("Autoscaling already started")
+
+        self.autoscaler = autoscaler.ConsumerAutoscaler(
+            consumer=self,
+            backlog_func=backlog_func or self.get_backlog,
+            min_pre_fetch_count=self.pre_fetch_count,
+            max_pre_fetch_count=max_pre_fetch_count,
+            min_ack_thread_count=self.ack_threads_count,
+            max_ack_thread_count=max_ack_message_thread_count or self.ack_threads_count,
+            min_handler_concurrency=min_handler_concurrency,
+            max_handler_concurrency=max_handler_concurrency,
+            handler_concurrency_callback=handler_concurrency_callback,
+            scale_up_backlog=scale_up_backlog,
+            scale_down_backlog=scale_down_backlog,
+            scale_down_polls=scale_down_polls,
+            steps=steps,
+            logger=self.logger,
+        )
+        self.autoscale_thread = start_periodic_task(
+            self.scheduler, interval_seconds, self.autoscale_signal, self.autoscaler.poll, self.logger)
+
+    # stop autoscaling. The consumer keeps its current settings
+    def stop_autoscaling(self):
+        if self.autoscale_thread:
+            self.autoscale_thread.stop()
+            self.autoscale_thread = None
+
+    # returns the queue depth info of the consumer group: a dict of backlog counts, see autoscaler.BACKLOG_*
+    def get_queue_depth_info(self):
+        if self.consumer_group_uuid is None:
+            consumer_group = util.execute_frontend(
+                self.tchannel, self.deployment_str, self.headers, self.timeout_seconds, 'readConsumerGroup',
+                cherami.ReadConsumerGroupRequest(
+                    destinationPath=self.path,
+                    consumerGroupName=self.consumer_group_name,
+                ))
+            self.consumer_group_uuid = consumer_group.consumerGroupUUID
+
+        result = util.execute_frontend(
+            self.tchannel, self.deployment_str, self.headers, self.timeout_seconds, 'getQueueDepthInfo',
+            cherami.GetQueueDepthInfoRequest(
+                key=self.consumer_group_uuid,
+            ))
+        return autoscaler.parse_queue_depth_info(result.value)
+
+    # number of messages available for delivery to the consumer group
+    def get_backlog(self):
+        return self.get_queue_depth_info().get(autoscaler.BACKLOG_AVAILABLE, 0)
+
+    # change the number of messages buffered by the consumer, and the batch size of each receive call
+    def set_pre_fetch_count(self, pre_fetch_count):
+        with self.msg_queue.mutex:
+            self.msg_queue.maxsize = pre_fetch_count
+            # wake up the consumer threads blocked on a full queue
+            self.msg_queue.not_full.notify_all()
+
+        self.pre_fetch_count = pre_fetch_count
+        self.msg_batch_size = max(pre_fetch_count / 10, 1)
+        for consumer_thread in self.consumer_threads.values():
+            consumer_thread.msg_batch_size = self.msg_batch_size
+
+    # change the number of ack threads. Threads are only started once the consumer is opened
+    def set_ack_thread_count(self, ack_thread_count):
+        self.ack_threads_count = ack_thread_count
+        if not self.opened:
+            return
+
+        while len(self.ack_threads) > ack_thread_count:
+            self.ack_threads.pop().stop()
+        while len(self.ack_threads) < ack_thread_count:
+            self._start_ack_thread()
+
+    # stop dispatching. The messages waiting on the lanes are nacked
+    def stop_dispatch(self, deadline=None):
+        if deadline is None:
+            deadline = time.time() + self.timeout_seconds
+
+        # the feeder stops first, so nothing is dispatched to the lanes once they're stopped
+        if self.dispatch_feeder_thread:
+            self.dispatch_feeder_thread.stop()
+            util.join_thread(self.dispatch_feeder_thread, deadline)
+            self.dispatch_feeder_thread = None
+
+        for dispatch_thread in self.dispatch_threads:
+            dispatch_thread.stop()
+        for dispatch_thread in self.dispatch_threads:
+            # the handler in progress finishes, the lane isn't consumed afterwards
+            util.join_thread(dispatch_thread, deadline)
+            while True:
+                try:
+                    delivery_token, msg = dispatch_thread.lane_queue.get(block=False)
+                    dispatch_thread.lane_queue.task_done()
+                except queue.Empty:
+                    break
+                self.nack_async(delivery_token, self._log_failed_response)
+        self.dispatch_threads = []
+
+    # take the messages received but not returned by receive() yet out of the buffer, all of them or only
+    # the ones received from hostport, and nack them so they're redelivered without waiting for the timeout
+    def _release_buffered_messages(self, hostport=None):
+        released = self.msg_queue.remove(
+            lambda result: hostport is None or util.get_hostport_from_delivery_token(result[0]) == hostport)
+        self._release_messages(released, hostport)
+
+    # also called by the consumer threads with the messages received after they were stopped
+    def _release_messages(self, released, hostport=None):
+        if not released:
+            return
+
+        util.stats_count(self.tchannel.name, 'consumer_msg_queue.released', hostport, len(released))
+        # STREAMING consumer groups can't nack, the messages are redelivered from the last checkpoint
+        if self.streaming:
+            return
+        for delivery_token, msg in released:
+            self.nack_async(delivery_token, self._log_failed_response)
 
     # Receive messages from cherami. This returns an array of tuple. First value of the tuple is a delivery_token,
     # which can be used to ack or nack the message. The second value of the tuple is the actual message, which is a
     # cherami.ConsumerMessage(in cherami.thrift) object
-    def receive(self, num_msgs):
+    # Chunks of large messages are buffered until the whole message can be returned. Its delivery token
+    # acks or nacks all of the chunks
+    # stop_signal: optional Event, once set receive returns the messages it has without waiting for more
+    def receive(self, num_msgs, stop_signal=None):
         start_time = time.time()
         timeout_stats = 'cherami_client_python.{}.receive.timeout'.format(self.tchannel.name)
         duration_stats = 'cherami_client_python.{}.receive.duration'.format(self.tchannel.name)
 
+        self._expire_chunks()
+
         msgs = []
         end_time = time.time() + self.timeout_seconds
         while len(msgs) < num_msgs:
@@ -170,16 +484,128 @@ class Consumer(object):
                 stats.count(timeout_stats, 1)
                 stats.timing(duration_stats, util.time_diff_in_ms(start_time, time.time()))
                 return msgs
+            if stop_signal is not None:
+                if stop_signal.is_set():
+                    return msgs
+                seconds_remaining = min(seconds_remaining, self.stop_poll_interval_seconds)
             try:
-                msgs.append(self.msg_queue.get(block=True, timeout=seconds_remaining))
+                result = self.msg_queue.get(block=True, timeout=seconds_remaining)
                 self.msg_queue.task_done()
 
                 util.stats_count(self.tchannel.name, 'consumer_msg_queue.dequeue', None, 1)
             except queue.Empty:
-                pass
+                continue
+
+            if self.chunk_reassembler is not None and chunking.is_chunk(result[1]):
+                result = self._reassemble(result)
+                if result is None:
+                    continue
+            if self.dedupe_seen_keys is not None and self._is_duplicate(result):
+                continue
+            if self.nack_pending_keys is not None:
+                self.nack_pending_keys.put(result[0], self.dedupe_key_func(result[1]))
+            msgs.append(self._decode(result))
         stats.timing(duration_stats, util.time_diff_in_ms(start_time, time.time()))
         return msgs
 
+    # duplicates are not returned to the application. A key maps to True once the original was acked
+    # successfully, then the duplicate is acked too. While the original is still pending the duplicate
+    # is dropped without an ack, so it's redelivered if the original ends up nacked or its ack fails
+    def _is_duplicate(self, result):
+        delivery_token, msg = result
+        key = self.dedupe_key_func(msg)
+        if key is None:
+            return False
+
+        self.dedupe_lookups += 1
+        util.stats_count(self.tchannel.name, 'consumer_dedupe.lookup', None, 1)
+        acked = self.dedupe_seen_keys.get(key)
+        if acked is not None:
+            self.dedupe_hits += 1
+            util.stats_count(self.tchannel.name, 'consumer_dedupe.hit', None, 1)
+            if acked:
+                self.ack_async(delivery_token, self._log_failed_response)
+            else:
+                util.stats_count(self.tchannel.name, 'consumer_dedupe.pending_drop', None, 1)
+            return True
+
+        self.dedupe_seen_keys.put(key, False)
+        self.dedupe_pending_keys.put(delivery_token, key)
+        return False
+
+    # ratio of received messages that were suppressed as duplicates
+    def get_dedupe_hit_rate(self):
+        if not self.dedupe_lookups:
+            return 0.0
+        return float(self.dedupe_hits) / self.dedupe_lookups
+
+    def _reassemble(self, result):
+        delivery_token, msg = result
+        # each chunk has its own checksum. A corrupted chunk is nacked right away so it gets redelivered
+        if not self.verify_checksum(msg):
+            util.stats_count(self.tchannel.name, 'consumer_chunk.checksum_failure', None, 1)
+            self.nack_async(delivery_token, self._log_failed_response)
+            return None
+        return self.chunk_reassembler.add(delivery_token, msg)
+
+    # Incomplete messages given up are not nacked: if their chunks went to other consumer instances, nacking
+    # would only start the same wait over. They're redelivered once their lock times out, and moved to the
+    # DLQ after the delivery limit. Returns the delivery tokens of their chunks
+    def _expire_chunks(self):
+        if self.chunk_reassembler is None:
+            return []
+        expired_tokens = self.chunk_reassembler.expire()
+        if expired_tokens:
+            util.stats_count(self.tchannel.name, 'consumer_chunk.expired', None, len(expired_tokens))
+            self.logger.info({
+                'msg': 'incomplete chunked messages given up',
+                'chunks': len(expired_tokens)
+            })
+        return expired_tokens
+
+    def _log_failed_response(self, ack_result):
+        if not ack_result.call_success:
+            self.logger.info({
+                'msg': 'ack failure',
+                'delivery token': ack_result.delivery_token,
+                'error msg': ack_result.error_msg
+            })
+
+    # decompress the payload if the publisher recorded a codec in userContext.
+    # The checksum covers the wire bytes, so it's verified here and cleared once the payload is decoded.
+    # Payloads that fail verification or decoding are returned untouched
+    def _decode(self, result):
+        msg = result[1]
+        payload = msg.payload
+        if not self.codec or not payload or not payload.userContext \
+                or codec.CODEC_CONTEXT_KEY not in payload.userContext:
+            return result
+
+        if not self.verify_checksum(msg):
+            util.stats_count(self.tchannel.name, 'consumer_codec.checksum_failure', None, 1)
+            return result
+
+        try:
+            payload.data, payload.userContext = self.codec.decode(payload.data, payload.userContext)
+            payload.crc32IEEEDataChecksum = None
+            payload.md5DataChecksum = None
+        except Exception as e:
+            util.stats_count(self.tchannel.name, 'consumer_codec.decode_failure', None, 1)
+            self.logger.info({
+                'msg': 'error decoding msg payload',
+                'delivery token': result[0],
+                'exception': str(e)
+            })
+        return result
+
+    # Wrap the results of receive() so that each payload is decoded by the serializer registered for its
+    # schemaVersion. Decoding is lazy and happens on the first access of the value of the returned message
+    def decode_batch(self, results):
+        if not self.serializer_registry:
+            raise Exception("Serializer registry is needed to decode messages")
+        return [serializer.DecodedMessage(delivery_token, msg, self.serializer_registry)
+                for delivery_token, msg in results]
+
     # verify checksum of the message received from cherami
     # return true if the data matches checksum. Otherwise return false
     # Consumer needs to perform this verification and decide what to do based on returned result
@@ -198,17 +624,165 @@ class Consumer(object):
     def ack(self, delivery_token):
         return self._respond(is_ack=True, delivery_token=delivery_token)
 
+    # The callback runs on the client callback executor if any. Its exceptions don't fail the ack
     def ack_async(self, delivery_token, callback):
+        callback = wrap_callback(self.logger, callback, self.callback_executor)
         return self._respond_async(is_ack=True, delivery_token=delivery_token, callback=callback)
 
     # Nack can be used by application to Nack a message so it can be delivered to
     # another consumer immediately without waiting for the timeout to expire
-    def nack(self, delivery_token):
+    # delay_seconds: how long to hold the nack before sending it, by default the nack backoff of the message.
+    # A delayed nack returns once it's scheduled. The delay should stay below the lock timeout of the consumer
+    # group, which redelivers the message anyway
+    def nack(self, delivery_token, delay_seconds=None):
+        delay_seconds = self._get_nack_delay(delivery_token, delay_seconds)
+        if delay_seconds > 0 and not self.streaming:
+            self._schedule_nack(delivery_token, self._log_failed_response, delay_seconds)
+            return True
         return self._respond(is_ack=False, delivery_token=delivery_token)
 
-    def nack_async(self, delivery_token, callback):
+    def nack_async(self, delivery_token, callback, delay_seconds=None):
+        callback = wrap_callback(self.logger, callback, self.callback_executor)
+        delay_seconds = self._get_nack_delay(delivery_token, delay_seconds)
+        if delay_seconds > 0 and not self.streaming:
+            self._schedule_nack(delivery_token, callback, delay_seconds)
+            return
         return self._respond_async(is_ack=False, delivery_token=delivery_token, callback=callback)
 
+    # Ack a batch of messages, waiting once for all of them. Returns whether each ack succeeded, in the order
+    # of the delivery tokens. The acks waiting in the queue are sent together by the ack threads
+    def ack_many(self, delivery_tokens):
+        return self._respond_many(True, delivery_tokens, None)
+
+    # Nack a batch of messages, waiting once for all of them. Delayed nacks succeed once scheduled
+    def nack_many(self, delivery_tokens, delay_seconds=None):
+        return self._respond_many(False, delivery_tokens, delay_seconds)
+
+    # the whole batch, queueing included, takes no longer than the call timeout
+    def _respond_many(self, is_ack, delivery_tokens, delay_seconds):
+        deadline = time.time() + self.timeout_seconds
+        delivery_tokens = list(delivery_tokens)
+        results = [None] * len(delivery_tokens)
+        pending = [len(delivery_tokens)]
+        lock = Lock()
+        done_signal = Event()
+
+        def respond(index, ack_result):
+            results[index] = ack_result
+            with lock:
+                pending[0] -= 1
+                if pending[0] == 0:
+                    done_signal.set()
+
+        for index, delivery_token in enumerate(delivery_tokens):
+            callback = functools.partial(respond, index)
+            if not delivery_token:
+                callback(None)
+                continue
+            if is_ack:
+                self._respond_async(True, delivery_token, callback, deadline)
+                continue
+
+            delay = self._get_nack_delay(delivery_token, delay_seconds)
+            if delay > 0 and not self.streaming:
+                self._schedule_nack(delivery_token, self._log_failed_response, delay)
+                callback(AckMessageResult(call_success=True, is_ack=False, delivery_token=delivery_token,
+                                          error_msg=None))
+            else:
+                self._respond_async(False, delivery_token, callback, deadline)
+
+        if delivery_tokens:
+            done_signal.wait(max(0, deadline - time.time()))
+        failed = [r for r in results if r is not None and not r.call_success]
+        timed_out = len([token for token, r in zip(delivery_tokens, results) if token and r is None])
+        if failed or timed_out:
+            self.logger.info({
+                'msg': 'ack failure',
+                'failed': len(failed),
+                'timed out': timed_out,
+                'error msg': failed[0].error_msg if failed else 'timed out'
+            })
+        return [r is not None and r.call_success for r in results]
+
+    # with nack backoff, each nack of a message doubles its delay, up to nack_backoff_max_seconds
+    def _get_nack_delay(self, delivery_token, delay_seconds):
+        if self.nack_pending_keys is None or not delivery_token:
+            return delay_seconds or 0
+        key = self.nack_pending_keys.pop(delivery_token)
+        if key is None:
+            return delay_seconds or 0
+
+        count = self.nack_counts.get(key, 0) + 1
+        self.nack_counts.put(key, count)
+        if delay_seconds is not None:
+            return delay_seconds
+        return min(self.nack_backoff_max_seconds, self.nack_backoff_seconds * 2 ** (count - 1))
+
+    def _schedule_nack(self, delivery_token, callback, delay_seconds):
+        if delivery_token is None or callback is None:
+            return
+        with self.delayed_nack_lock:
+            if self.delayed_nack_thread is None:
+                self.delayed_nack_thread = DelayedNackThread(self.logger, self._send_nacks)
+                self.delayed_nack_thread.start()
+            closing = self.delayed_nack_thread.stop_signal.is_set()
+            if not closing:
+                self._forget_dedupe_key(False, delivery_token)
+                self.delayed_nack_thread.schedule(delay_seconds, delivery_token, callback)
+        if closing:
+            # the consumer is closing, the nack isn't held any more
+            self._respond_async(False, delivery_token, callback)
+            return
+        util.stats_count(self.tchannel.name, 'consumer_delayed_nack.scheduled', None, 1)
+        stats.gauge('cherami_client_python.{}.consumer_delayed_nack.pending'.format(self.tchannel.name),
+                    self.get_delayed_nack_count())
+
+    # number of nacks waiting for their delay to pass or being sent
+    def get_delayed_nack_count(self):
+        delayed_nack_thread = self.delayed_nack_thread
+        return len(delayed_nack_thread) if delayed_nack_thread is not None else 0
+
+    # called by the delayed nack thread with the due nacks: one ackMessages call per outputhost
+    def _send_nacks(self, items):
+        host_tokens = {}
+        for delivery_token, callback in items:
+            if util.is_chunked_delivery_token(delivery_token):
+                aggregator = chunking.ChunkAckResultAggregator(delivery_token, callback)
+                tokens = [(chunk_delivery_token, aggregator) for chunk_delivery_token in delivery_token]
+            else:
+                tokens = [(delivery_token, callback)]
+            for token, token_callback in tokens:
+                hostport = util.get_hostport_from_delivery_token(token)
+                host_tokens.setdefault(hostport, []).append((token, token_callback))
+
+        for hostport, tokens in host_tokens.items():
+            error_msg = None
+            try:
+                util.execute_output_host(tchannel=self.tchannel,
+                                         headers=self.headers,
+                                         hostport=hostport,
+                                         timeout=get_call_timeout(self.timeouts, self.timeout_seconds, hostport,
+                                                                  'ackMessages'),
+                                         method_name='ackMessages',
+                                         request=cherami.AckMessagesRequest(
+                                             ackIds=[],
+                                             nackIds=[util.get_ack_id_from_delivery_token(token)
+                                                      for token, token_callback in tokens]),
+                                         latency_observer=get_latency_observer(self.timeouts))
+                util.stats_count(self.tchannel.name, 'consumer_delayed_nack.sent', hostport, len(tokens))
+            except Exception as e:
+                self.logger.info({
+                    'msg': 'error sending delayed nacks to output host',
+                    'hostport': hostport,
+                    'exception': str(e)
+                })
+                error_msg = str(e)
+            for token, token_callback in tokens:
+                run_callback(self.logger, token_callback, AckMessageResult(call_success=error_msg is None,
+                                                                           is_ack=False,
+                                                                           delivery_token=token,
+                                                                           error_msg=error_msg))
+
     def _respond(self, is_ack, delivery_token):
         if not delivery_token:
             return
@@ -241,14 +815,47 @@ class Consumer(object):
                 })
                 return False
 
-    def _respond_async(self, is_ack, delivery_token, callback):
+    # a nacked message is redelivered, it's not a duplicate then. An acked key is only marked acked
+    # once the ack succeeded, returns the callback to use for the response
+    def _forget_dedupe_key(self, is_ack, delivery_token, callback=None):
+        if self.dedupe_pending_keys is None:
+            return callback
+        key = self.dedupe_pending_keys.pop(delivery_token)
+        if key is None:
+            return callback
+        if not is_ack:
+            self.dedupe_seen_keys.pop(key)
+            return callback
+        return functools.partial(self._dedupe_ack_done, key, callback)
+
+    def _dedupe_ack_done(self, key, callback, ack_result):
+        if ack_result.call_success:
+            self.dedupe_seen_keys.put(key, True)
+        else:
+            self.dedupe_seen_keys.pop(key)
+        callback(ack_result)
+
+    # deadline: optional time by which the ack has to be queued, instead of waiting up to the call timeout
+    def _respond_async(self, is_ack, delivery_token, callback, deadline=None):
         if delivery_token is None or callback is None:
             return
 
+        callback = self._forget_dedupe_key(is_ack, delivery_token, callback)
+        if is_ack and self.nack_pending_keys is not None:
+            key = self.nack_pending_keys.pop(delivery_token)
+            if key is not None:
+                self.nack_counts.pop(key)
+
+        if util.is_chunked_delivery_token(delivery_token):
+            aggregator = chunking.ChunkAckResultAggregator(delivery_token, callback)
+            for chunk_delivery_token in delivery_token:
+                self._respond_async(is_ack, chunk_delivery_token, aggregator, deadline)
+            return
+
         try:
             self.ack_queue.put((is_ack, delivery_token, callback),
                                block=True,
-                               timeout=self.timeout_seconds)
+                               timeout=self.timeout_seconds if deadline is None else max(0, deadline - time.time()))
 
             hostport = util.get_hostport_from_delivery_token(delivery_token)
             util.stats_count(self.tchannel.name, 'consumer_ack_queue.enqueue', hostport, 1)
@@ -21,6 +21,7 @@
 from __future__ import absolute_import
 
 import traceback
+from collections import deque
 from threading import Thread, Event
 from six.moves.queue import Full
 
@@ -29,6 +30,14 @@ from cherami_client.lib import cherami
 
 
 class ConsumerThread(Thread):
+    # how often calls in flight are checked for completion while more than one can be in flight
+    poll_interval_seconds = 0.005
+
+    # max_inflight_receives: how many receiveMessageBatch long polls can be in flight to the outputhost.
+    # Each one asks for no more messages than the buffer has room for
+    # release_func: optional function called with the (delivery_token, msg) tuples received once stopped,
+    # which aren't buffered any more. Once stopped, the long polls in flight are waited for, so joining
+    # the thread can take up to timeout_seconds
     def __init__(self,
                  tchannel,
                  headers,
@@ -38,7 +47,10 @@ class ConsumerThread(Thread):
                  path,
                  consumer_group_name,
                  timeout_seconds,
-                 msg_batch_size):
+                 msg_batch_size,
+                 streaming=False,
+                 max_inflight_receives=1,
+                 release_func=None):
         Thread.__init__(self)
         self.tchannel = tchannel
         self.headers = headers
@@ -49,46 +61,36 @@ class ConsumerThread(Thread):
         self.consumer_group_name = consumer_group_name
         self.timeout_seconds = timeout_seconds
         self.msg_batch_size = msg_batch_size
+        self.streaming = streaming
+        self.max_inflight_receives = max(1, max_inflight_receives)
+        self.release_func = release_func
+        # set when the last receive returned no message, i.e. there's no backlog on this host
+        self.caught_up = Event()
         self.stop_signal = Event()
+        # (PendingCall, number of messages asked for) in call order
+        self.inflight = deque()
 
     def stop(self):
         self.stop_signal.set()
 
     def run(self):
-        request = cherami.ReceiveMessageBatchRequest(destinationPath=self.path,
-                                                     consumerGroupName=self.consumer_group_name,
-                                                     maxNumberOfMessages=self.msg_batch_size,
-                                                     receiveTimeout=max(1, self.timeout_seconds - 1)
-                                                     )
         while not self.stop_signal.is_set():
-            # possible optimization: if we don't have enough capacity in the queue,
-            # backoff for a bit before pulling from Cherami again
             try:
-                result = util.execute_output_host(tchannel=self.tchannel,
-                                                  headers=self.headers,
-                                                  hostport=self.hostport,
-                                                  timeout=self.timeout_seconds,
-                                                  method_name='receiveMessageBatch',
-                                                  request=request)
-                util.stats_count(self.tchannel.name,
-                                 'receiveMessageBatch.messages',
-                                 self.hostport,
-                                 len(result.messages))
-
-                for msg in result.messages:
-                    # if the queue is full, keep trying until there's free slot, or the thread has been shutdown
-                    while not self.stop_signal.is_set():
-                        try:
-                            self.msg_queue.put((util.create_delivery_token(msg.ackId, self.hostport), msg),
-                                               block=True,
-                                               timeout=5)
-                            util.stats_count(self.tchannel.name,
-                                             'consumer_msg_queue.enqueue',
-                                             self.hostport,
-                                             1)
-                            break
-                        except Full:
-                            pass
+                self._complete_done_receives()
+
+                if len(self.inflight) < self.max_inflight_receives:
+                    batch_size = self._get_batch_size()
+                    if batch_size > 0:
+                        self._start_receive(batch_size)
+                        continue
+
+                if not self.inflight:
+                    # no room in the buffer
+                    self.stop_signal.wait(self.poll_interval_seconds)
+                elif self.max_inflight_receives == 1:
+                    self._complete_receive(*self.inflight.popleft())
+                else:
+                    self.stop_signal.wait(self.poll_interval_seconds)
             except Exception as e:
                 self.logger.info({
                     'msg': 'error receiving msg from output host',
@@ -96,3 +98,93 @@ class ConsumerThread(Thread):
                     'traceback': traceback.format_exc(),
                     'exception': str(e)
                 })
+
+        # the messages of the receives still in flight are released as they complete
+        while self.inflight:
+            self._complete_receive(*self.inflight.popleft())
+
+    # number of messages to ask for: the buffer room of the host, minus the messages of the receives in flight
+    def _get_batch_size(self):
+        # a single receive at a time waits for room in the buffer after the call instead
+        if self.max_inflight_receives == 1:
+            return self.msg_batch_size
+
+        available = self.msg_queue.get_available_credit(self.hostport)
+        if available is None:
+            return self.msg_batch_size
+        return min(self.msg_batch_size, available - sum(size for call, size in self.inflight))
+
+    def _start_receive(self, batch_size):
+        request = cherami.ReceiveMessageBatchRequest(destinationPath=self.path,
+                                                     consumerGroupName=self.consumer_group_name,
+                                                     maxNumberOfMessages=batch_size,
+                                                     receiveTimeout=max(1, self.timeout_seconds - 1)
+                                                     )
+        call = util.start_output_host_call(tchannel=self.tchannel,
+                                           headers=self.headers,
+                                           hostport=self.hostport,
+                                           timeout=self.timeout_seconds,
+                                           method_name='receiveMessageBatch',
+                                           request=request)
+        self.inflight.append((call, batch_size))
+
+    def _complete_done_receives(self):
+        if not any(call.done() for call, size in self.inflight):
+            return
+
+        pending = deque()
+        while self.inflight:
+            call, size = self.inflight.popleft()
+            if call.done():
+                self._complete_receive(call, size)
+            else:
+                pending.append((call, size))
+        self.inflight = pending
+
+    def _complete_receive(self, call, batch_size):
+        try:
+            result = call.result()
+        except Exception as e:
+            self.logger.info({
+                'msg': 'error receiving msg from output host',
+                'hostport': self.hostport,
+                'traceback': traceback.format_exc(),
+                'exception': str(e)
+            })
+            return
+
+        util.stats_count(self.tchannel.name,
+                         'receiveMessageBatch.messages',
+                         self.hostport,
+                         len(result.messages))
+        if result.messages:
+            self.caught_up.clear()
+        else:
+            self.caught_up.set()
+
+        # STREAMING consumer group messages have no ack id, they are tracked by lsn and address
+        if self.streaming:
+            received = [(util.create_streaming_delivery_token(msg.lsn, self.hostport, msg.address), msg)
+                        for msg in result.messages]
+        else:
+            received = [(util.create_delivery_token(msg.ackId, self.hostport), msg) for msg in result.messages]
+
+        for index, item in enumerate(received):
+            # if the queue is full, keep trying until there's free slot, or the thread has been shutdown
+            while not self.stop_signal.is_set():
+                try:
+                    self.msg_queue.put(item,
+                                       block=True,
+                                       timeout=5)
+                    util.stats_count(self.tchannel.name,
+                                     'consumer_msg_queue.enqueue',
+                                     self.hostport,
+                                     1)
+                    break
+                except Full:
+                    pass
+            else:
+                # once stopped, the rest of the batch is released instead of buffered
+                if self.release_func:
+                    self.release_func(received[index:], self.hostport)
+                return
@@ -0,0 +1,82 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import heapq
+import time
+import traceback
+from threading import Thread, Condition, Event
+
+
+# Holds nacks until their delay has passed, in a heap ordered by due time. The nacks due at the same time
+# are handed to send_func together as a list of (delivery_token, callback), so they can be sent in batches.
+# Once stopped, the nacks still held are sent right away
+class DelayedNackThread(Thread):
+    def __init__(self, logger, send_func):
+        Thread.__init__(self)
+        self.logger = logger
+        self.send_func = send_func
+        self.heap = []
+        self.count = 0
+        # number of nacks taken off the heap and being sent
+        self.sending = 0
+        self.condition = Condition()
+        self.stop_signal = Event()
+
+    def stop(self):
+        with self.condition:
+            self.stop_signal.set()
+            self.condition.notify()
+
+    def schedule(self, delay_seconds, delivery_token, callback):
+        with self.condition:
+            # the count keeps nacks due at the same time in order, without comparing their tokens
+            heapq.heappush(self.heap, (time.time() + delay_seconds, self.count, delivery_token, callback))
+            self.count += 1
+            self.condition.notify()
+
+    # nacks held or being sent
+    def __len__(self):
+        with self.condition:
+            return len(self.heap) + self.sending
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stop_signal.is_set() and (not self.heap or self.heap[0][0] > time.time()):
+                    self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+                now = float('inf') if self.stop_signal.is_set() else time.time()
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    due_time, count, delivery_token, callback = heapq.heappop(self.heap)
+                    due.append((delivery_token, callback))
+                self.sending = len(due)
+
+            if due:
+                try:
+                    self.send_func(due)
+                except Exception as e:
+                    self.logger.info({
+                        'msg': 'error sending delayed nacks',
+                        'traceback': traceback.format_exc(),
+                        'exception': str(e)
+                    })
+                finally:
+                    self.sending = 0
+            if self.stop_signal.is_set():
+                return
@@ -0,0 +1,126 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import
+
+import traceback
+from threading import Thread, Event
+from six.moves.queue import Empty, Full
+
+from cherami_client.lib import util
+
+
+# default key of a message: the value of the given userContext key
+def get_context_key(context_key):
+    def key_func(msg):
+        if msg.payload is None or not msg.payload.userContext:
+            return None
+        return msg.payload.userContext.get(context_key)
+    return key_func
+
+
+# A lane processes its messages one at a time, in the order they were dispatched to it
+class DispatchThread(Thread):
+    def __init__(self, consumer, lane_queue, handler, auto_ack, logger):
+        Thread.__init__(self)
+        self.consumer = consumer
+        self.lane_queue = lane_queue
+        self.handler = handler
+        self.auto_ack = auto_ack
+        self.logger = logger
+        self.stop_signal = Event()
+
+    def stop(self):
+        self.stop_signal.set()
+
+    def run(self):
+        while not self.stop_signal.is_set():
+            try:
+                delivery_token, msg = self.lane_queue.get(block=True, timeout=1)
+                self.lane_queue.task_done()
+            except Empty:
+                continue
+
+            try:
+                self.handler(delivery_token, msg)
+                if self.auto_ack:
+                    self.consumer.ack(delivery_token)
+            except Exception as e:
+                util.stats_count(self.consumer.tchannel.name, 'consumer_dispatch.handler_exception', None, 1)
+                self.logger.info({
+                    'msg': 'error handling dispatched msg',
+                    'delivery token': delivery_token,
+                    'traceback': traceback.format_exc(),
+                    'exception': str(e)
+                })
+                if self.auto_ack:
+                    self.consumer.nack(delivery_token)
+
+
+# Receives messages from the consumer and dispatches each one to a lane picked by hashing its key,
+# so messages with the same key are handled in order while different keys are handled in parallel.
+# A full lane blocks dispatching, which stops receiving and pushes back on the consumer threads
+class DispatchFeederThread(Thread):
+    def __init__(self, consumer, lane_queues, key_func, receive_batch_size, logger):
+        Thread.__init__(self)
+        self.consumer = consumer
+        self.lane_queues = lane_queues
+        self.key_func = key_func
+        self.receive_batch_size = receive_batch_size
+        self.logger = logger
+        self.stop_signal = Event()
+        self.next_lane = 0
+
+    def stop(self):
+        self.stop_signal.set()
+
+    def get_lane(self, msg):
+        key = self.key_func(msg)
+        if key is None:
+            # no ordering needed, spread the message evenly
+            self.next_lane = (self.next_lane + 1) % len(self.lane_queues)
+            return self.next_lane
+        return hash(key) % len(self.lane_queues)
+
+    def run(self):
+        while not self.stop_signal.is_set():
+            try:
+                results = self.consumer.receive(self.receive_batch_size, stop_signal=self.stop_signal)
+            except Exception as e:
+                self.logger.info({
+                    'msg': 'error receiving msg for dispatch',
+                    'traceback': traceback.format_exc(),
+                    'exception': str(e)
+                })
+                continue
+
+            for result in results:
+                lane_queue = self.lane_queues[self.get_lane(result[1])]
+                dispatched = False
+                while not self.stop_signal.is_set():
+                    try:
+                        lane_queue.put(result, block=True, timeout=1)
+                        dispatched = True
+                        break
+                    except Full:
+                        util.stats_count(self.consumer.tchannel.name, 'consumer_dispatch.lane_full', None, 1)
+                if not dispatched:
+                    # stopped before dispatching, make the message available to other consumers right away
+                    self.consumer.nack_async(result[0], self.consumer._log_failed_response)
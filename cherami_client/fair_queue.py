@@ -0,0 +1,171 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import math
+import time
+from collections import deque
+
+from six.moves import queue
+
+from cherami_client.lib import util
+
+
+# Buffer of the messages received from all outputhosts of a consumer, queued as (delivery_token, msg) tuples.
+# Each outputhost has its own sub-buffer, and they are served with deficit round robin: each host in turn
+# gets up to quantum messages dequeued. Each host can buffer at most its share of maxsize (its credit),
+# so a host with a large backlog can't fill the buffer and block the others
+class FairMessageQueue(queue.Queue):
+    def __init__(self, maxsize=0, quantum=1):
+        self.quantum = quantum
+        queue.Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        # hostport -> deque of messages
+        self.buffers = {}
+        # hosts with buffered messages, in turn order
+        self.active = deque()
+        self.deficits = {}
+        self.size = 0
+        self.host_count = 1
+
+    def _qsize(self):
+        return self.size
+
+    def _put(self, item):
+        hostport = util.get_hostport_from_delivery_token(item[0])
+        buffer = self.buffers.get(hostport)
+        if buffer is None:
+            buffer = self.buffers[hostport] = deque()
+        if not buffer:
+            self.active.append(hostport)
+            self.deficits[hostport] = 0
+        buffer.append(item)
+        self.size += 1
+
+    def _get(self):
+        hostport = self.active[0]
+        if self.deficits[hostport] < 1:
+            self.deficits[hostport] += self.quantum
+
+        buffer = self.buffers[hostport]
+        item = buffer.popleft()
+        self.size -= 1
+        self.deficits[hostport] -= 1
+        if not buffer:
+            self.active.popleft()
+            del self.buffers[hostport]
+            del self.deficits[hostport]
+        elif self.deficits[hostport] < 1:
+            # turn of the next host
+            self.active.rotate(-1)
+        return item
+
+    # number of messages a host can buffer
+    def get_credit(self):
+        if self.maxsize <= 0:
+            return None
+        return max(1, int(math.ceil(float(self.maxsize) / self.host_count)))
+
+    # number of messages the host can still buffer, or None if unlimited
+    def get_available_credit(self, hostport):
+        credit = self.get_credit()
+        if credit is None:
+            return None
+        with self.mutex:
+            buffer = self.buffers.get(hostport)
+            return max(0, min(credit - (len(buffer) if buffer else 0), self.maxsize - self.size))
+
+    # the credit of each host is its share of maxsize
+    def set_host_count(self, host_count):
+        with self.mutex:
+            self.host_count = max(1, host_count)
+            self.not_full.notify_all()
+
+    def _is_full(self, hostport):
+        if self.maxsize <= 0:
+            return False
+        if self.size >= self.maxsize:
+            return True
+        buffer = self.buffers.get(hostport)
+        return buffer is not None and len(buffer) >= self.get_credit()
+
+    # same as Queue.put, except that it blocks while the host of the message has used up its credit
+    def put(self, item, block=True, timeout=None):
+        hostport = util.get_hostport_from_delivery_token(item[0])
+        with self.not_full:
+            if not block:
+                if self._is_full(hostport):
+                    raise queue.Full
+            elif timeout is None:
+                while self._is_full(hostport):
+                    self.not_full.wait()
+            else:
+                end_time = time.time() + timeout
+                while self._is_full(hostport):
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        raise queue.Full
+                    self.not_full.wait(remaining)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    # same as Queue.get, except that all threads waiting to put are woken up, since only
+    # the ones putting messages of the host dequeued from may be able to proceed
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not block:
+                if not self.size:
+                    raise queue.Empty
+            elif timeout is None:
+                while not self.size:
+                    self.not_empty.wait()
+            else:
+                end_time = time.time() + timeout
+                while not self.size:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self.not_empty.wait(remaining)
+            item = self._get()
+            self.not_full.notify_all()
+            return item
+
+    # take the messages matching predicate(item) out of the buffer, and return them
+    def remove(self, predicate):
+        with self.mutex:
+            removed = []
+            for hostport in list(self.buffers.keys()):
+                buffer = self.buffers[hostport]
+                kept = deque()
+                for item in buffer:
+                    if predicate(item):
+                        removed.append(item)
+                    else:
+                        kept.append(item)
+                if kept:
+                    self.buffers[hostport] = kept
+                else:
+                    del self.buffers[hostport]
+                    del self.deficits[hostport]
+                    self.active.remove(hostport)
+            self.size -= len(removed)
+            self.unfinished_tasks -= len(removed)
+            self.not_full.notify_all()
+            return removed
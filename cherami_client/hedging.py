@@ -0,0 +1,98 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import random
+import threading
+import time
+from collections import deque
+
+from cherami_client.lib import cherami
+
+
+# Decides when a putMessageBatch call is slow enough to be sent again to another inputhost.
+# A call is hedged once it has been in flight longer than the given percentile of the recent call latencies.
+# Each call earns budget_percent / 100 of a hedge, so at most budget_percent of the calls are hedged
+class HedgePolicy(object):
+    # latencies needed before hedging starts
+    min_samples = 20
+    # hedges that can be saved up while calls are fast
+    max_budget = 10
+
+    def __init__(self, percentile=95, budget_percent=5, window_size=1000, min_delay_seconds=0.005):
+        if not 0 < percentile < 100:
+            raise Exception("Hedge percentile must be between 0 and 100: {0}".format(percentile))
+        self.percentile = percentile
+        self.budget_percent = budget_percent
+        self.min_delay_seconds = min_delay_seconds
+        self.latencies = deque(maxlen=window_size)
+        self.budget = 0.0
+        self.recorded = 0
+        self.delay = None
+        self.hostports = []
+        self.lock = threading.Lock()
+
+    def record(self, latency_seconds):
+        with self.lock:
+            self.latencies.append(latency_seconds)
+            self.budget = min(self.max_budget, self.budget + self.budget_percent / 100.0)
+            self.recorded += 1
+            # the delay is computed again every min_samples calls
+            if self.recorded % self.min_samples == 0:
+                latencies = sorted(self.latencies)
+                index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.0))
+                self.delay = max(self.min_delay_seconds, latencies[index])
+
+    # how long a call is in flight before it's hedged, None until there are enough latencies
+    def get_delay(self):
+        return self.delay
+
+    # returns the inputhost to send a hedge of a call to hostport, or None if the budget is spent
+    def acquire(self, hostport):
+        with self.lock:
+            others = [h for h in self.hostports if h != hostport]
+            if not others or self.budget < 1:
+                return None
+            self.budget -= 1
+            return random.choice(others)
+
+
+# Callback of a task whose messages may be sent to two inputhosts. The first OK ack of each message is passed on,
+# a failed ack only when no other call for the message is in flight. Only used by the thread sending the task
+class HedgedCallback(object):
+    def __init__(self, msgs, callback):
+        self.callback = callback
+        self.start_time = time.time()
+        self.hedged = False
+        self.attempts = dict((msg.id, 1) for msg in msgs)
+        self.acked = set()
+
+    def hedge(self):
+        self.hedged = True
+        for id in self.attempts:
+            self.attempts[id] += 1
+
+    def __call__(self, ack):
+        if ack.id in self.acked:
+            return
+        self.attempts[ack.id] = self.attempts.get(ack.id, 1) - 1
+        if ack.status != cherami.Status.OK and self.attempts[ack.id] > 0:
+            return
+        self.acked.add(ack.id)
+        if callable(self.callback):
+            self.callback(ack)
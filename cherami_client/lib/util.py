@@ -32,67 +32,107 @@ from clay import stats
 
 # helper to execute thrift call
 def execute_frontend(tchannel, deployment_str, headers, timeout, method_name, request):
-    frontend_module = cherami_frontend.load_frontend(deployment_str)
-    method = getattr(frontend_module.BFrontend, method_name)
-    if not callable(method):
-        raise Exception("Not a valid callable method: " + method_name)
+    return start_frontend_call(tchannel, deployment_str, headers, timeout, method_name, request).result()
 
-    start_time = time.time()
-    try:
-        stats_count(tchannel.name, '{}.calls'.format(method_name), None, 1)
 
-        result = tchannel.thrift(method(request), headers=headers, timeout=timeout).result().body
+def execute_input_host(tchannel, headers, hostport, timeout, method_name, request, latency_observer=None):
+    return start_input_host_call(tchannel, headers, hostport, timeout, method_name, request,
+                                 latency_observer).result()
 
-        stats_count(tchannel.name, '{}.success'.format(method_name), None, 1)
-        stats_timing(tchannel.name, '{}.duration.success'.format(method_name), start_time)
 
-        return result
-    except Exception:
-        stats_count(tchannel.name, '{}.exception'.format(method_name), None, 1)
-        stats_timing(tchannel.name, '{}.duration.exception'.format(method_name), start_time)
-        raise
+def execute_output_host(tchannel, headers, hostport, timeout, method_name, request, latency_observer=None):
+    return start_output_host_call(tchannel, headers, hostport, timeout, method_name, request,
+                                  latency_observer).result()
+
+
+# helpers to start a thrift call without waiting for its result, so that several calls can be in flight.
+# The returned PendingCall gives the result once the call completes.
+# latency_observer: optional function called with the hostport, method name and latency of calls, and failed=True
+# for the calls that failed
+def start_frontend_call(tchannel, deployment_str, headers, timeout, method_name, request):
+    frontend_module = cherami_frontend.load_frontend(deployment_str)
+    method = getattr(frontend_module.BFrontend, method_name)
+    if not callable(method):
+        raise Exception("Not a valid callable method: " + method_name)
+    return _start_call(tchannel, None, method_name,
+                       lambda: tchannel.thrift(method(request), headers=headers, timeout=timeout))
 
 
-def execute_input_host(tchannel, headers, hostport, timeout, method_name, request):
+def start_input_host_call(tchannel, headers, hostport, timeout, method_name, request, latency_observer=None):
     method = getattr(cherami_input.BIn, method_name)
     if not callable(method):
         raise Exception("Not a valid callable method: " + method_name)
+    return _start_call(tchannel, hostport, method_name,
+                       lambda: tchannel.thrift(method(request), headers=headers, timeout=timeout, hostport=hostport),
+                       latency_observer)
 
-    start_time = time.time()
-    try:
-        stats_count(tchannel.name, '{}.calls'.format(method_name), hostport, 1)
 
-        result = tchannel.thrift(method(request), headers=headers, timeout=timeout, hostport=hostport).result().body
+def start_output_host_call(tchannel, headers, hostport, timeout, method_name, request, latency_observer=None):
+    method = getattr(cherami_output.BOut, method_name)
+    if not callable(method):
+        raise Exception("Not a valid callable method: " + method_name)
+    return _start_call(tchannel, hostport, method_name,
+                       lambda: tchannel.thrift(method(request), headers=headers, timeout=timeout, hostport=hostport),
+                       latency_observer)
 
-        stats_count(tchannel.name, '{}.success'.format(method_name), hostport, 1)
-        stats_timing(tchannel.name, '{}.duration.success'.format(method_name), start_time)
 
-        return result
+def _start_call(tchannel, hostport, method_name, call, latency_observer=None):
+    start_time = time.time()
+    stats_count(tchannel.name, '{}.calls'.format(method_name), hostport, 1)
+    try:
+        future = call()
     except Exception:
         stats_count(tchannel.name, '{}.exception'.format(method_name), hostport, 1)
         stats_timing(tchannel.name, '{}.duration.exception'.format(method_name), start_time)
         raise
+    return PendingCall(tchannel, hostport, method_name, future, start_time, latency_observer)
 
 
-def execute_output_host(tchannel, headers, hostport, timeout, method_name, request):
-    method = getattr(cherami_output.BOut, method_name)
-    if not callable(method):
-        raise Exception("Not a valid callable method: " + method_name)
+class PendingCall(object):
+    def __init__(self, tchannel, hostport, method_name, future, start_time, latency_observer=None):
+        self.tchannel = tchannel
+        self.hostport = hostport
+        self.method_name = method_name
+        self.future = future
+        self.start_time = start_time
+        self.latency_observer = latency_observer
 
-    start_time = time.time()
-    try:
-        stats_count(tchannel.name, '{}.calls'.format(method_name), hostport, 1)
+    def done(self):
+        return self.future.done()
 
-        result = tchannel.thrift(method(request), headers=headers, timeout=timeout, hostport=hostport).result().body
+    # wait for the call to complete, and return the response body or raise the call exception
+    def result(self):
+        try:
+            result = self.future.result().body
 
-        stats_count(tchannel.name, '{}.success'.format(method_name), hostport, 1)
-        stats_timing(tchannel.name, '{}.duration.success'.format(method_name), start_time)
+            stats_count(self.tchannel.name, '{}.success'.format(self.method_name), self.hostport, 1)
+            stats_timing(self.tchannel.name, '{}.duration.success'.format(self.method_name), self.start_time)
+            if self.latency_observer:
+                self.latency_observer(self.hostport, self.method_name, time.time() - self.start_time)
 
-        return result
-    except Exception:
-        stats_count(tchannel.name, '{}.exception'.format(method_name), hostport, 1)
-        stats_timing(tchannel.name, '{}.duration.exception'.format(method_name), start_time)
-        raise
+            return result
+        except Exception:
+            stats_count(self.tchannel.name, '{}.exception'.format(self.method_name), self.hostport, 1)
+            stats_timing(self.tchannel.name, '{}.duration.exception'.format(self.method_name), self.start_time)
+            if self.latency_observer:
+                self.latency_observer(self.hostport, self.method_name, time.time() - self.start_time, failed=True)
+            raise
+
+
+# wait until condition() is true or the deadline(a time.time() value) has passed. Returns whether condition() held
+def wait_until(condition, deadline, interval_seconds=0.05):
+    while not condition():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval_seconds, remaining))
+    return True
+
+
+# join a thread, waiting no longer than the deadline. Threads never started are skipped
+def join_thread(thread, deadline):
+    if thread.is_alive():
+        thread.join(max(0, deadline - time.time()))
 
 
 def get_connection_key(host):
@@ -127,6 +167,24 @@ def get_hostport_from_delivery_token(delivery_token):
     return delivery_token[1]
 
 
+# messages of STREAMING consumer groups have no ack id, their log sequence number takes its place
+def create_streaming_delivery_token(lsn, hostport, address):
+    return (lsn, hostport, address)
+
+
+def get_address_from_streaming_delivery_token(delivery_token):
+    return delivery_token[2]
+
+
+# the delivery token of a message reassembled from chunks is made of the delivery tokens of its chunks
+def create_chunked_delivery_token(delivery_tokens):
+    return tuple(delivery_tokens)
+
+
+def is_chunked_delivery_token(delivery_token):
+    return isinstance(delivery_token[0], tuple)
+
+
 def stats_count(client_name, stats_name, hostport, count):
     overall_stats = 'cherami_client_python.{}.{}'.format(client_name, stats_name)
     stats.count(overall_stats, count)
@@ -0,0 +1,81 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import
+
+from cherami_client.publisher import Publisher
+from cherami_client.log_publisher_thread import LogPublisherThread
+from cherami_client.scheduler import start_periodic_task
+
+
+# Publisher for LOG destinations. Messages are appended in the order they are published, each one chained
+# to the previous message with previousMessageId, and the acks carry the lsn and address of the messages.
+class LogPublisher(Publisher):
+
+    # batch_size: maximum number of messages sent in one putMessageBatch call
+    # pipeline_depth: maximum number of putMessageBatch calls in flight
+    # max_retries: how many times messages are resent after the chain broke before giving up on them
+    # previous_message_id: id of the last message in the log, if any
+    def __init__(self, batch_size=16, pipeline_depth=4, max_retries=3, previous_message_id=None, **kwargs):
+        Publisher.__init__(self, **kwargs)
+        self.log_thread = LogPublisherThread(path=self.path,
+                                             task_queue=self.task_queue,
+                                             tchannel=self.tchannel,
+                                             headers=self.headers,
+                                             timeout_seconds=self.timeout_seconds,
+                                             batch_size=batch_size,
+                                             pipeline_depth=pipeline_depth,
+                                             max_retries=max_retries,
+                                             previous_message_id=previous_message_id,
+                                             logger=self.logger)
+
+    # a single thread sends all messages in order, so only the inputhosts are kept track of
+    def _reconfigure(self):
+        self.logger.info('log publisher reconfiguration started')
+        result, host_connection_set = self._read_publisher_options()
+        self.log_thread.set_hosts(host_connection_set, result.checksumOption)
+        self.logger.info('log publisher reconfiguration succeeded')
+
+    def open(self):
+        try:
+            self._reconfigure()
+            self.log_thread.start()
+            self.reconfigure_thread = start_periodic_task(scheduler=self.scheduler,
+                                                          interval_seconds=self.reconfigure_interval_seconds,
+                                                          signal=self.reconfigure_signal,
+                                                          func=self._reconfigure,
+                                                          logger=self.logger)
+        except Exception as e:
+            self.logger.exception('Failed to open log publisher: %s', e)
+            self.close()
+            raise e
+
+    def _is_drained(self):
+        return self.task_queue.empty() and self.log_thread.is_idle()
+
+    def _stop_workers(self):
+        self.log_thread.stop()
+        self.task_queue.put(None)
+        return [self.log_thread]
+
+    # restart the chain of messages after the given message id, e.g. after acks failed
+    # because another publisher appended to the log
+    def resync(self, previous_message_id):
+        self.log_thread.resync(previous_message_id)
@@ -0,0 +1,246 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import
+
+import threading
+import traceback
+from collections import deque
+from six.moves.queue import Empty
+
+from cherami_client.lib import cherami, cherami_input, util
+from cherami_client.publisher_thread import expire_task
+
+
+# Sends the messages of a LOG destination in order. Each message is chained to the previous one with
+# previousMessageId, so the inputhost rejects any message that doesn't directly follow the last one appended.
+# Up to pipeline_depth batches are in flight at once. When a message is rejected, the messages after it are
+# rejected too, so they are all resent chained to the last acked message.
+class LogPublisherThread(threading.Thread):
+    def __init__(self,
+                 path,
+                 task_queue,
+                 tchannel,
+                 headers,
+                 timeout_seconds,
+                 batch_size,
+                 pipeline_depth,
+                 max_retries,
+                 previous_message_id,
+                 logger):
+        threading.Thread.__init__(self)
+        self.path = path
+        self.task_queue = task_queue
+        self.tchannel = tchannel
+        self.headers = headers
+        self.timeout_seconds = timeout_seconds
+        self.batch_size = batch_size
+        self.pipeline_depth = pipeline_depth
+        self.max_retries = max_retries
+        self.logger = logger
+        self.stop_signal = threading.Event()
+
+        self.hostports = []
+        self.host_index = 0
+        self.checksum_option = None
+        self.lock = threading.Lock()
+
+        # id of the last message acked by the inputhost, and of the last message sent
+        self.last_acked_id = previous_message_id
+        self.last_sent_id = previous_message_id
+        # (msg, callback, retries) waiting to be resent, in order
+        self.resend_queue = deque()
+        # (PendingCall, [(msg, callback, retries)]) in send order
+        self.inflight = deque()
+
+    def stop(self):
+        self.stop_signal.set()
+
+    # whether all the messages taken from the task queue were acked or given up
+    def is_idle(self):
+        return not self.inflight and not self.resend_queue
+
+    def set_hosts(self, hostports, checksum_option):
+        with self.lock:
+            self.hostports = sorted(hostports)
+            self.checksum_option = checksum_option
+
+    # restart the chain after the given message id, e.g. after another publisher appended to the log
+    def resync(self, previous_message_id):
+        with self.lock:
+            self.last_acked_id = previous_message_id
+            self.last_sent_id = previous_message_id
+
+    def _get_hostport(self):
+        with self.lock:
+            if not self.hostports:
+                return None
+            return self.hostports[self.host_index % len(self.hostports)]
+
+    # stick to one inputhost, and only move to the next one when calls fail
+    def _next_host(self):
+        with self.lock:
+            self.host_index += 1
+
+    def _take_batch(self, block):
+        batch = []
+        while self.resend_queue and len(batch) < self.batch_size:
+            batch.append(self.resend_queue.popleft())
+
+        while len(batch) < self.batch_size:
+            try:
+                task = self.task_queue.get(block=block and not batch, timeout=1)
+                self.task_queue.task_done()
+            except Empty:
+                break
+            if task is None:
+                # only wakes up the thread
+                break
+            msgs, callback, deadline = task
+            if expire_task(self.tchannel, msgs, callback, deadline):
+                continue
+            batch.extend((msg, callback, 0) for msg in msgs)
+        return batch
+
+    def _send(self, batch):
+        msgs = []
+        for msg, callback, retries in batch:
+            msg.previousMessageId = self.last_sent_id
+            self.last_sent_id = msg.id
+            if self.checksum_option == cherami.ChecksumOption.CRC32IEEE:
+                msg.crc32IEEEDataChecksum = util.calc_crc(msg.data, self.checksum_option)
+            elif self.checksum_option == cherami.ChecksumOption.MD5:
+                msg.md5DataChecksum = util.calc_crc(msg.data, self.checksum_option)
+            msgs.append(msg)
+
+        request = cherami_input.PutMessageBatchRequest(destinationPath=self.path, messages=msgs)
+        try:
+            call = util.start_input_host_call(tchannel=self.tchannel,
+                                              headers=self.headers,
+                                              hostport=self._get_hostport(),
+                                              timeout=self.timeout_seconds,
+                                              method_name='putMessageBatch',
+                                              request=request)
+        except Exception:
+            self._next_host()
+            self._resync(batch, None)
+            return
+        self.inflight.append((call, batch))
+
+    def _complete(self, call, batch):
+        try:
+            batch_result = call.result()
+            acks = {}
+            if batch_result and batch_result.successMessages:
+                for ack in batch_result.successMessages:
+                    acks[ack.id] = ack
+            if batch_result and batch_result.failedMessages:
+                for ack in batch_result.failedMessages:
+                    acks[ack.id] = ack
+        except Exception:
+            self.logger.info({
+                'msg': 'error appending to log destination',
+                'path': self.path,
+                'traceback': traceback.format_exc(),
+            })
+            self._next_host()
+            acks = {}
+
+        for i, (msg, callback, retries) in enumerate(batch):
+            ack = acks.get(msg.id)
+            if ack is None or ack.status != cherami.Status.OK:
+                self._resync(batch[i:], ack)
+                return
+            self.last_acked_id = msg.id
+            if callable(callback):
+                try:
+                    callback(ack)
+                except Exception:
+                    self.logger.info({
+                        'msg': 'error in log publisher callback',
+                        'traceback': traceback.format_exc(),
+                    })
+
+    # the chain is broken at the first message of failed: wait for the calls still in flight, which can't
+    # succeed either, and resend everything chained to the last acked message
+    def _resync(self, failed, failed_ack):
+        util.stats_count(self.tchannel.name, 'log_publisher.resync', None, 1)
+        pending = list(failed)
+        while self.inflight:
+            call, batch = self.inflight.popleft()
+            try:
+                call.result()
+            except Exception:
+                pass
+            pending.extend(batch)
+        pending.extend(self.resend_queue)
+        self.resend_queue.clear()
+        self.last_sent_id = self.last_acked_id
+
+        msg, callback, retries = pending[0]
+        if retries >= self.max_retries:
+            # most likely another publisher appended to the log. Give up on all pending messages, the
+            # application needs to resync with the log before appending again
+            reason = failed_ack.message if failed_ack and failed_ack.message else 'log append conflict'
+            for msg, callback, retries in pending:
+                if callable(callback):
+                    callback(util.create_failed_message_ack(msg.id, reason))
+            return
+
+        for msg, callback, retries in pending:
+            self.resend_queue.append((msg, callback, retries + 1))
+
+    def run(self):
+        while not self.stop_signal.is_set():
+            try:
+                if self._get_hostport() is None:
+                    self.stop_signal.wait(1)
+                    continue
+
+                while len(self.inflight) < self.pipeline_depth:
+                    batch = self._take_batch(block=not self.inflight)
+                    if not batch:
+                        break
+                    self._send(batch)
+
+                if self.inflight:
+                    call, batch = self.inflight.popleft()
+                    self._complete(call, batch)
+            except Exception:
+                self.logger.info({
+                    'msg': 'error in log publisher thread',
+                    'path': self.path,
+                    'traceback': traceback.format_exc(),
+                })
+
+        self._fail_pending()
+
+    # the thread was stopped before all messages were acked. Whether the messages in flight were appended
+    # is unknown, they time out. The ones waiting to be resent fail
+    def _fail_pending(self):
+        while self.inflight:
+            call, batch = self.inflight.popleft()
+            for msg, callback, retries in batch:
+                if callable(callback):
+                    callback(util.create_timeout_message_ack(msg.id))
+        while self.resend_queue:
+            msg, callback, retries = self.resend_queue.popleft()
+            if callable(callback):
+                callback(util.create_failed_message_ack(msg.id, 'publisher closed'))
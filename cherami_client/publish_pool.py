@@ -0,0 +1,98 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import threading
+import traceback
+from collections import deque
+from datetime import datetime
+
+from cherami_client.publisher_thread import put_message_batch
+from cherami_client.timeouts import get_latency_observer
+
+
+# Worker threads shared by the publishers of a client, instead of one thread per publisher and inputhost.
+# Publishers with queued messages take turns: a worker sends one batch of a publisher, then moves on to
+# the next publisher, so a busy destination doesn't hold up the others
+class PublishPool(object):
+    def __init__(self, thread_count, logger):
+        self.logger = logger
+        self.condition = threading.Condition()
+        # publishers with queued messages, in turn order. A publisher is in it at most once
+        self.ready = deque()
+        self.stop_signal = threading.Event()
+        self.threads = [PublishPoolThread(self) for i in range(thread_count)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stop_signal.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    # called by a publisher after queueing messages
+    def notify(self, publisher):
+        with self.condition:
+            if publisher not in self.ready:
+                self.ready.append(publisher)
+                self.condition.notify()
+
+    # wait for a publisher with queued messages. Returns None once stopped
+    def _next_publisher(self):
+        with self.condition:
+            while not self.ready:
+                if self.stop_signal.is_set():
+                    return None
+                self.condition.wait(1)
+            return self.ready.popleft()
+
+
+class PublishPoolThread(threading.Thread):
+    def __init__(self, pool):
+        threading.Thread.__init__(self)
+        self.pool = pool
+        self.thread_start_time = datetime.now()
+
+    def run(self):
+        while True:
+            publisher = self.pool._next_publisher()
+            if publisher is None:
+                return
+
+            task = publisher._take_pool_task()
+            # the publisher has its turn again after the others, also when the task taken expired
+            if not publisher.task_queue.empty():
+                self.pool.notify(publisher)
+            if task is None:
+                continue
+
+            msgs, callback, hostport, checksum_option, timeout_seconds = task
+            try:
+                put_message_batch(publisher.tchannel, publisher.path, hostport, publisher.headers,
+                                  timeout_seconds, checksum_option, msgs, callback,
+                                  self.thread_start_time, get_latency_observer(publisher.timeouts))
+            except Exception:
+                self.pool.logger.info({
+                    'msg': 'error in publish pool thread',
+                    'path': publisher.path,
+                    'traceback': traceback.format_exc(),
+                })
+            finally:
+                publisher._pool_task_done()
@@ -19,11 +19,15 @@
 # THE SOFTWARE.
 
 import threading
+import time
 
 from six.moves import queue
+from cherami_client import chunking, router
+from cherami_client.callback_executor import wrap_callback
 from cherami_client.lib import cherami, cherami_input, util
-from cherami_client.publisher_thread import PublisherThread
-from cherami_client.reconfigure_thread import ReconfigureThread
+from cherami_client.publisher_thread import PublisherThread, expire_task
+from cherami_client.scheduler import start_periodic_task
+from cherami_client.timeouts import get_call_timeout
 
 
 class Publisher(object):
@@ -35,7 +39,19 @@ class Publisher(object):
                  deployment_str,
                  headers,
                  timeout_seconds,
-                 reconfigure_interval_seconds):
+                 reconfigure_interval_seconds,
+                 codec=None,
+                 serializer_registry=None,
+                 chunk_size_bytes=None,
+                 scheduler=None,
+                 publish_pool=None,
+                 max_inflight_batches=1,
+                 routing=None,
+                 hedge_policy=None,
+                 callback_executor=None,
+                 local_zone=None,
+                 zone_resolver=None,
+                 timeouts=None):
         self.logger = logger
         self.path = path
         self.tchannel = tchannel
@@ -47,9 +63,40 @@ class Publisher(object):
         self.reconfigure_signal = threading.Event()
         self.reconfigure_interval_seconds = reconfigure_interval_seconds
         self.reconfigure_thread = None
+        self.codec = codec
+        self.serializer_registry = serializer_registry
+        self.chunk_size_bytes = chunk_size_bytes
+        self.destination_type = None
+        self.max_inflight_batches = max_inflight_batches
+        # with a routing policy, messages are queued per inputhost, see Router. Preferring the inputhosts of the
+        # local zone needs the router, by default routing to the host with the least outstanding messages
+        if local_zone and zone_resolver and not routing:
+            routing = router.LEAST_OUTSTANDING
+        # the publish pool threads pick the inputhost of each batch themselves
+        if publish_pool and (routing or hedge_policy):
+            raise ValueError('routing, hedging and local_zone are not supported with a publish pool')
+        self.router = None
+        if routing:
+            self.router = router.Router(tchannel.name, self.task_queue, routing, local_zone, zone_resolver)
+        # optional hedging.HedgePolicy, sending slow batches again to another inputhost
+        self.hedge_policy = hedge_policy
+        # optional callback_executor.CallbackExecutor running the application callbacks
+        self.callback_executor = callback_executor
+        # optional timeouts.AdaptiveTimeouts giving the putMessageBatch timeouts
+        self.timeouts = timeouts
 
-    def _reconfigure(self):
-        self.logger.info('publisher reconfiguration started')
+        # shared by the publishers of a client, see Client(shared_thread_pools=True)
+        self.scheduler = scheduler
+        self.publish_pool = publish_pool
+        # with a publish pool, the inputhosts the pool threads send to in turn
+        self.pool_hostports = []
+        self.pool_host_index = 0
+        self.pool_inflight = 0
+        self.pool_lock = threading.Lock()
+        self.checksum_option = None
+
+    # returns the publisher options and the set of inputhosts serving the destination
+    def _read_publisher_options(self):
         result = util.execute_frontend(
             self.tchannel, self.deployment_str, self.headers, self.timeout_seconds, 'readPublisherOptions',
             cherami.ReadPublisherOptionsRequest(
@@ -65,11 +112,28 @@ class Publisher(object):
         if not hostAddresses:
             raise Exception("tchannel protocol is not supported by cherami server")
 
-        host_connection_set = set(map(lambda h: util.get_connection_key(h), hostAddresses))
+        return result, set(map(lambda h: util.get_connection_key(h), hostAddresses))
+
+    def _reconfigure(self):
+        self.logger.info('publisher reconfiguration started')
+        result, host_connection_set = self._read_publisher_options()
+
+        if self.publish_pool:
+            with self.pool_lock:
+                self.pool_hostports = sorted(host_connection_set)
+                self.checksum_option = result.checksumOption
+            self.logger.info('publisher reconfiguration succeeded')
+            return
+
         existing_connection_set = set(self.workers.keys())
         missing_connection_set = host_connection_set - existing_connection_set
         extra_connection_set = existing_connection_set - host_connection_set
 
+        if self.router:
+            self.router.set_hosts(host_connection_set)
+        if self.hedge_policy:
+            self.hedge_policy.hostports = sorted(host_connection_set)
+
         # clean up
         for extra_conn in extra_connection_set:
             self.logger.info('cleaning up connection %s', extra_conn)
@@ -81,12 +145,15 @@ class Publisher(object):
             self.logger.info('creating new connection %s', missing_conn)
             worker = PublisherThread(
                 path=self.path,
-                task_queue=self.task_queue,
+                task_queue=self.router.view(missing_conn) if self.router else self.task_queue,
                 tchannel=self.tchannel,
                 hostport=missing_conn,
                 headers=self.headers,
                 timeout_seconds=self.timeout_seconds,
-                checksum_option=result.checksumOption
+                checksum_option=result.checksumOption,
+                max_inflight_batches=self.max_inflight_batches,
+                hedge_policy=self.hedge_policy,
+                timeouts=self.timeouts,
             )
             self.workers[missing_conn] = worker
             worker.start()
@@ -98,24 +165,66 @@ class Publisher(object):
     def open(self):
         try:
             self._reconfigure()
-            self.reconfigure_thread = ReconfigureThread(
-                interval_seconds=self.reconfigure_interval_seconds,
-                reconfigure_signal=self.reconfigure_signal,
-                reconfigure_func=self._reconfigure,
-                logger=self.logger,
-            )
-            self.reconfigure_thread.start()
+            self.reconfigure_thread = start_periodic_task(scheduler=self.scheduler,
+                                                          interval_seconds=self.reconfigure_interval_seconds,
+                                                          signal=self.reconfigure_signal,
+                                                          func=self._reconfigure,
+                                                          logger=self.logger)
         except Exception as e:
             self.logger.exception('Failed to open publisher: %s', e)
             self.close()
             raise e
 
-    # close the publisher
-    def close(self):
+    # close the publisher. Messages already published keep being sent until drain_timeout_seconds
+    # (by default the call timeout) have passed, then the worker threads are stopped and joined.
+    # Messages that couldn't be sent by then get a failed ack
+    def close(self, drain_timeout_seconds=None):
+        if drain_timeout_seconds is None:
+            drain_timeout_seconds = self.timeout_seconds
+        deadline = time.time() + drain_timeout_seconds
+
         if self.reconfigure_thread:
             self.reconfigure_thread.stop()
-        for worker in self.workers.itervalues():
+            util.join_thread(self.reconfigure_thread, deadline)
+
+        util.wait_until(self._is_drained, deadline)
+        for worker in self._stop_workers():
+            util.join_thread(worker, deadline)
+        self._fail_queued_messages('publisher closed')
+
+    def _is_drained(self):
+        return self.task_queue.empty() and self.pool_inflight == 0 and (not self.router or self.router.empty())
+
+    # stop the worker threads and return them
+    def _stop_workers(self):
+        workers = list(self.workers.values())
+        for worker in workers:
             worker.stop()
+            # wake up the worker waiting for a message
+            if self.router:
+                self.router.wake(worker.hostport)
+            else:
+                self.task_queue.put(None)
+        return workers
+
+    def _fail_queued_messages(self, reason):
+        if self.router:
+            for task in self.router.take_all():
+                self.task_queue.put(task)
+
+        while True:
+            try:
+                task = self.task_queue.get(block=False)
+                self.task_queue.task_done()
+            except queue.Empty:
+                return
+            if task is None:
+                continue
+
+            msgs, callback, deadline = task
+            if callable(callback):
+                for msg in msgs:
+                    callback(util.create_failed_message_ack(msg.id, reason))
 
     # publish a message. Returns an ack(type is cherami.PutMessageAck)
     # the Status field of the ack indicates whether the publish was successful or not
@@ -123,7 +232,10 @@ class Publisher(object):
     #     (cherami doesn't care about this field but just pass through)
     # data: message payload
     # user context: user specified context to pass through
-    def publish(self, id, data, userContext={}):
+    # schema_version: when set, data is encoded by the serializer registered for this version
+    # delay_seconds: delay before the message is delivered. Only TIMER destinations support it
+    # The message is given up if it can't be sent within the publisher timeout
+    def publish(self, id, data, userContext={}, schema_version=None, delay_seconds=0):
         done_signal = threading.Event()
         result = []
 
@@ -132,7 +244,7 @@ class Publisher(object):
             done_signal.set()
 
         # publish and later on wait
-        self.publish_async(id, data, done_callback, userContext)
+        self._publish_async(id, data, done_callback, userContext, schema_version, delay_seconds, None)
 
         done = done_signal.wait(self.timeout_seconds)
         if not done:
@@ -143,11 +255,166 @@ class Publisher(object):
 
     # asynchronously publish a message.
     # A callback function needs to be provided(it expects a cherami.PutMessageAck object as parameter)
-    def publish_async(self, id, data, callback, userContext={}):
-        msg = cherami_input.PutMessage(
+    # If the publisher has a codec, data is compressed and the codec is recorded in userContext
+    # If the publisher has a chunk size, larger messages are split into chunks sent in one batch,
+    # and the callback is called once when all chunks are acked
+    # timeout_seconds: deadline for sending the message, by default the publisher timeout. Messages still
+    # queued at the deadline aren't sent, their ack is TIMEDOUT
+    # The callback runs on the client callback executor if any. Its exceptions don't fail the message
+    def publish_async(self, id, data, callback, userContext={}, schema_version=None, delay_seconds=0,
+                      timeout_seconds=None):
+        callback = wrap_callback(self.logger, callback, self.callback_executor)
+        self._publish_async(id, data, callback, userContext, schema_version, delay_seconds, timeout_seconds)
+
+    def _publish_async(self, id, data, callback, userContext, schema_version, delay_seconds, timeout_seconds):
+        deadline = self._get_deadline(timeout_seconds)
+        msg = self._create_message(id, data, userContext, schema_version, delay_seconds)
+        if self._is_large(msg):
+            self._put_large_message(msg, callback, deadline)
+            return
+        self._enqueue([msg], callback, deadline)
+
+    # schedule delayed messages on a TIMER destination. Returns the acks in the order of the messages
+    # messages: iterable of (id, data, delay_seconds) or (id, data, delay_seconds, userContext) tuples
+    # batch_size: maximum number of messages sent in one putMessageBatch call
+    def schedule_many(self, messages, batch_size=100):
+        messages = list(messages)
+        if not messages:
+            return []
+        done_signal = threading.Event()
+        lock = threading.Lock()
+        acks = {}
+        count = [0]
+
+        def done_callback(ack):
+            with lock:
+                acks[ack.id] = ack
+                count[0] += 1
+                if count[0] == len(messages):
+                    done_signal.set()
+
+        self._schedule_many_async(messages, done_callback, batch_size, None)
+
+        done_signal.wait(self.timeout_seconds)
+        return [acks.get(m[0]) or util.create_timeout_message_ack(m[0]) for m in messages]
+
+    # asynchronously schedule delayed messages. The callback is called once per message with its ack
+    def schedule_many_async(self, messages, callback, batch_size=100, timeout_seconds=None):
+        callback = wrap_callback(self.logger, callback, self.callback_executor)
+        self._schedule_many_async(messages, callback, batch_size, timeout_seconds)
+
+    # all messages are created first, so an invalid one raises before any is queued
+    def _schedule_many_async(self, messages, callback, batch_size, timeout_seconds):
+        deadline = self._get_deadline(timeout_seconds)
+        msgs = []
+        for message in messages:
+            id, data, delay_seconds = message[:3]
+            user_context = message[3] if len(message) > 3 else {}
+            msgs.append(self._create_message(id, data, user_context, None, delay_seconds))
+
+        batch = []
+        for msg in msgs:
+            if self._is_large(msg):
+                self._put_large_message(msg, callback, deadline)
+                continue
+
+            batch.append(msg)
+            if len(batch) >= batch_size:
+                self._enqueue(batch, callback, deadline)
+                batch = []
+
+        if batch:
+            self._enqueue(batch, callback, deadline)
+
+    def _get_deadline(self, timeout_seconds):
+        return time.time() + (timeout_seconds or self.timeout_seconds)
+
+    def _create_message(self, id, data, userContext, schema_version, delay_seconds):
+        if delay_seconds:
+            self._check_delay(delay_seconds)
+
+        if schema_version:
+            if not self.serializer_registry:
+                raise Exception("Serializer registry is needed to publish with a schema version")
+            data = self.serializer_registry.encode(schema_version, data)
+
+        if self.codec:
+            data, userContext = self.codec.encode(data, userContext)
+
+        return cherami_input.PutMessage(
             id=id,
-            delayMessageInSeconds=0,
+            delayMessageInSeconds=delay_seconds,
             data=data,
-            userContext=userContext
+            userContext=userContext,
+            schemaVersion=schema_version,
         )
-        self.task_queue.put((msg, callback))
+
+    # only TIMER destinations support delayed messages. The destination type never changes,
+    # so it's read once
+    def _check_delay(self, delay_seconds):
+        if delay_seconds < 0:
+            raise Exception("Delay can't be negative: {0}".format(delay_seconds))
+
+        if self.destination_type is None:
+            destination = util.execute_frontend(
+                self.tchannel, self.deployment_str, self.headers, self.timeout_seconds, 'readDestination',
+                cherami.ReadDestinationRequest(
+                    path=self.path,
+                ))
+            self.destination_type = destination.type
+
+        if self.destination_type != cherami.DestinationType.TIMER:
+            raise Exception("Delayed messages are only supported by TIMER destinations: " + self.path)
+
+    def _is_large(self, msg):
+        return self.chunk_size_bytes and msg.data and len(msg.data) > self.chunk_size_bytes
+
+    def _put_large_message(self, msg, callback, deadline):
+        chunks = chunking.split(msg, self.chunk_size_bytes)
+        if callable(callback):
+            callback = chunking.ChunkAckAggregator(msg.id, len(chunks), callback)
+        self._enqueue(chunks, callback, deadline)
+
+    # queue messages sent in one batch, unless the deadline passes first
+    def _enqueue(self, msgs, callback, deadline):
+        if self.router:
+            self.router.put((msgs, callback, deadline))
+            return
+        self.task_queue.put((msgs, callback, deadline))
+        if self.publish_pool:
+            self.publish_pool.notify(self)
+
+    # called by the publish pool threads: take the next queued messages and pick the inputhost to send them to.
+    # Returns (msgs, callback, hostport, checksum_option, timeout_seconds), or None if there's nothing to send.
+    # The call doesn't outlast the deadline of the messages
+    def _take_pool_task(self):
+        try:
+            task = self.task_queue.get(block=False)
+            self.task_queue.task_done()
+        except queue.Empty:
+            return None
+        if task is None:
+            return None
+
+        msgs, callback, deadline = task
+        if expire_task(self.tchannel, msgs, callback, deadline):
+            return None
+        with self.pool_lock:
+            if not self.pool_hostports:
+                hostport = None
+            else:
+                hostport = self.pool_hostports[self.pool_host_index % len(self.pool_hostports)]
+                self.pool_host_index += 1
+                self.pool_inflight += 1
+
+        if hostport is None:
+            if callable(callback):
+                for msg in msgs:
+                    callback(util.create_failed_message_ack(msg.id, 'no inputhost to publish to'))
+            return None
+        timeout_seconds = get_call_timeout(self.timeouts, self.timeout_seconds, hostport, 'putMessageBatch', deadline)
+        return msgs, callback, hostport, self.checksum_option, timeout_seconds
+
+    def _pool_task_done(self):
+        with self.pool_lock:
+            self.pool_inflight -= 1
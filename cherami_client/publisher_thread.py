@@ -19,14 +19,105 @@
 # THE SOFTWARE.
 
 import threading
+import time
 import traceback
+from collections import deque
 from datetime import datetime
 from six.moves.queue import Empty
 
+from cherami_client.hedging import HedgedCallback
 from cherami_client.lib import cherami, cherami_input, util
+from cherami_client.timeouts import get_call_timeout, get_latency_observer
+
+
+# The messages of a task whose deadline passed aren't sent: the publisher doesn't wait for them any more,
+# and sending them would only delay the messages queued after them. Returns whether the task expired
+def expire_task(tchannel, msgs, callback, deadline):
+    if deadline is None or time.time() < deadline:
+        return False
+
+    util.stats_count(tchannel.name, 'publisher_task_queue.expired', None, len(msgs))
+    if callable(callback):
+        for msg in msgs:
+            callback(util.create_timeout_message_ack(msg.id))
+    return True
+
+
+# Start sending messages in one putMessageBatch call to the inputhost. Returns the util.PendingCall
+def start_put_message_batch(tchannel, path, hostport, headers, timeout_seconds, checksum_option, msgs,
+                            latency_observer=None):
+    for msg in msgs:
+        if checksum_option == cherami.ChecksumOption.CRC32IEEE:
+            msg.crc32IEEEDataChecksum = util.calc_crc(msg.data, checksum_option)
+        elif checksum_option == cherami.ChecksumOption.MD5:
+            msg.md5DataChecksum = util.calc_crc(msg.data, checksum_option)
+
+    request = cherami_input.PutMessageBatchRequest(
+       destinationPath=path,
+       messages=msgs)
+    return util.start_input_host_call(tchannel=tchannel,
+                                      headers=headers,
+                                      hostport=hostport,
+                                      timeout=timeout_seconds,
+                                      method_name='putMessageBatch',
+                                      request=request,
+                                      latency_observer=latency_observer)
+
+
+# Wait for a putMessageBatch call to complete, and call the callback once per message with its ack
+def complete_put_message_batch(call, msgs, callback, hostport, start_time):
+    try:
+        batch_result = call.result()
+    except Exception:
+        fail_put_message_batch(msgs, callback, hostport, start_time)
+        return
+
+    if not callable(callback):
+        return
+
+    acks = {}
+    if batch_result and batch_result.successMessages:
+        for ack in batch_result.successMessages:
+            acks[ack.id] = ack
+    if batch_result and batch_result.failedMessages:
+        for ack in batch_result.failedMessages:
+            acks[ack.id] = ack
+
+    for msg in msgs:
+        # fallback: somehow no result received
+        callback(acks.get(msg.id) or
+                 util.create_failed_message_ack(msg.id, 'sender gets no result from input'))
+
+
+def fail_put_message_batch(msgs, callback, hostport, start_time):
+    if msgs and callable(callback):
+        failure_msg = 'traceback:{0}, hostport:{1}, thread start time:{2}'\
+                        .format(traceback.format_exc(),
+                                hostport,
+                                str(start_time))
+        for msg in msgs:
+            callback(util.create_failed_message_ack(msg.id, failure_msg))
+
+
+# Send messages in one putMessageBatch call to the inputhost, and call the callback once per message with its ack
+def put_message_batch(tchannel, path, hostport, headers, timeout_seconds, checksum_option, msgs, callback, start_time,
+                      latency_observer=None):
+    try:
+        call = start_put_message_batch(tchannel, path, hostport, headers, timeout_seconds, checksum_option, msgs,
+                                       latency_observer)
+    except Exception:
+        fail_put_message_batch(msgs, callback, hostport, start_time)
+        return
+    complete_put_message_batch(call, msgs, callback, hostport, start_time)
 
 
 class PublisherThread(threading.Thread):
+    # how often calls in flight are checked for completion while waiting for messages to send
+    poll_interval_seconds = 0.005
+
+    # max_inflight_batches: how many putMessageBatch calls can be in flight to the inputhost
+    # hedge_policy: optional hedging.HedgePolicy, sending slow calls again to another inputhost
+    # timeouts: optional timeouts.AdaptiveTimeouts giving the call timeouts instead of timeout_seconds
     def __init__(self,
                  path,
                  task_queue,
@@ -34,7 +125,10 @@ class PublisherThread(threading.Thread):
                  hostport,
                  headers,
                  timeout_seconds,
-                 checksum_option):
+                 checksum_option,
+                 max_inflight_batches=1,
+                 hedge_policy=None,
+                 timeouts=None):
         threading.Thread.__init__(self)
         self.path = path
         self.task_queue = task_queue
@@ -43,53 +137,112 @@ class PublisherThread(threading.Thread):
         self.headers = headers
         self.timeout_seconds = timeout_seconds
         self.checksum_option = checksum_option
+        self.max_inflight_batches = max(1, max_inflight_batches)
+        self.hedge_policy = hedge_policy
+        self.timeouts = timeouts
         self.stop_signal = threading.Event()
         self.thread_start_time = datetime.now()
+        # (PendingCall, msgs, callback) in send order
+        self.inflight = deque()
 
     def stop(self):
         self.stop_signal.set()
 
+    # Each task is a tuple of (messages, callback, deadline). All messages of a task are sent in one
+    # putMessageBatch call and the callback is invoked once per message with its ack.
+    # Up to max_inflight_batches calls are in flight, their acks are delivered as they complete.
+    # Expired tasks are failed without being sent. None tasks only wake up the thread
+    # With a hedge policy, calls in flight for too long are sent again to another inputhost
     def run(self):
-        while not self.stop_signal.is_set():
+        while True:
+            self._complete_done_calls()
+            self._hedge_slow_calls()
+
+            if self.stop_signal.is_set():
+                if not self.inflight:
+                    return
+                # finish the calls in flight before exiting
+                self._complete(*self.inflight.popleft()[:3])
+                continue
+
+            if len(self.inflight) >= self.max_inflight_batches:
+                if self.max_inflight_batches == 1 and not self.hedge_policy:
+                    self._complete(*self.inflight.popleft()[:3])
+                else:
+                    # the window is full, wait for any call to complete
+                    self.stop_signal.wait(self.poll_interval_seconds)
+                continue
+
             try:
                 # remove from queue regardless
-                msg, callback = self.task_queue.get(block=True, timeout=5)
+                task = self.task_queue.get(block=True,
+                                           timeout=self.poll_interval_seconds if self.inflight else 5)
                 self.task_queue.task_done()
+            except Empty:
+                continue
+            if task is None:
+                continue
+
+            msgs, callback, deadline = task
+            if expire_task(self.tchannel, msgs, callback, deadline):
+                continue
+            if self.hedge_policy:
+                callback = HedgedCallback(msgs, callback)
+            # the call doesn't outlast the deadline of the messages
+            timeout_seconds = get_call_timeout(self.timeouts, self.timeout_seconds, self.hostport, 'putMessageBatch',
+                                               deadline)
+            try:
+                call = start_put_message_batch(self.tchannel, self.path, self.hostport, self.headers,
+                                               timeout_seconds, self.checksum_option, msgs,
+                                               get_latency_observer(self.timeouts))
+            except Exception:
+                fail_put_message_batch(msgs, callback, self.hostport, self.thread_start_time)
+                continue
+            self.inflight.append((call, msgs, callback, deadline))
 
-                if self.checksum_option == cherami.ChecksumOption.CRC32IEEE:
-                    msg.crc32IEEEDataChecksum = util.calc_crc(msg.data, self.checksum_option)
-                elif self.checksum_option == cherami.ChecksumOption.MD5:
-                    msg.md5DataChecksum = util.calc_crc(msg.data, self.checksum_option)
-
-                request = cherami_input.PutMessageBatchRequest(
-                   destinationPath=self.path,
-                   messages=[msg])
-                batch_result = util.execute_input_host(tchannel=self.tchannel,
-                                                       headers=self.headers,
-                                                       hostport=self.hostport,
-                                                       timeout=self.timeout_seconds,
-                                                       method_name='putMessageBatch',
-                                                       request=request)
-
-                if not callable(callback):
-                    continue
-                if batch_result and batch_result.successMessages and len(batch_result.successMessages) != 0:  # noqa
-                    callback(batch_result.successMessages[0])
-                    continue
-                if batch_result and batch_result.failedMessages and len(batch_result.failedMessages) != 0:  # noqa
-                    callback(batch_result.failedMessages[0])
-                    continue
-
-                # fallback: somehow no result received
-                callback(util.create_failed_message_ack(msg.id, 'sender gets no result from input'))
+    def _complete_done_calls(self):
+        if not any(item[0].done() for item in self.inflight):
+            return
 
-            except Empty:
-                pass
+        pending = deque()
+        while self.inflight:
+            item = self.inflight.popleft()
+            if item[0].done():
+                self._complete(*item[:3])
+            else:
+                pending.append(item)
+        self.inflight = pending
+
+    def _complete(self, call, msgs, callback):
+        if self.hedge_policy and call.done():
+            self.hedge_policy.record(time.time() - call.start_time)
+        complete_put_message_batch(call, msgs, callback, call.hostport, self.thread_start_time)
 
+    # the messages are sent with the same ids, the first OK ack wins. The hedge call doesn't outlast
+    # the deadline of the messages either
+    def _hedge_slow_calls(self):
+        if not self.hedge_policy or self.hedge_policy.get_delay() is None:
+            return
+
+        now = time.time()
+        slow_time = now - self.hedge_policy.get_delay()
+        for call, msgs, callback, deadline in list(self.inflight):
+            if callback.hedged or callback.start_time > slow_time:
+                continue
+            if deadline is not None and deadline <= now:
+                continue
+            hostport = self.hedge_policy.acquire(self.hostport)
+            if hostport is None:
+                return
+
+            callback.hedge()
+            util.stats_count(self.tchannel.name, 'putMessageBatch.hedged', hostport, len(msgs))
+            try:
+                hedge_call = start_put_message_batch(self.tchannel, self.path, hostport, self.headers,
+                                                     get_call_timeout(self.timeouts, self.timeout_seconds, hostport,
+                                                                      'putMessageBatch', deadline),
+                                                     self.checksum_option, msgs, get_latency_observer(self.timeouts))
             except Exception:
-                if msg and callable(callback):
-                    failure_msg = 'traceback:{0}, hostport:{1}, thread start time:{2}'\
-                                    .format(traceback.format_exc(),
-                                            self.hostport,
-                                            str(self.thread_start_time))
-                    callback(util.create_failed_message_ack(msg.id, failure_msg))
+                fail_put_message_batch(msgs, callback, hostport, self.thread_start_time)
+                continue
+            self.inflight.append((hedge_call, msgs, callback, deadline))
@@ -0,0 +1,262 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import random
+import threading
+import time
+
+from six.moves import queue
+
+from cherami_client.lib import cherami, util
+
+LEAST_OUTSTANDING = 'least_outstanding'
+POWER_OF_TWO_CHOICES = 'p2c'
+
+
+# Calls the callback of a routed task, and tells the router once all messages of the task have their ack
+class RoutedCallback(object):
+    def __init__(self, router, hostport, count, callback):
+        self.router = router
+        self.hostport = hostport
+        self.count = count
+        self.callback = callback
+        self.start_time = time.time()
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def __call__(self, ack):
+        with self.lock:
+            self.count -= 1
+            self.failed = self.failed or ack.status != cherami.Status.OK
+            done = self.count == 0
+        if done:
+            self.router.done(self.hostport, time.time() - self.start_time, self.failed)
+        if callable(self.callback):
+            self.callback(ack)
+
+
+# Queue interface of the router for the PublisherThread of one inputhost
+class RoutedQueue(object):
+    def __init__(self, router, hostport):
+        self.router = router
+        self.hostport = hostport
+
+    def get(self, block=True, timeout=None):
+        return self.router.get(self.hostport, timeout if block else 0)
+
+    def task_done(self):
+        pass
+
+
+# Routes publish tasks to per-inputhost queues. A task goes to the host with the least outstanding tasks
+# (queued or in flight), or with power of two choices, to the better of two random hosts by outstanding tasks
+# times average latency. A host with nothing to send takes tasks queued for the other hosts, so tasks don't
+# wait behind a slow host. Tasks queued before there's any host wait in the shared task queue.
+# Hosts whose last max_failures tasks failed only get tasks when all hosts are failing.
+# With a local zone and a function returning the zone of an inputhost, tasks go to the hosts of the local zone
+# while any of them has less than spill_outstanding tasks, and hosts of other zones only take tasks from queues
+# that long
+class Router(object):
+    # consecutive failed tasks after which a host is avoided
+    max_failures = 3
+
+    # how long an idle host waits for a task routed to it before looking for tasks of other hosts
+    steal_interval_seconds = 0.05
+    # weight of the last call in the average latency
+    latency_decay = 0.3
+
+    def __init__(self, client_name, task_queue, policy=LEAST_OUTSTANDING, local_zone=None, zone_resolver=None,
+                 spill_outstanding=4):
+        if policy not in (LEAST_OUTSTANDING, POWER_OF_TWO_CHOICES):
+            raise Exception("Unknown routing policy: {0}".format(policy))
+        self.client_name = client_name
+        self.task_queue = task_queue
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.host_queues = {}
+        self.outstanding = {}
+        self.latencies = {}
+        self.failures = {}
+        self.local_zone = local_zone
+        self.zone_resolver = zone_resolver
+        self.spill_outstanding = spill_outstanding
+        # hosts of the local zone, None without zones
+        self.local_hosts = set() if local_zone and zone_resolver else None
+
+    def view(self, hostport):
+        return RoutedQueue(self, hostport)
+
+    # tasks queued for removed hosts go back to the shared task queue
+    def set_hosts(self, hostports):
+        local_hosts = self._get_local_hosts(set(hostports) - set(self.host_queues.keys()))
+        orphans = []
+        with self.lock:
+            for hostport in set(self.host_queues.keys()) - set(hostports):
+                orphans.extend(self._take_all(self.host_queues.pop(hostport)))
+                del self.outstanding[hostport]
+                self.latencies.pop(hostport, None)
+                self.failures.pop(hostport, None)
+                if self.local_hosts is not None:
+                    self.local_hosts.discard(hostport)
+            for hostport in hostports:
+                if hostport not in self.host_queues:
+                    self.host_queues[hostport] = queue.Queue()
+                    self.outstanding[hostport] = 0
+                    self.failures[hostport] = 0
+            if self.local_hosts is not None:
+                self.local_hosts.update(local_hosts)
+        for task in orphans:
+            self.task_queue.put(task)
+
+    def put(self, task):
+        with self.lock:
+            hostport = self._pick()
+            if hostport is not None:
+                self.outstanding[hostport] += 1
+                self.host_queues[hostport].put(task)
+                return
+        self.task_queue.put(task)
+
+    # hosts whose zone can't be resolved are treated as remote
+    def _get_local_hosts(self, hostports):
+        if self.local_hosts is None:
+            return set()
+        local_hosts = set()
+        for hostport in hostports:
+            try:
+                if self.zone_resolver(hostport) == self.local_zone:
+                    local_hosts.add(hostport)
+            except Exception:
+                util.stats_count(self.client_name, 'publisher_router.zone_resolver.exception', hostport, 1)
+        return local_hosts
+
+    def _pick(self):
+        hostports = [h for h in self.host_queues.keys() if self.failures[h] < self.max_failures] or \
+            list(self.host_queues.keys())
+        if not hostports:
+            return None
+        if self.local_hosts is not None:
+            local_hosts = [h for h in hostports
+                           if h in self.local_hosts and self.outstanding[h] < self.spill_outstanding]
+            if local_hosts:
+                hostports = local_hosts
+            else:
+                util.stats_count(self.client_name, 'publisher_router.spilled', None, 1)
+        if self.policy == LEAST_OUTSTANDING:
+            random.shuffle(hostports)
+            return min(hostports, key=lambda h: self.outstanding[h])
+
+        candidates = random.sample(hostports, min(2, len(hostports)))
+        return min(candidates, key=lambda h: (self.outstanding[h] + 1) * self.latencies.get(h, 0))
+
+    # the next task for hostport: its own, then the unrouted ones, then the ones queued for the busiest host
+    def get(self, hostport, timeout):
+        host_queue = self.host_queues.get(hostport)
+        if host_queue is None:
+            raise queue.Empty
+
+        for source in (host_queue, self.task_queue):
+            try:
+                task = source.get(block=False)
+                source.task_done()
+                return self._assign(hostport, task, source is host_queue)
+            except queue.Empty:
+                pass
+
+        task = self._steal(hostport)
+        if task is not None:
+            return self._assign(hostport, task, True)
+
+        task = host_queue.get(block=True, timeout=min(timeout, self.steal_interval_seconds))
+        host_queue.task_done()
+        return self._assign(hostport, task, True)
+
+    def _steal(self, hostport):
+        with self.lock:
+            # hosts of other zones only take tasks from queues backed up to spill_outstanding
+            min_size = 1 if self.local_hosts is None or hostport in self.local_hosts else self.spill_outstanding
+            victims = [(q.qsize(), h) for h, q in self.host_queues.items() if h != hostport and q.qsize() >= min_size]
+            if not victims:
+                return None
+            victim = max(victims)[1]
+            try:
+                task = self.host_queues[victim].get(block=False)
+                self.host_queues[victim].task_done()
+            except queue.Empty:
+                return None
+            if task is None:
+                # wake up call of the victim, put it back
+                self.host_queues[victim].put(None)
+                return None
+            self.outstanding[victim] -= 1
+            self.outstanding[hostport] = self.outstanding.get(hostport, 0) + 1
+        util.stats_count(self.client_name, 'publisher_router.stolen', victim, 1)
+        return task
+
+    # the task is sent to hostport. routed tells whether it's already counted as outstanding on hostport
+    def _assign(self, hostport, task, routed):
+        if task is None:
+            return None
+        msgs, callback, deadline = task
+        with self.lock:
+            if not routed and hostport in self.outstanding:
+                self.outstanding[hostport] += 1
+        return msgs, RoutedCallback(self, hostport, len(msgs), callback), deadline
+
+    def done(self, hostport, latency_seconds, failed=False):
+        with self.lock:
+            if hostport not in self.outstanding:
+                return
+            self.outstanding[hostport] -= 1
+            self.failures[hostport] = self.failures[hostport] + 1 if failed else 0
+            previous = self.latencies.get(hostport)
+            self.latencies[hostport] = latency_seconds if previous is None else \
+                previous + self.latency_decay * (latency_seconds - previous)
+
+    # wake up the PublisherThread of hostport
+    def wake(self, hostport):
+        host_queue = self.host_queues.get(hostport)
+        if host_queue is not None:
+            host_queue.put(None)
+
+    def empty(self):
+        with self.lock:
+            return all(q.empty() for q in self.host_queues.values()) and \
+                all(count == 0 for count in self.outstanding.values())
+
+    # take out all the tasks queued for the hosts
+    def take_all(self):
+        with self.lock:
+            tasks = []
+            for hostport, host_queue in self.host_queues.items():
+                taken = self._take_all(host_queue)
+                self.outstanding[hostport] -= len(taken)
+                tasks.extend(taken)
+            return tasks
+
+    def _take_all(self, host_queue):
+        tasks = []
+        while True:
+            try:
+                task = host_queue.get(block=False)
+                host_queue.task_done()
+            except queue.Empty:
+                return tasks
+            if task is not None:
+                tasks.append(task)
@@ -0,0 +1,124 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+from cherami_client.reconfigure_thread import ReconfigureThread
+
+
+# A function run periodically by a Scheduler. It can be stopped and joined like a ReconfigureThread
+class ScheduledTask(object):
+    def __init__(self, interval_seconds, func):
+        self.interval_seconds = interval_seconds
+        self.func = func
+        self.stop_signal = threading.Event()
+        # cleared while the function runs
+        self.idle = threading.Event()
+        self.idle.set()
+
+    def stop(self):
+        self.stop_signal.set()
+
+    def is_alive(self):
+        return not self.stop_signal.is_set() or not self.idle.is_set()
+
+    # wait for the function to finish if it's running
+    def join(self, timeout=None):
+        self.idle.wait(timeout)
+
+
+# Runs the periodic tasks of all the publishers and consumers of a client on a single thread,
+# e.g. their reconfiguration, instead of one thread per task
+class Scheduler(threading.Thread):
+    def __init__(self, logger):
+        threading.Thread.__init__(self)
+        self.logger = logger
+        self.condition = threading.Condition()
+        # (next run time, sequence, task)
+        self.tasks = []
+        self.sequence = itertools.count()
+        self.stop_signal = threading.Event()
+
+    def stop(self):
+        self.stop_signal.set()
+        with self.condition:
+            self.condition.notify()
+
+    # run func every interval_seconds, the first time after interval_seconds
+    def schedule(self, interval_seconds, func):
+        task = ScheduledTask(interval_seconds, func)
+        self._push(task)
+        return task
+
+    def _push(self, task):
+        with self.condition:
+            heapq.heappush(self.tasks, (time.time() + task.interval_seconds, next(self.sequence), task))
+            self.condition.notify()
+
+    # wait for the next task due
+    def _pop(self):
+        with self.condition:
+            while not self.stop_signal.is_set():
+                while self.tasks and self.tasks[0][2].stop_signal.is_set():
+                    heapq.heappop(self.tasks)
+
+                now = time.time()
+                if self.tasks and self.tasks[0][0] <= now:
+                    task = heapq.heappop(self.tasks)[2]
+                    task.idle.clear()
+                    return task
+                self.condition.wait(self.tasks[0][0] - now if self.tasks else 1)
+            return None
+
+    def run(self):
+        while not self.stop_signal.is_set():
+            task = self._pop()
+            if task is None:
+                return
+
+            try:
+                task.func()
+            except Exception:
+                self.logger.info('scheduler thread {0}, exception {1}'
+                                 .format(threading.current_thread(), traceback.format_exc()))
+            finally:
+                task.idle.set()
+
+            if not task.stop_signal.is_set():
+                self._push(task)
+
+
+# run func every interval_seconds, on the scheduler if one is given, otherwise on a thread of its own
+# woken up by signal. Returns the task, which has stop(), is_alive() and join()
+def start_periodic_task(scheduler, interval_seconds, signal, func, logger):
+    if scheduler is not None:
+        return scheduler.schedule(interval_seconds, func)
+
+    thread = ReconfigureThread(
+        interval_seconds=interval_seconds,
+        reconfigure_signal=signal,
+        reconfigure_func=func,
+        logger=logger,
+    )
+    thread.start()
+    return thread
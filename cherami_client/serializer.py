@@ -0,0 +1,136 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import
+
+import json
+import threading
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonSerializer(object):
+    def __init__(self, **kwargs):
+        # build the encoder/decoder once instead of on every json.dumps/json.loads call
+        self.encoder = json.JSONEncoder(**kwargs)
+        self.decoder = json.JSONDecoder()
+
+    # payloads are always bytes: the encoder returns text on python 3 (and with ensure_ascii=False on python 2)
+    def encode(self, value):
+        data = self.encoder.encode(value)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return data
+
+    def decode(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return self.decoder.decode(data)
+
+
+class MsgpackSerializer(object):
+    def __init__(self):
+        if msgpack is None:
+            raise Exception('msgpack is not installed')
+        # msgpack packers keep internal buffers and are not thread safe, so one is cached per thread
+        self.local = threading.local()
+
+    def encode(self, value):
+        packer = getattr(self.local, 'packer', None)
+        if packer is None:
+            packer = self.local.packer = msgpack.Packer()
+        return packer.pack(value)
+
+    def decode(self, data):
+        return msgpack.unpackb(data)
+
+
+class ThriftSerializer(object):
+    # thrift_module: the module returned by thrift.load(), struct_class: the struct type of the payload
+    def __init__(self, thrift_module, struct_class):
+        self.dumps = thrift_module.dumps
+        self.loads = thrift_module.loads
+        self.struct_class = struct_class
+
+    def encode(self, value):
+        return self.dumps(value)
+
+    def decode(self, data):
+        return self.loads(self.struct_class, data)
+
+
+class SerializerRegistry(object):
+    def __init__(self):
+        self.encoders = {}
+        self.decoders = {}
+
+    # register a serializer for a schema version. A serializer is any object with encode(value) and decode(data)
+    # Schema version 0 means no schema is used, so it cannot be registered
+    def register(self, schema_version, serializer):
+        if not schema_version:
+            raise Exception('Schema version 0 means no schema, use a positive version')
+        self.encoders[schema_version] = serializer.encode
+        self.decoders[schema_version] = serializer.decode
+
+    def register_json(self, schema_version, **kwargs):
+        self.register(schema_version, JsonSerializer(**kwargs))
+
+    def register_msgpack(self, schema_version):
+        self.register(schema_version, MsgpackSerializer())
+
+    def register_thrift(self, schema_version, thrift_module, struct_class):
+        self.register(schema_version, ThriftSerializer(thrift_module, struct_class))
+
+    def encode(self, schema_version, value):
+        encoder = self.encoders.get(schema_version)
+        if encoder is None:
+            raise Exception('No serializer registered for schema version: {0}'.format(schema_version))
+        return encoder(value)
+
+    # messages published without a schema are returned as raw bytes
+    def decode(self, schema_version, data):
+        if not schema_version:
+            return data
+        decoder = self.decoders.get(schema_version)
+        if decoder is None:
+            raise Exception('No serializer registered for schema version: {0}'.format(schema_version))
+        return decoder(data)
+
+
+# A received message whose payload is only decoded when value is first accessed
+class DecodedMessage(object):
+
+    _not_decoded = object()
+
+    def __init__(self, delivery_token, message, registry):
+        self.delivery_token = delivery_token
+        self.message = message
+        self.registry = registry
+        self._value = self._not_decoded
+
+    @property
+    def value(self):
+        if self._value is self._not_decoded:
+            payload = self.message.payload
+            self._value = self.registry.decode(payload.schemaVersion, payload.data)
+        return self._value
@@ -0,0 +1,185 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import
+
+import threading
+from threading import Event
+
+from cherami_client.lib import cherami, util
+from cherami_client.consumer import Consumer
+from cherami_client.scheduler import start_periodic_task
+from cherami_client.ack_message_result import AckMessageResult
+
+
+# Tracks the messages delivered from one outputhost and the address up to which all of them were processed.
+# Messages carry no extent, and setConsumedMessages takes a single address per outputhost, so the lsns
+# delivered by an outputhost are assumed to be one gapless sequence. A missing lsn holds the watermark back
+# until it's delivered and processed: the checkpoint never moves past a message that wasn't processed
+class Watermark(object):
+    def __init__(self):
+        # lowest lsn that hasn't been processed yet
+        self.next_lsn = None
+        # lsn -> address of the messages processed out of order
+        self.processed_addresses = {}
+        self.address = None
+        self.checkpointed_address = None
+        self.lock = threading.Lock()
+
+    def delivered(self, lsn):
+        with self.lock:
+            if self.next_lsn is None:
+                self.next_lsn = lsn
+
+    def processed(self, lsn, address):
+        with self.lock:
+            if self.next_lsn is None or lsn < self.next_lsn:
+                return
+            self.processed_addresses[lsn] = address
+            while self.next_lsn in self.processed_addresses:
+                self.address = self.processed_addresses.pop(self.next_lsn)
+                self.next_lsn += 1
+
+    # returns the address to checkpoint, or None if it hasn't moved since the last checkpoint
+    def get_checkpoint(self):
+        with self.lock:
+            if self.address is None or self.address == self.checkpointed_address:
+                return None
+            return self.address
+
+    def checkpointed(self, address):
+        with self.lock:
+            self.checkpointed_address = address
+
+
+class StreamingConsumer(Consumer):
+    streaming = True
+
+    # start_address: messages with a lower address are skipped
+    # checkpoint_interval_seconds: how often the processed watermark is checkpointed with setConsumedMessages
+    def __init__(self, start_address=None, checkpoint_interval_seconds=5, **kwargs):
+        Consumer.__init__(self, **kwargs)
+        self.start_address = start_address
+        self.checkpoint_interval_seconds = checkpoint_interval_seconds
+        self.checkpoint_signal = Event()
+        self.checkpoint_thread = None
+        self.watermarks = {}
+        self.watermarks_lock = threading.Lock()
+
+    def _get_watermark(self, hostport):
+        with self.watermarks_lock:
+            if hostport not in self.watermarks:
+                self.watermarks[hostport] = Watermark()
+            return self.watermarks[hostport]
+
+    # streaming consumer groups checkpoint periodically instead of running ack threads
+    def _start_ack_threads(self):
+        self.checkpoint_thread = start_periodic_task(
+            self.scheduler, self.checkpoint_interval_seconds, self.checkpoint_signal, self.checkpoint, self.logger)
+
+    def set_ack_thread_count(self, ack_thread_count):
+        pass
+
+    def close(self, drain_timeout_seconds=None):
+        Consumer.close(self, drain_timeout_seconds)
+        if self.checkpoint_thread:
+            self.checkpoint_thread.stop()
+            self.checkpoint_thread.join(self.timeout_seconds)
+            try:
+                self.checkpoint()
+            except Exception as e:
+                self.logger.info({
+                    'msg': 'error checkpointing on close',
+                    'exception': str(e)
+                })
+
+    # Mark all messages processed so far as consumed, one setConsumedMessages call per outputhost
+    def checkpoint(self):
+        with self.watermarks_lock:
+            watermarks = list(self.watermarks.items())
+
+        for hostport, watermark in watermarks:
+            address = watermark.get_checkpoint()
+            if address is None:
+                continue
+            util.execute_output_host(tchannel=self.tchannel,
+                                     headers=self.headers,
+                                     hostport=hostport,
+                                     timeout=self.timeout_seconds,
+                                     method_name='setConsumedMessages',
+                                     request=cherami.SetConsumedMessagesRequest(
+                                         destinationPath=self.path,
+                                         consumerGroupName=self.consumer_group_name,
+                                         addressInclusive=address))
+            watermark.checkpointed(address)
+
+    # Receive messages in address order per outputhost. Ack a message once it's processed, the consumer group
+    # moves forward to the last address up to which every message was acked
+    def receive(self, num_msgs, stop_signal=None):
+        msgs = []
+        for delivery_token, msg in Consumer.receive(self, num_msgs, stop_signal):
+            tokens = delivery_token if util.is_chunked_delivery_token(delivery_token) else [delivery_token]
+            for token in tokens:
+                watermark = self._get_watermark(util.get_hostport_from_delivery_token(token))
+                watermark.delivered(util.get_ack_id_from_delivery_token(token))
+
+            if self.start_address is not None and msg.address is not None and msg.address < self.start_address:
+                self._mark_processed(delivery_token)
+                continue
+            msgs.append((delivery_token, msg))
+        return msgs
+
+    # True once every outputhost has no more backlog and all received messages were returned
+    def is_end_of_stream(self):
+        consumer_threads = list(self.consumer_threads.values())
+        return bool(consumer_threads) and self.msg_queue.empty() \
+            and all(t.caught_up.is_set() for t in consumer_threads)
+
+    def _mark_processed(self, delivery_token):
+        tokens = delivery_token if util.is_chunked_delivery_token(delivery_token) else [delivery_token]
+        for token in tokens:
+            watermark = self._get_watermark(util.get_hostport_from_delivery_token(token))
+            watermark.processed(util.get_ack_id_from_delivery_token(token),
+                                util.get_address_from_streaming_delivery_token(token))
+
+    # streams aren't redelivered: chunks of a message given up are skipped, so the checkpoint isn't held back
+    def _expire_chunks(self):
+        expired_tokens = Consumer._expire_chunks(self)
+        for delivery_token in expired_tokens:
+            self._mark_processed(delivery_token)
+        return expired_tokens
+
+    # acks are recorded right away, the deadline for queueing them isn't needed
+    def _respond_async(self, is_ack, delivery_token, callback, deadline=None):
+        if delivery_token is None or callback is None:
+            return
+
+        if not is_ack:
+            callback(AckMessageResult(call_success=False,
+                                      is_ack=is_ack,
+                                      delivery_token=delivery_token,
+                                      error_msg='nack is not supported by STREAMING consumer groups'))
+            return
+
+        self._mark_processed(delivery_token)
+        callback(AckMessageResult(call_success=True,
+                                  is_ack=is_ack,
+                                  delivery_token=delivery_token,
+                                  error_msg=None))
@@ -0,0 +1,90 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import threading
+import time
+from collections import deque
+
+# shortest timeout given to a call, however little time is left before the caller's deadline
+MIN_CALL_TIMEOUT_SECONDS = 0.01
+
+
+# Timeouts of the calls to inputhosts and outputhosts, per host and method, derived from their recent latencies:
+# multiplier times the percentile of the latencies, within min_timeout_seconds and max_timeout_seconds.
+# Until a host and method have enough latencies, their timeout is max_timeout_seconds.
+# Failed calls have no latency: after max_failures in a row, e.g. once the host got slower than its timeout,
+# the latencies are dropped and the timeout is back to max_timeout_seconds until it's learned again
+class AdaptiveTimeouts(object):
+    # latencies needed before the timeout adapts
+    min_samples = 20
+    # failed calls in a row after which the timeout is learned again
+    max_failures = 3
+
+    def __init__(self, min_timeout_seconds, max_timeout_seconds, percentile=99, multiplier=3, window_size=200):
+        self.min_timeout_seconds = min_timeout_seconds
+        self.max_timeout_seconds = max_timeout_seconds
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.window_size = window_size
+        # (hostport, method_name) -> [latencies, recorded count, timeout, failures in a row]
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    # the latency of a call. The latency of a failed call isn't used
+    def record(self, hostport, method_name, latency_seconds, failed=False):
+        with self.lock:
+            key = (hostport, method_name)
+            if key not in self.stats:
+                self.stats[key] = [deque(maxlen=self.window_size), 0, None, 0]
+            stats = self.stats[key]
+            if failed:
+                stats[3] += 1
+                if stats[3] >= self.max_failures and stats[2] is not None:
+                    self.stats[key] = [deque(maxlen=self.window_size), 0, None, 0]
+                return
+            stats[3] = 0
+            stats[0].append(latency_seconds)
+            stats[1] += 1
+            # the timeout is computed again every min_samples calls
+            if stats[1] % self.min_samples == 0:
+                latencies = sorted(stats[0])
+                index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.0))
+                stats[2] = min(self.max_timeout_seconds,
+                               max(self.min_timeout_seconds, latencies[index] * self.multiplier))
+
+    def get_timeout(self, hostport, method_name):
+        stats = self.stats.get((hostport, method_name))
+        if stats is None or stats[2] is None:
+            return self.max_timeout_seconds
+        return stats[2]
+
+
+# Timeout of a call: the adaptive timeout if any, cut to the time left before the deadline(a time.time() value)
+# of the caller, as waiting any longer is of no use to it
+def get_call_timeout(timeouts, timeout_seconds, hostport, method_name, deadline=None):
+    if timeouts:
+        timeout_seconds = timeouts.get_timeout(hostport, method_name)
+    if deadline is not None:
+        timeout_seconds = min(timeout_seconds, max(MIN_CALL_TIMEOUT_SECONDS, deadline - time.time()))
+    return timeout_seconds
+
+
+# function recording the latency of calls and their failures, None without adaptive timeouts
+def get_latency_observer(timeouts):
+    return timeouts.record if timeouts else None
@@ -0,0 +1,79 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import unittest
+import mock
+import threading
+import time
+
+from six.moves import queue
+
+from cherami_client.ack_thread import AckThread
+from cherami_client.lib import util
+
+
+class TestAckThread(unittest.TestCase):
+
+    def setUp(self):
+        self.ack_queue = queue.Queue()
+        self.mock_tchannel = mock.Mock()
+        self.mock_tchannel.thrift.return_value.result.return_value = mock.Mock(body=None)
+        self.results = []
+        self.done_signal = threading.Event()
+
+    def _callback(self, ack_result):
+        self.results.append(ack_result)
+        if len(self.results) == 4:
+            self.done_signal.set()
+
+    def test_coalesced_acks(self):
+        for is_ack, delivery_token in [(True, ('a', '0:0')), (False, ('b', '0:0')), (True, ('c', '1:1')),
+                                       (True, ('d', '0:0'))]:
+            self.ack_queue.put((is_ack, delivery_token, self._callback))
+
+        thread = AckThread(self.mock_tchannel, {}, mock.Mock(), self.ack_queue, timeout_seconds=1, max_batch_size=3)
+        thread.start()
+        self.assertTrue(self.done_signal.wait(5))
+        thread.stop()
+        self.ack_queue.put(None)
+        thread.join(5)
+
+        # one call per outputhost for the first three, then one for the last
+        requests = sorted((kwargs['hostport'], args[0].call_args.ackRequest.ackIds,
+                           args[0].call_args.ackRequest.nackIds)
+                          for args, kwargs in self.mock_tchannel.thrift.call_args_list)
+        self.assertEquals([('0:0', ['a'], ['b']), ('0:0', ['d'], []), ('1:1', ['c'], [])], requests)
+        self.assertTrue(all(r.call_success for r in self.results))
+        self.assertFalse(thread.is_alive())
+
+    def test_failed_batch(self):
+        self.mock_tchannel.thrift.return_value.result.side_effect = Exception('failed')
+        for ack_id in ['a', 'b']:
+            self.ack_queue.put((True, (ack_id, '0:0'), self.results.append))
+        self.ack_queue.put(None)
+
+        thread = AckThread(self.mock_tchannel, {}, mock.Mock(), self.ack_queue, timeout_seconds=1)
+        thread.start()
+        util.wait_until(lambda: len(self.results) == 2, time.time() + 5)
+        thread.stop()
+        self.ack_queue.put(None)
+        thread.join(5)
+
+        self.assertEquals(1, self.mock_tchannel.thrift.call_count)
+        self.assertEquals([(False, 'failed')] * 2, [(r.call_success, r.error_msg) for r in self.results])
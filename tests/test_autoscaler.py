@@ -0,0 +1,87 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import unittest
+import mock
+from clay import config
+
+from cherami_client import autoscaler
+
+
+class TestAutoscaler(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer = mock.Mock()
+        self.backlogs = []
+        self.handler_concurrency = []
+        self.autoscaler = autoscaler.ConsumerAutoscaler(
+            consumer=self.consumer,
+            backlog_func=lambda: self.backlogs.pop(0),
+            min_pre_fetch_count=10,
+            max_pre_fetch_count=50,
+            min_ack_thread_count=2,
+            max_ack_thread_count=6,
+            min_handler_concurrency=1,
+            max_handler_concurrency=5,
+            handler_concurrency_callback=self.handler_concurrency.append,
+            scale_up_backlog=1000,
+            scale_down_backlog=100,
+            scale_down_polls=2,
+            steps=4,
+            logger=config.get_logger('test'),
+        )
+
+    def _poll(self, *backlogs):
+        self.backlogs.extend(backlogs)
+        for i in range(len(backlogs)):
+            self.autoscaler.poll()
+
+    def test_scale_up_and_down(self):
+        self._poll(5000, 5000)
+        self.assertEquals(2, self.autoscaler.level)
+        self.consumer.set_pre_fetch_count.assert_called_with(30)
+        self.consumer.set_ack_thread_count.assert_called_with(4)
+        self.assertEquals([2, 3], self.handler_concurrency)
+
+        self._poll(5000, 5000, 5000)
+        self.assertEquals(4, self.autoscaler.level)
+        self.consumer.set_pre_fetch_count.assert_called_with(50)
+        self.assertEquals(4, self.consumer.set_pre_fetch_count.call_count)
+
+        # scaling down needs consecutive polls with a low backlog
+        self._poll(50, 500, 50)
+        self.assertEquals(4, self.autoscaler.level)
+        self._poll(50)
+        self.assertEquals(3, self.autoscaler.level)
+        self.consumer.set_pre_fetch_count.assert_called_with(40)
+
+    def test_hysteresis(self):
+        self._poll(1000)
+        self.assertEquals(1, self.autoscaler.level)
+
+        # a backlog between the thresholds keeps the level
+        self._poll(500, 200, 900, 500)
+        self.assertEquals(1, self.autoscaler.level)
+        self.assertEquals(1, self.consumer.set_pre_fetch_count.call_count)
+
+    def test_parse_queue_depth_info(self):
+        info = autoscaler.parse_queue_depth_info('{"BacklogAvailable": 12, "BacklogDLQ": 3}')
+        self.assertEquals(12, info[autoscaler.BACKLOG_AVAILABLE])
+        self.assertEquals({}, autoscaler.parse_queue_depth_info(''))
+        self.assertRaises(Exception, autoscaler.parse_queue_depth_info, '[1]')
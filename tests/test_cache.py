@@ -0,0 +1,47 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import unittest
+
+from cherami_client.lib.cache import TtlLruCache
+
+
+class TestCache(unittest.TestCase):
+
+    def test_cache_lru_eviction(self):
+        cache = TtlLruCache(max_size=2, ttl_seconds=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEquals(1, cache.get('a'))
+        cache.put('c', 3)
+
+        self.assertEquals(2, len(cache))
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEquals(3, cache.pop('c'))
+        self.assertIsNone(cache.pop('c'))
+
+    def test_cache_ttl(self):
+        cache = TtlLruCache(max_size=2, ttl_seconds=60)
+        cache.put('a', 1, ttl_seconds=0)
+        cache.put('b', None)
+        self.assertFalse('a' in cache)
+        self.assertEquals('default', cache.get('a', 'default'))
+        self.assertTrue('b' in cache)
@@ -0,0 +1,71 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import unittest
+import mock
+import threading
+
+from cherami_client.callback_executor import CallbackExecutor, wrap_callback
+from cherami_client.client import Client
+
+
+class TestCallbackExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = mock.Mock()
+
+    def test_wrap_callback_inline(self):
+        def callback(arg):
+            raise Exception('callback failed')
+
+        wrap_callback(self.logger, callback)('arg')
+        self.assertEquals('error in application callback', self.logger.info.call_args[0][0]['msg'])
+        self.assertIsNone(wrap_callback(self.logger, None))
+
+    def test_executor(self):
+        executor = CallbackExecutor(self.logger, thread_count=1, queue_size=10)
+        executor.start()
+
+        results = []
+        release = threading.Event()
+
+        def callback(arg):
+            release.wait(5)
+            results.append((arg, threading.current_thread()))
+            if arg == 0:
+                raise Exception('callback failed')
+
+        wrapped = wrap_callback(self.logger, callback, executor)
+        for i in range(3):
+            wrapped(i)
+        # the callbacks don't run on the calling thread
+        self.assertEquals([], results)
+
+        release.set()
+        executor.stop()
+        executor.threads[0].join(5)
+
+        # callbacks queued before stop still run, after an exception too
+        self.assertEquals([(i, executor.threads[0]) for i in range(3)], results)
+        self.assertFalse(executor.threads[0].is_alive())
+
+    def test_client_close_joins_executor(self):
+        client = Client(mock.Mock(), self.logger, callback_thread_count=2)
+        client.close()
+        self.assertFalse(any(thread.is_alive() for thread in client.callback_executor.threads))
@@ -0,0 +1,83 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import unittest
+
+from cherami_client import chunking
+from cherami_client.lib import cherami, util
+
+
+class TestChunking(unittest.TestCase):
+
+    def setUp(self):
+        self.test_msg = cherami.PutMessage(id='test_msg_id', data='0123456789', userContext={'k': 'v'})
+
+    def _deliver(self, chunks):
+        return [(util.create_delivery_token('ack{0}'.format(i), '0:0'),
+                 cherami.ConsumerMessage(ackId='ack{0}'.format(i), payload=chunk))
+                for i, chunk in enumerate(chunks)]
+
+    def test_split_small_message(self):
+        self.assertEquals([self.test_msg], chunking.split(self.test_msg, 10))
+
+    def test_split_and_reassemble(self):
+        chunks = chunking.split(self.test_msg, 4)
+        self.assertEquals(3, len(chunks))
+        self.assertEquals(['0123', '4567', '89'], [c.data for c in chunks])
+        self.assertEquals(3, len(set(c.id for c in chunks)))
+
+        reassembler = chunking.ChunkReassembler(timeout_seconds=60, max_bytes=1024)
+        delivered = self._deliver(chunks)
+        self.assertIsNone(reassembler.add(*delivered[2]))
+        self.assertIsNone(reassembler.add(*delivered[0]))
+        delivery_token, msg = reassembler.add(*delivered[1])
+
+        self.assertTrue(util.is_chunked_delivery_token(delivery_token))
+        self.assertEquals([d[0] for d in delivered], list(delivery_token))
+        self.assertEquals('test_msg_id', msg.payload.id)
+        self.assertEquals('0123456789', msg.payload.data)
+        self.assertEquals({'k': 'v'}, msg.payload.userContext)
+        self.assertEquals(0, reassembler.buffered_bytes)
+
+    def test_reassembler_expire(self):
+        delivered = self._deliver(chunking.split(self.test_msg, 4))
+
+        reassembler = chunking.ChunkReassembler(timeout_seconds=60, max_bytes=1024)
+        reassembler.add(*delivered[0])
+        self.assertEquals([], reassembler.expire())
+
+        reassembler.timeout_seconds = 0
+        self.assertEquals([delivered[0][0]], reassembler.expire())
+        self.assertEquals(0, reassembler.buffered_bytes)
+
+        reassembler = chunking.ChunkReassembler(timeout_seconds=60, max_bytes=6)
+        reassembler.add(*delivered[0])
+        reassembler.add(*delivered[1])
+        self.assertEquals(2, len(reassembler.expire()))
+
+    def test_ack_aggregator(self):
+        acks = []
+        aggregator = chunking.ChunkAckAggregator('test_msg_id', 2, acks.append)
+        aggregator(cherami.PutMessageAck(id='test_msg_id#0', status=cherami.Status.OK))
+        self.assertEquals(0, len(acks))
+        aggregator(cherami.PutMessageAck(id='test_msg_id#1', status=cherami.Status.FAILED, message='err'))
+        self.assertEquals(1, len(acks))
+        self.assertEquals('test_msg_id', acks[0].id)
+        self.assertEquals(cherami.Status.FAILED, acks[0].status)
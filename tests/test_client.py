@@ -0,0 +1,169 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import unittest
+import mock
+from clay import config
+
+from cherami_client.lib import cherami
+from cherami_client.client import Client
+
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        self.test_path = '/test/path'
+        self.logger = config.get_logger('test')
+        self.destination = mock.Mock(body=cherami.DestinationDescription(path=self.test_path))
+
+        self.mock_call = mock.Mock()
+        self.mock_tchannel = mock.Mock()
+        self.mock_tchannel.thrift.return_value = self.mock_call
+
+    def _calls(self, endpoint):
+        return len([args for args, kwargs in self.mock_tchannel.thrift.call_args_list
+                    if args[0].endpoint == endpoint])
+
+    def test_metadata_cache_disabled(self):
+        self.mock_call.result.return_value = self.destination
+        client = Client(self.mock_tchannel, self.logger)
+
+        client.read_destination(cherami.ReadDestinationRequest(path=self.test_path))
+        client.read_destination(cherami.ReadDestinationRequest(path=self.test_path))
+        self.assertEquals(2, self._calls('BFrontend::readDestination'))
+
+    def test_metadata_cache(self):
+        self.mock_call.result.return_value = self.destination
+        client = Client(self.mock_tchannel, self.logger, metadata_cache_ttl_seconds=60)
+
+        for i in range(3):
+            result = client.read_destination(cherami.ReadDestinationRequest(path=self.test_path))
+            self.assertEquals(self.test_path, result.path)
+        self.assertEquals(1, self._calls('BFrontend::readDestination'))
+
+        client.update_destination(cherami.UpdateDestinationRequest(path=self.test_path))
+        client.read_destination(cherami.ReadDestinationRequest(path=self.test_path))
+        self.assertEquals(2, self._calls('BFrontend::readDestination'))
+
+    def test_metadata_cache_negative(self):
+        self.mock_call.result.side_effect = cherami.EntityNotExistsError(message='not found')
+        client = Client(self.mock_tchannel, self.logger, metadata_cache_ttl_seconds=60)
+
+        for i in range(2):
+            self.assertRaises(cherami.EntityNotExistsError, client.read_consumer_group,
+                              cherami.ReadConsumerGroupRequest(destinationPath=self.test_path,
+                                                               consumerGroupName='cg'))
+        self.assertEquals(1, self._calls('BFrontend::readConsumerGroup'))
+
+        self.mock_call.result.side_effect = None
+        self.mock_call.result.return_value = mock.Mock(body=cherami.ConsumerGroupDescription())
+        client.create_consumer_group(cherami.CreateConsumerGroupRequest(destinationPath=self.test_path,
+                                                                        consumerGroupName='cg'))
+        client.read_consumer_group(cherami.ReadConsumerGroupRequest(destinationPath=self.test_path,
+                                                                    consumerGroupName='cg'))
+        self.assertEquals(2, self._calls('BFrontend::readConsumerGroup'))
+
+    def test_iter_destinations(self):
+        pages = {
+            None: cherami.ListDestinationsResult(
+                destinations=[cherami.DestinationDescription(path='/a'), cherami.DestinationDescription(path='/b')],
+                nextPageToken='1'),
+            '1': cherami.ListDestinationsResult(
+                destinations=[cherami.DestinationDescription(path='/c')]),
+        }
+
+        def thrift(request, **kwargs):
+            page = pages[request.call_args.listRequest.pageToken]
+            return mock.Mock(result=mock.Mock(return_value=mock.Mock(body=page)))
+
+        self.mock_tchannel.thrift.side_effect = thrift
+        client = Client(self.mock_tchannel, self.logger)
+
+        destinations = client.iter_destinations(prefix='/', page_size=2)
+        self.assertEquals('/a', next(destinations).path)
+        # the next page is already requested
+        self.assertEquals(2, self._calls('BFrontend::listDestinations'))
+        self.assertEquals(['/b', '/c'], [d.path for d in destinations])
+        self.assertEquals(2, self.mock_tchannel.thrift.call_args[0][0].call_args.listRequest.limit)
+
+    def test_iter_consumer_groups_empty_page(self):
+        pages = {
+            None: cherami.ListConsumerGroupResult(nextPageToken='1'),
+            '1': cherami.ListConsumerGroupResult(
+                consumerGroups=[cherami.ConsumerGroupDescription(consumerGroupName='cg')], nextPageToken='2'),
+            '2': cherami.ListConsumerGroupResult(),
+        }
+
+        def thrift(request, **kwargs):
+            page = pages[request.call_args.listRequest.pageToken]
+            return mock.Mock(result=mock.Mock(return_value=mock.Mock(body=page)))
+
+        self.mock_tchannel.thrift.side_effect = thrift
+        client = Client(self.mock_tchannel, self.logger)
+
+        # an empty page with a next page token doesn't end the listing
+        self.assertEquals(['cg'], [cg.consumerGroupName for cg in client.iter_consumer_groups(self.test_path)])
+        self.assertEquals(3, self._calls('BFrontend::listConsumerGroups'))
+
+    def test_bulk_create_destinations(self):
+        counts = {'inflight': 0, 'max_inflight': 0}
+
+        def get_result():
+            counts['inflight'] -= 1
+            return mock.Mock(body=cherami.DestinationDescription())
+
+        def thrift(request, **kwargs):
+            counts['inflight'] += 1
+            counts['max_inflight'] = max(counts['max_inflight'], counts['inflight'])
+            if request.call_args.createRequest.path == '/bad':
+                counts['inflight'] -= 1
+                raise Exception('bad path')
+            return mock.Mock(result=get_result)
+
+        self.mock_tchannel.thrift.side_effect = thrift
+        client = Client(self.mock_tchannel, self.logger)
+
+        paths = ['/a', '/b', '/bad', '/c', '/d']
+        results = list(client.bulk_create_destinations(
+            (cherami.CreateDestinationRequest(path=path) for path in paths), max_concurrency=2))
+
+        self.assertEquals(paths, [request.path for request, result, error in results])
+        self.assertEquals(2, counts['max_inflight'])
+        for request, result, error in results:
+            if request.path == '/bad':
+                self.assertIsNone(result)
+                self.assertEquals('bad path', str(error))
+            else:
+                self.assertIsNotNone(result)
+                self.assertIsNone(error)
+
+    def test_bulk_merge_DLQ_rate_limit(self):
+        self.mock_call.result.return_value = mock.Mock(body=None)
+        client = Client(self.mock_tchannel, self.logger)
+
+        with mock.patch('cherami_client.client.time.sleep') as mock_sleep:
+            results = list(client.bulk_merge_DLQ_for_consumer_groups(
+                [cherami.MergeDLQForConsumerGroupRequest(destinationPath=self.test_path, consumerGroupName=str(i))
+                 for i in range(3)],
+                max_calls_per_second=10))
+
+        self.assertEquals(3, len(results))
+        self.assertEquals(3, self._calls('BFrontend::mergeDLQForConsumerGroup'))
+        self.assertEquals(2, mock_sleep.call_count)
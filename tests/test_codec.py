@@ -0,0 +1,61 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import unittest
+import zlib
+
+from cherami_client import codec
+
+
+class TestCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.test_data = '{"event": "trip_completed", "city": "sf"}' * 100
+        self.test_context = {'mycontextkey': 'mycontextvalue'}
+
+    def test_codec_roundtrip(self):
+        for name in codec.available_codecs():
+            payload_codec = codec.PayloadCodec(name=name)
+            data, context = payload_codec.encode(self.test_data, self.test_context)
+            self.assertTrue(len(data) < len(self.test_data))
+            self.assertEquals(name, context[codec.CODEC_CONTEXT_KEY])
+            self.assertFalse(codec.CODEC_CONTEXT_KEY in self.test_context)
+
+            decoded, decoded_context = codec.PayloadCodec().decode(data, context)
+            self.assertEquals(self.test_data, decoded)
+            self.assertEquals(self.test_context, decoded_context)
+
+    def test_codec_below_threshold(self):
+        payload_codec = codec.PayloadCodec(name=codec.ZLIB, threshold_bytes=len(self.test_data) + 1)
+        data, context = payload_codec.encode(self.test_data, self.test_context)
+        self.assertEquals(self.test_data, data)
+        self.assertEquals(self.test_context, context)
+
+    def test_codec_incompressible(self):
+        payload_codec = codec.PayloadCodec(name=codec.ZLIB, threshold_bytes=0)
+        data = zlib.compress(self.test_data)
+        encoded, context = payload_codec.encode(data, None)
+        self.assertEquals(data, encoded)
+        self.assertIsNone(context)
+
+    def test_codec_unknown_dictionary(self):
+        data, context = codec.PayloadCodec(name=codec.ZLIB).encode(self.test_data, {})
+        context[codec.CODEC_DICTIONARY_CONTEXT_KEY] = 'unknown'
+        self.assertRaises(Exception, codec.PayloadCodec().decode, data, context)
@@ -20,10 +20,13 @@
 
 import unittest
 import mock
+import threading
+import time
 from clay import config
 
-from cherami_client.lib import cherami, cherami_output
+from cherami_client.lib import cherami, cherami_output, util
 from cherami_client.client import Client
+from cherami_client import chunking, codec
 
 
 class TestConsumer(unittest.TestCase):
@@ -78,7 +81,9 @@ class TestConsumer(unittest.TestCase):
         self.assertEquals(self.test_cg, args[0].call_args.getHostsRequest.consumerGroupName)
         self.assertEquals(10, len(consumer.consumer_threads))
         self.assertEquals(consumer.ack_threads_count, len(consumer.ack_threads))
-        self.assertTrue(consumer.reconfigure_thread.is_alive())
+        # close joins the threads
+        self.assertFalse(consumer.reconfigure_thread.is_alive())
+        self.assertFalse(any(ack_thread.is_alive() for ack_thread in consumer.ack_threads))
 
     def test_consumer_consume(self):
         self.mock_call.result.return_value = self.output_hosts
@@ -93,7 +98,9 @@ class TestConsumer(unittest.TestCase):
         msgs = consumer.receive(1)
         consumer.close()
 
-        args, kwargs = self.mock_tchannel.thrift.call_args
+        # close nacks the messages buffered after the first one
+        args = [args for args, kwargs in self.mock_tchannel.thrift.call_args_list
+                if args[0].endpoint != 'BOut::ackMessages'][-1]
         self.assertEquals('BOut::receiveMessageBatch', args[0].endpoint)
         self.assertEquals(self.test_path, args[0].call_args.request.destinationPath)
         self.assertEquals(self.test_cg, args[0].call_args.request.consumerGroupName)
@@ -185,3 +192,365 @@ class TestConsumer(unittest.TestCase):
         self.assertEquals(1, len(args[0].call_args.ackRequest.ackIds))
         self.assertEquals(self.test_delivery_token[0], args[0].call_args.ackRequest.ackIds[0])
         self.assertFalse(res)
+
+    def test_consumer_ack_callback_exception(self):
+        self.mock_call.result.return_value = self.output_hosts
+
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1, callback_thread_count=1)
+        consumer = client.create_consumer(self.test_path, self.test_cg)
+        consumer._do_not_start_consumer_thread()
+        consumer.open()
+
+        results = []
+        done_signal = threading.Event()
+
+        def callback(ack_result):
+            results.append((ack_result.call_success, threading.current_thread()))
+            done_signal.set()
+            raise Exception('callback failed')
+
+        self.mock_call.result.return_value = self.ack_ok_response
+        consumer.ack_async(self.test_delivery_token, callback)
+        self.assertTrue(done_signal.wait(5))
+        consumer.close()
+        client.close()
+
+        # the callback runs on the callback thread, and its exception isn't an ack failure
+        self.assertEquals([(True, client.callback_executor.threads[0])], results)
+
+    def test_consumer_ack_many(self):
+        self.mock_call.result.return_value = self.output_hosts
+
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1)
+        consumer = client.create_consumer(self.test_path, self.test_cg)
+        consumer._do_not_start_consumer_thread()
+        consumer.open()
+
+        self.mock_call.result.return_value = self.ack_ok_response
+        delivery_tokens = [(str(i), '{0}:{0}'.format(i % 2)) for i in range(10)] + [None]
+        results = consumer.ack_many(delivery_tokens)
+        self.assertEquals([True] * 10 + [False], results)
+        ack_ids = [ack_id for args, kwargs in self.mock_tchannel.thrift.call_args_list
+                   if args[0].endpoint == 'BOut::ackMessages' for ack_id in args[0].call_args.ackRequest.ackIds]
+        self.assertEquals([str(i) for i in range(10)], sorted(ack_ids, key=int))
+
+        self.mock_call.result.side_effect = Exception(self.test_err_msg)
+        self.assertEquals([False, False], consumer.nack_many(delivery_tokens[:2]))
+        self.assertEquals([True], consumer.nack_many(delivery_tokens[:1], delay_seconds=60))
+        self.assertEquals(1, consumer.get_delayed_nack_count())
+        consumer.close()
+
+    def test_consumer_ack_many_full_queue(self):
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=0.2)
+        consumer = client.create_consumer(self.test_path, self.test_cg, ack_message_buffer_size=1)
+
+        # nothing takes the acks off the queue: the batch waits for the call timeout once, not per ack
+        start_time = time.time()
+        results = consumer.ack_many([(str(i), '0:0') for i in range(5)])
+        self.assertLess(time.time() - start_time, 0.5)
+        self.assertEquals([False] * 5, results)
+
+    def test_consumer_nack_backoff(self):
+        self.mock_call.result.return_value = self.output_hosts
+
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1)
+        consumer = client.create_consumer(self.test_path, self.test_cg, nack_backoff_seconds=10,
+                                          nack_backoff_max_seconds=30)
+        consumer._do_not_start_consumer_thread()
+        consumer.open()
+
+        # each nack of the message doubles its delay
+        delays = []
+        for i in range(4):
+            consumer.nack_pending_keys.put(self.test_delivery_token, 'id')
+            delays.append(consumer._get_nack_delay(self.test_delivery_token, None))
+        self.assertEquals([10, 20, 30, 30], delays)
+
+        # an ack resets it
+        consumer.nack_pending_keys.put(self.test_delivery_token, 'id')
+        self.mock_call.result.return_value = self.ack_ok_response
+        consumer.ack(self.test_delivery_token)
+        consumer.nack_pending_keys.put(self.test_delivery_token, 'id')
+        self.assertEquals(10, consumer._get_nack_delay(self.test_delivery_token, None))
+
+        # the nack is held, then sent when the consumer closes. The thread holding it starts with the first one
+        self.assertIsNone(consumer.delayed_nack_thread)
+        consumer.nack_pending_keys.put(self.test_delivery_token, 'id')
+        consumer.nack_pending_keys.put(('other_ack_id', '0:0'), 'other_id')
+        self.assertTrue(consumer.nack(self.test_delivery_token))
+        self.assertTrue(consumer.nack(('other_ack_id', '0:0')))
+        self.assertEquals(2, consumer.get_delayed_nack_count())
+        consumer.close()
+
+        args, kwargs = self.mock_tchannel.thrift.call_args
+        self.assertEquals('BOut::ackMessages', args[0].endpoint)
+        # in due order: the other message was nacked once, this one twice
+        self.assertEquals(['other_ack_id', self.test_ack_id], args[0].call_args.ackRequest.nackIds)
+        self.assertEquals(0, consumer.get_delayed_nack_count())
+
+    def test_consumer_receive_compressed(self):
+        self.mock_call.result.return_value = self.output_hosts
+
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1)
+        consumer = client.create_consumer(self.test_path, self.test_cg)
+        consumer._do_not_start_consumer_thread()
+        consumer.open()
+
+        data, context = codec.PayloadCodec(name=codec.ZLIB, threshold_bytes=0).encode('msg' * 100, {'k': 'v'})
+        self.mock_call.result.return_value = mock.Mock(body=cherami_output.ReceiveMessageBatchResult(
+            messages=[cherami_output.ConsumerMessage(
+                ackId=self.test_ack_id,
+                payload=cherami_output.PutMessage(
+                    data=data,
+                    userContext=context,
+                    crc32IEEEDataChecksum=util.calc_crc(data, cherami.ChecksumOption.CRC32IEEE))
+            )]
+        ))
+        consumer.consumer_threads['0:0'].start()
+        msgs = consumer.receive(1)
+        consumer.close()
+
+        self.assertEquals(1, len(msgs))
+        self.assertEquals('msg' * 100, msgs[0][1].payload.data)
+        self.assertEquals({'k': 'v'}, msgs[0][1].payload.userContext)
+        self.assertTrue(consumer.verify_checksum(msgs[0][1]))
+
+    def test_consumer_receive_chunked(self):
+        self.mock_call.result.return_value = self.output_hosts
+
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1)
+        consumer = client.create_consumer(self.test_path, self.test_cg, reassemble_chunks=True)
+        consumer._do_not_start_consumer_thread()
+        consumer.open()
+
+        chunks = chunking.split(cherami_output.PutMessage(id='id', data='msg' * 10), 8)
+        self.mock_call.result.return_value = mock.Mock(body=cherami_output.ReceiveMessageBatchResult(
+            messages=[cherami_output.ConsumerMessage(ackId='ack{0}'.format(i), payload=chunk)
+                      for i, chunk in enumerate(chunks)]
+        ))
+        consumer.consumer_threads['0:0'].start()
+        msgs = consumer.receive(1)
+        consumer.consumer_threads['0:0'].stop()
+        consumer.consumer_threads['0:0'].join()
+
+        self.mock_call.result.return_value = self.ack_ok_response
+        res = consumer.ack(msgs[0][0])
+        consumer.close()
+
+        self.assertEquals(1, len(msgs))
+        self.assertEquals('msg' * 10, msgs[0][1].payload.data)
+        self.assertTrue(res)
+        acked_ids = [ack_id for args, kwargs in self.mock_tchannel.thrift.call_args_list
+                     if args[0].endpoint == 'BOut::ackMessages'
+                     for ack_id in args[0].call_args.ackRequest.ackIds]
+        self.assertEquals(set('ack{0}'.format(i) for i in range(len(chunks))), set(acked_ids))
+
+    def test_consumer_chunks(self):
+        self.mock_call.result.return_value = self.output_hosts
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1)
+        chunks = chunking.split(cherami_output.PutMessage(id='id', data='msg' * 10), 8)
+
+        # without reassembly, chunks are returned as they are
+        consumer = client.create_consumer(self.test_path, self.test_cg)
+        consumer._do_not_start_consumer_thread()
+        consumer.open()
+        for i, chunk in enumerate(chunks):
+            consumer.msg_queue.put((util.create_delivery_token('ack{0}'.format(i), '0:0'),
+                                    cherami_output.ConsumerMessage(ackId='ack{0}'.format(i), payload=chunk)))
+        msgs = consumer.receive(len(chunks))
+        consumer.close()
+        self.assertEquals([chunk.data for chunk in chunks], [msg.payload.data for token, msg in msgs])
+
+        # an incomplete message given up isn't nacked, it's redelivered once its lock times out
+        consumer = client.create_consumer(self.test_path, self.test_cg, reassemble_chunks=True)
+        consumer._do_not_start_consumer_thread()
+        consumer.open()
+        consumer.msg_queue.put((util.create_delivery_token('ack0', '0:0'),
+                                cherami_output.ConsumerMessage(ackId='ack0', payload=chunks[0])))
+        consumer.receive(1)
+        consumer.chunk_reassembler.timeout_seconds = 0
+        self.assertEquals([('ack0', '0:0')], consumer._expire_chunks())
+        self.assertTrue(consumer.ack_queue.empty())
+        consumer.close()
+        self.assertFalse(any(args[0].endpoint == 'BOut::ackMessages'
+                             for args, kwargs in self.mock_tchannel.thrift.call_args_list))
+
+    def test_consumer_dispatch_key_order(self):
+        self.mock_call.result.return_value = self.output_hosts
+
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1)
+        # each of the 10 hosts can buffer 20 messages
+        consumer = client.create_consumer(self.test_path, self.test_cg, pre_fetch_count=200)
+        consumer._do_not_start_consumer_thread()
+        consumer.open()
+
+        self.mock_call.result.return_value = self.ack_ok_response
+        handled = {}
+        done_signal = threading.Event()
+        lock = threading.Lock()
+
+        def handler(delivery_token, msg):
+            with lock:
+                handled.setdefault(msg.payload.userContext['partition-key'], []).append(msg.payload.id)
+                if sum(len(v) for v in handled.values()) == 20:
+                    done_signal.set()
+
+        for i in range(20):
+            consumer.msg_queue.put((util.create_delivery_token('ack{0}'.format(i), '0:0'),
+                                    cherami_output.ConsumerMessage(
+                                        ackId='ack{0}'.format(i),
+                                        payload=cherami_output.PutMessage(
+                                            id=str(i), userContext={'partition-key': str(i % 3)}))))
+        consumer.start_dispatch(handler, lane_count=2)
+        done_signal.wait(5)
+        # the last handled messages may still be acking
+        for dispatch_thread in consumer.dispatch_threads:
+            dispatch_thread.stop()
+            dispatch_thread.join()
+        consumer.close()
+
+        self.assertTrue(done_signal.is_set())
+        for key, ids in handled.items():
+            self.assertEquals([str(i) for i in range(20) if str(i % 3) == key], ids)
+        acked_ids = [ack_id for args, kwargs in self.mock_tchannel.thrift.call_args_list
+                     if args[0].endpoint == 'BOut::ackMessages'
+                     for ack_id in args[0].call_args.ackRequest.ackIds]
+        self.assertEquals(20, len(acked_ids))
+
+    def test_consumer_close_stops_dispatch(self):
+        self.mock_call.result.return_value = self.output_hosts
+
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=30)
+        consumer = client.create_consumer(self.test_path, self.test_cg)
+        consumer._do_not_start_consumer_thread()
+        consumer.open()
+
+        consumer.start_dispatch(lambda delivery_token, msg: None, lane_count=2)
+        feeder = consumer.dispatch_feeder_thread
+        lanes = list(consumer.dispatch_threads)
+        start_time = time.time()
+        consumer.close(drain_timeout_seconds=2)
+
+        # the feeder waiting in receive is stopped and joined within the drain deadline
+        self.assertLess(time.time() - start_time, 2)
+        self.assertFalse(feeder.is_alive())
+        self.assertFalse(any(lane.is_alive() for lane in lanes))
+
+    def test_consumer_dedupe(self):
+        self.mock_call.result.return_value = self.output_hosts
+
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1)
+        consumer = client.create_consumer(self.test_path, self.test_cg, dedupe_cache_size=10)
+        consumer._do_not_start_consumer_thread()
+        consumer.open()
+        self.mock_call.result.return_value = self.ack_ok_response
+
+        def deliver(ack_id, msg_id='msg_id'):
+            consumer.msg_queue.put((util.create_delivery_token(ack_id, '0:0'),
+                                    cherami_output.ConsumerMessage(
+                                        ackId=ack_id,
+                                        payload=cherami_output.PutMessage(id=msg_id, data='msg'))))
+
+        def acked_ids():
+            return [ack_id for args, kwargs in self.mock_tchannel.thrift.call_args_list
+                    if args[0].endpoint == 'BOut::ackMessages'
+                    for ack_id in args[0].call_args.ackRequest.ackIds]
+
+        deliver('ack0')
+        deliver('ack1')
+        msgs = consumer.receive(2)
+        self.assertEquals(1, len(msgs))
+        self.assertEquals('ack0', msgs[0][1].ackId)
+        self.assertEquals(0.5, consumer.get_dedupe_hit_rate())
+        # the original is still pending, the duplicate is dropped without an ack
+        self.assertEquals([], acked_ids())
+
+        # once the original is acked, later duplicates are acked right away
+        self.assertTrue(consumer.ack(msgs[0][0]))
+        deliver('ack2')
+        self.assertEquals([], consumer.receive(1))
+        self.assertTrue(util.wait_until(lambda: 'ack2' in acked_ids(), time.time() + 1))
+
+        # a nacked message is not suppressed when it's redelivered
+        deliver('ack3', 'msg_id2')
+        msgs = consumer.receive(1)
+        self.assertTrue(consumer.nack(msgs[0][0]))
+        deliver('ack4', 'msg_id2')
+        msgs = consumer.receive(1)
+        consumer.close()
+
+        self.assertEquals(1, len(msgs))
+        self.assertEquals('ack4', msgs[0][1].ackId)
+
+    def test_consumer_autoscaling_settings(self):
+        self.mock_call.result.side_effect = [
+            mock.Mock(body=cherami.ConsumerGroupDescription(consumerGroupUUID='uuid')),
+            mock.Mock(body=cherami.GetQueueDepthInfoResult(value='{"BacklogAvailable": 1200}')),
+        ]
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1)
+        consumer = client.create_consumer(self.test_path, self.test_cg, pre_fetch_count=10)
+
+        self.assertEquals(1200, consumer.get_backlog())
+        args, kwargs = self.mock_tchannel.thrift.call_args
+        self.assertEquals('BFrontend::getQueueDepthInfo', args[0].endpoint)
+        self.assertEquals('uuid', args[0].call_args.getQueueDepthInfoRequest.key)
+
+        consumer.set_pre_fetch_count(40)
+        self.assertEquals(40, consumer.msg_queue.maxsize)
+        self.assertEquals(4, consumer.msg_batch_size)
+
+        # ack threads only run once the consumer is opened
+        consumer.set_ack_thread_count(2)
+        self.assertEquals(0, len(consumer.ack_threads))
+        consumer.opened = True
+        consumer.set_ack_thread_count(2)
+        self.assertEquals(2, len(consumer.ack_threads))
+        consumer.set_ack_thread_count(1)
+        self.assertEquals(1, len(consumer.ack_threads))
+        consumer.close()
+
+    def test_consumer_release_buffered_messages(self):
+        self.mock_call.result.return_value = self.output_hosts
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1)
+        consumer = client.create_consumer(self.test_path, self.test_cg, ack_message_thread_count=0)
+        consumer._do_not_start_consumer_thread()
+        consumer.open()
+
+        for i in range(4):
+            consumer.msg_queue.put((util.create_delivery_token('ack{0}'.format(i), '{0}:{0}'.format(i % 2)),
+                                    cherami_output.ConsumerMessage(ackId='ack{0}'.format(i), payload=self.test_msg)))
+
+        # host 1 is removed
+        self.mock_call.result.return_value = mock.Mock(body=cherami.ReadConsumerGroupHostsResult(
+            hostAddresses=[cherami.HostAddress(host='0', port=0)]))
+        consumer._reconfigure()
+        self.assertEquals(2, consumer.msg_queue.qsize())
+        self.assertEquals(['ack0', 'ack2'], [msg.ackId for token, msg in consumer.msg_queue.buffers['0:0']])
+        nacked = [consumer.ack_queue.get(block=False) for i in range(consumer.ack_queue.qsize())]
+        self.assertEquals([(False, ('ack1', '1:1')), (False, ('ack3', '1:1'))],
+                          [(is_ack, token) for is_ack, token, callback in nacked])
+
+        # close nacks the rest
+        consumer.close(drain_timeout_seconds=0)
+        self.assertEquals(0, consumer.msg_queue.qsize())
+        self.assertEquals(2, consumer.ack_queue.qsize())
+
+    def test_consumer_shared_pools(self):
+        self.mock_call.result.return_value = self.output_hosts
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1, shared_thread_pools=True)
+        consumers = [client.create_consumer(self.test_path, cg) for cg in ['cg1', 'cg2']]
+        for consumer in consumers:
+            consumer._do_not_start_consumer_thread()
+            consumer.open()
+            self.assertEquals(0, len(consumer.ack_threads))
+            self.assertIs(client.ack_pool.ack_queue, consumer.ack_queue)
+
+        self.mock_call.result.return_value = self.ack_ok_response
+        self.assertTrue(consumers[0].ack(self.test_delivery_token))
+        for consumer in consumers:
+            consumer.close()
+        client.close()
+
+        args, kwargs = self.mock_tchannel.thrift.call_args
+        self.assertEquals('BOut::ackMessages', args[0].endpoint)
+        self.assertEquals([self.test_ack_id], args[0].call_args.ackRequest.ackIds)
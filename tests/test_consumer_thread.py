@@ -0,0 +1,107 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import unittest
+import mock
+import threading
+from clay import config
+
+from cherami_client.consumer_thread import ConsumerThread
+from cherami_client.fair_queue import FairMessageQueue
+from cherami_client.lib import cherami_output
+
+
+class TestConsumerThread(unittest.TestCase):
+
+    def setUp(self):
+        self.msg_queue = FairMessageQueue(10)
+        self.mock_tchannel = mock.Mock()
+        self.sizes = []
+        self.done = threading.Event()
+
+        # the first call returns two messages, the others wait
+        def thrift(request, **kwargs):
+            size = request.call_args.request.maxNumberOfMessages
+            first = not self.sizes
+            self.sizes.append(size)
+            future = mock.Mock()
+            future.done.side_effect = lambda: first and self.done.is_set()
+            future.result.return_value = mock.Mock(body=cherami_output.ReceiveMessageBatchResult(
+                messages=[cherami_output.ConsumerMessage(ackId='ack{0}'.format(i)) for i in range(2)]))
+            return future
+        self.mock_tchannel.thrift.side_effect = thrift
+
+    def _wait_for(self, condition):
+        for i in range(500):
+            if condition():
+                return True
+            threading.Event().wait(0.01)
+        return False
+
+    def test_concurrent_receives(self):
+        thread = ConsumerThread(tchannel=self.mock_tchannel,
+                                headers={},
+                                logger=config.get_logger('test'),
+                                msg_queue=self.msg_queue,
+                                hostport='0:0',
+                                path='/test/path',
+                                consumer_group_name='test/cg',
+                                timeout_seconds=1,
+                                msg_batch_size=4,
+                                max_inflight_receives=3)
+        thread.daemon = True
+        thread.start()
+
+        # three receives in flight, asking for no more than the buffer can hold
+        self.assertTrue(self._wait_for(lambda: len(self.sizes) == 3))
+        self.assertEquals([4, 4, 2], self.sizes)
+
+        # the first one completes: its messages are buffered and another receive takes its place
+        self.done.set()
+        self.assertTrue(self._wait_for(lambda: len(self.sizes) == 4))
+        thread.stop()
+        thread.join()
+
+        self.assertEquals(2, self.msg_queue.qsize())
+        # 2 messages buffered and 6 asked for by the receives still in flight leave room for 2
+        self.assertEquals(2, self.sizes[3])
+
+    def test_stop_releases_inflight_receives(self):
+        released = []
+        thread = ConsumerThread(tchannel=self.mock_tchannel,
+                                headers={},
+                                logger=config.get_logger('test'),
+                                msg_queue=self.msg_queue,
+                                hostport='0:0',
+                                path='/test/path',
+                                consumer_group_name='test/cg',
+                                timeout_seconds=1,
+                                msg_batch_size=4,
+                                max_inflight_receives=2,
+                                release_func=lambda msgs, hostport: released.extend(msgs))
+        thread.daemon = True
+        thread.start()
+        self.assertTrue(self._wait_for(lambda: len(self.sizes) == 2))
+
+        # the receives completing once stopped aren't buffered, their messages are released
+        thread.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEquals(0, self.msg_queue.qsize())
+        self.assertEquals([('ack0', '0:0'), ('ack1', '0:0')] * 2, [token for token, msg in released])
@@ -0,0 +1,78 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import unittest
+import mock
+import threading
+import time
+
+from cherami_client.delayed_nack import DelayedNackThread
+from cherami_client.lib import util
+
+
+class TestDelayedNackThread(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.sent = threading.Event()
+
+        def send(items):
+            self.batches.append([token for token, callback in items])
+            self.sent.set()
+
+        self.thread = DelayedNackThread(mock.Mock(), send)
+        self.thread.daemon = True
+
+    def test_due_nacks_sent_together(self):
+        self.thread.schedule(0.05, 'b', None)
+        self.thread.schedule(0.05, 'c', None)
+        self.thread.schedule(0.01, 'a', None)
+        self.thread.schedule(60, 'd', None)
+        self.thread.start()
+
+        while sum(len(batch) for batch in self.batches) < 3:
+            self.assertTrue(self.sent.wait(5))
+            self.sent.clear()
+        self.assertEquals(['a', 'b', 'c'], [token for batch in self.batches for token in batch])
+        self.assertTrue(util.wait_until(lambda: len(self.thread) == 1, time.time() + 5))
+
+        # the nacks held are sent once stopped
+        self.thread.stop()
+        self.thread.join(5)
+        self.assertEquals(['d'], self.batches[-1])
+        self.assertEquals(0, len(self.thread))
+        self.assertFalse(self.thread.is_alive())
+
+    def test_nacks_being_sent_counted(self):
+        release = threading.Event()
+        thread = DelayedNackThread(mock.Mock(), lambda items: release.wait(5))
+        thread.daemon = True
+        thread.schedule(60, 'a', None)
+        thread.schedule(60, 'b', None)
+        thread.start()
+
+        # stopped while the send hangs, the nacks not sent yet are still counted
+        thread.stop()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        self.assertEquals(2, len(thread))
+
+        release.set()
+        thread.join(5)
+        self.assertEquals(0, len(thread))
@@ -0,0 +1,80 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import unittest
+
+from six.moves import queue
+
+from cherami_client.fair_queue import FairMessageQueue
+from cherami_client.lib import util
+
+
+class TestFairMessageQueue(unittest.TestCase):
+
+    def _put(self, q, hostport, ids, block=True):
+        for id in ids:
+            q.put((util.create_delivery_token(id, hostport), id), block=block)
+
+    def _get_all(self, q):
+        ids = []
+        while q.qsize():
+            ids.append(q.get(block=False)[1])
+        return ids
+
+    def test_round_robin(self):
+        q = FairMessageQueue(0)
+        self._put(q, '0:0', ['a1', 'a2', 'a3', 'a4'])
+        self._put(q, '1:1', ['b1'])
+        self._put(q, '2:2', ['c1', 'c2'])
+
+        self.assertEquals(['a1', 'b1', 'c1', 'a2', 'c2', 'a3', 'a4'], self._get_all(q))
+        self.assertRaises(queue.Empty, q.get, block=False)
+
+    def test_quantum(self):
+        q = FairMessageQueue(0, quantum=2)
+        self._put(q, '0:0', ['a1', 'a2', 'a3'])
+        self._put(q, '1:1', ['b1', 'b2', 'b3'])
+
+        self.assertEquals(['a1', 'a2', 'b1', 'b2', 'a3', 'b3'], self._get_all(q))
+
+    def test_credit(self):
+        q = FairMessageQueue(4)
+        q.set_host_count(2)
+        self.assertEquals(2, q.get_credit())
+
+        # a busy host can't use up the whole buffer
+        self._put(q, '0:0', ['a1', 'a2'])
+        self.assertRaises(queue.Full, self._put, q, '0:0', ['a3'], False)
+        self.assertRaises(queue.Full, q.put, (util.create_delivery_token('a3', '0:0'), 'a3'), True, 0.01)
+        self._put(q, '1:1', ['b1', 'b2'], block=False)
+        self.assertRaises(queue.Full, self._put, q, '2:2', ['c1'], False)
+
+        self.assertEquals('a1', q.get()[1])
+        self._put(q, '0:0', ['a3'], block=False)
+        self.assertEquals(['b1', 'a2', 'b2', 'a3'], self._get_all(q))
+
+    def test_remove(self):
+        q = FairMessageQueue(10)
+        self._put(q, '0:0', ['a1', 'a2'])
+        self._put(q, '1:1', ['b1', 'b2'])
+
+        removed = q.remove(lambda result: util.get_hostport_from_delivery_token(result[0]) == '0:0')
+        self.assertEquals(['a1', 'a2'], [id for token, id in removed])
+        self.assertEquals(2, q.qsize())
+        self.assertEquals(['b1', 'b2'], self._get_all(q))
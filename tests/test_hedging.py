@@ -0,0 +1,64 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import unittest
+
+from cherami_client.hedging import HedgePolicy, HedgedCallback
+from cherami_client.lib import cherami, cherami_input, util
+
+
+class TestHedging(unittest.TestCase):
+
+    def test_delay_percentile(self):
+        policy = HedgePolicy(percentile=90, min_delay_seconds=0)
+        for i in range(HedgePolicy.min_samples - 1):
+            policy.record(i / 100.0)
+        self.assertIsNone(policy.get_delay())
+
+        policy.record(0.19)
+        self.assertEquals(0.18, policy.get_delay())
+
+    def test_budget(self):
+        policy = HedgePolicy(budget_percent=10)
+        policy.hostports = ['a', 'b']
+        for i in range(19):
+            policy.record(0.01)
+
+        self.assertEquals('b', policy.acquire('a'))
+        self.assertIsNone(policy.acquire('a'))
+        policy.hostports = ['a']
+        policy.record(0.01)
+        self.assertIsNone(policy.acquire('a'))
+
+    def test_first_ok_ack_wins(self):
+        acks = []
+        callback = HedgedCallback([cherami_input.PutMessage(id='a'), cherami_input.PutMessage(id='b')], acks.append)
+        callback.hedge()
+
+        callback(util.create_failed_message_ack('a', 'failed'))
+        callback(cherami_input.PutMessageAck(id='b', status=cherami.Status.OK))
+        self.assertEquals(['b'], [ack.id for ack in acks])
+
+        callback(cherami_input.PutMessageAck(id='a', status=cherami.Status.OK))
+        callback(util.create_failed_message_ack('b', 'failed'))
+        self.assertEquals([('b', cherami.Status.OK), ('a', cherami.Status.OK)], [(ack.id, ack.status) for ack in acks])
+
+        callback = HedgedCallback([cherami_input.PutMessage(id='a')], acks.append)
+        callback(util.create_failed_message_ack('a', 'failed'))
+        self.assertEquals(cherami.Status.FAILED, acks[-1].status)
@@ -0,0 +1,112 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import unittest
+import mock
+import threading
+from clay import config
+
+from cherami_client.lib import cherami, cherami_input
+from cherami_client.client import Client
+
+
+class TestLogPublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.test_path = '/test/log'
+        self.logger = config.get_logger('test')
+        self.publisher_options = mock.Mock(body=cherami.ReadPublisherOptionsResult(
+            hostProtocols=[cherami.HostProtocol(
+                protocol=cherami.Protocol.TCHANNEL,
+                hostAddresses=[cherami.HostAddress(host='0', port=0)])]
+        ))
+        self.sent = []
+        self.reject_ids = set()
+        self.lsn = [0]
+        self.mock_tchannel = mock.Mock()
+        self.mock_tchannel.thrift.side_effect = self._thrift
+
+    # the inputhost rejects the messages in reject_ids once, and the messages after them in the batch
+    def _thrift(self, request, **kwargs):
+        if request.endpoint == 'BFrontend::readPublisherOptions':
+            return mock.Mock(result=mock.Mock(return_value=self.publisher_options))
+
+        success, failed = [], []
+        for msg in request.call_args.request.messages:
+            self.sent.append((msg.id, msg.previousMessageId))
+            if msg.id in self.reject_ids or failed:
+                failed.append(cherami_input.PutMessageAck(id=msg.id, status=cherami.Status.FAILED, message='err'))
+                self.reject_ids.discard(msg.id)
+                continue
+            self.lsn[0] += 1
+            success.append(cherami_input.PutMessageAck(id=msg.id, status=cherami.Status.OK,
+                                                       lsn=self.lsn[0], address=self.lsn[0] * 10))
+        return mock.Mock(result=mock.Mock(return_value=mock.Mock(
+            body=cherami_input.PutMessageBatchResult(successMessages=success, failedMessages=failed))))
+
+    def _publish(self, publisher, count):
+        acks = []
+        done_signal = threading.Event()
+
+        def callback(ack):
+            acks.append(ack)
+            if len(acks) == count:
+                done_signal.set()
+
+        for i in range(count):
+            publisher.publish_async(str(i), 'msg', callback)
+        done_signal.wait(5)
+        return acks
+
+    def test_log_publisher_chain(self):
+        client = Client(self.mock_tchannel, self.logger)
+        publisher = client.create_log_publisher(self.test_path, batch_size=2, previous_message_id='head')
+        publisher.open()
+        acks = self._publish(publisher, 5)
+        publisher.close()
+
+        self.assertEquals([str(i) for i in range(5)], [ack.id for ack in acks])
+        self.assertEquals([1, 2, 3, 4, 5], [ack.lsn for ack in acks])
+        self.assertEquals([10, 20, 30, 40, 50], [ack.address for ack in acks])
+        self.assertEquals([('0', 'head'), ('1', '0'), ('2', '1'), ('3', '2'), ('4', '3')], self.sent)
+
+    def test_log_publisher_resync(self):
+        self.reject_ids.add('1')
+        client = Client(self.mock_tchannel, self.logger)
+        publisher = client.create_log_publisher(self.test_path, batch_size=5)
+        publisher.open()
+        acks = self._publish(publisher, 3)
+        publisher.close()
+
+        self.assertEquals(['0', '1', '2'], [ack.id for ack in acks])
+        self.assertTrue(all(ack.status == cherami.Status.OK for ack in acks))
+        # the rejected message and the ones after it are resent chained to the last acked message
+        self.assertEquals([('0', None), ('1', '0'), ('2', '1'), ('1', '0'), ('2', '1')], self.sent)
+
+    def test_log_publisher_give_up(self):
+        client = Client(self.mock_tchannel, self.logger)
+        publisher = client.create_log_publisher(self.test_path, max_retries=0)
+        publisher.open()
+        self.reject_ids.add('0')
+        acks = self._publish(publisher, 2)
+        publisher.close()
+
+        self.assertEquals(['0', '1'], [ack.id for ack in acks])
+        self.assertTrue(all(ack.status == cherami.Status.FAILED for ack in acks))
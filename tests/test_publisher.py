@@ -26,6 +26,9 @@ from clay import config
 
 from cherami_client.lib import cherami, cherami_input, util
 from cherami_client.client import Client
+from cherami_client import codec, router, serializer
+from cherami_client.publish_pool import PublishPool
+from cherami_client.publisher import Publisher
 
 
 class TestPublisher(unittest.TestCase):
@@ -102,7 +105,9 @@ class TestPublisher(unittest.TestCase):
         self.assertEquals('BFrontend::readPublisherOptions', args[0].endpoint)
         self.assertEquals(self.test_path, args[0].call_args.getPublisherOptionsRequest.path)
         self.assertEquals(10, len(publisher.workers))
-        self.assertTrue(publisher.reconfigure_thread.is_alive())
+        # close joins the threads
+        self.assertFalse(publisher.reconfigure_thread.is_alive())
+        self.assertFalse(any(worker.is_alive() for worker in publisher.workers.values()))
 
     def test_publisher_publish(self):
         self.mock_call.result.return_value = self.publisher_options
@@ -226,6 +231,25 @@ class TestPublisher(unittest.TestCase):
         self.assertEquals(cherami.Status.OK, acks[0].status)
         self.assertEquals(self.test_receipt, acks[0].receipt)
 
+    def test_publisher_publish_async_callback_exception(self):
+        self.mock_call.result.return_value = self.publisher_options
+        acks = []
+
+        client = Client(self.mock_tchannel, self.logger)
+        publisher = client.create_publisher(self.test_path)
+        publisher.open()
+
+        def callback(ack):
+            acks.append(ack)
+            raise Exception('callback failed')
+
+        self.mock_call.result.return_value = self.send_ack_success
+        publisher.publish_async(self.test_msg_id, self.test_msg, callback)
+        publisher.close()
+
+        # the exception doesn't fail the message
+        self.assertEquals([cherami.Status.OK], [ack.status for ack in acks])
+
     def test_publisher_publish_async_invalid_callback(self):
         self.mock_call.result.return_value = self.publisher_options
 
@@ -281,6 +305,142 @@ class TestPublisher(unittest.TestCase):
         self.assertEquals(cherami.Status.OK, ack.status)
         self.assertEquals(self.test_receipt, ack.receipt)
 
+    def test_publisher_publish_compressed(self):
+        self.mock_call.result.return_value = self.publisher_options_crc32
+
+        client = Client(self.mock_tchannel, self.logger)
+        publisher = client.create_publisher(self.test_path,
+                                            payload_codec=codec.PayloadCodec(name=codec.ZLIB, threshold_bytes=0))
+        publisher.open()
+
+        self.mock_call.result.return_value = self.send_ack_success
+        data = self.test_msg * 100
+        context = {'mycontextkey': 'mycontextvalue'}
+        ack = publisher.publish(self.test_msg_id, data, context)
+        publisher.close()
+
+        args, kwargs = self.mock_tchannel.thrift.call_args
+        sent = args[0].call_args.request.messages[0]
+        self.assertEquals(codec.ZLIB, sent.userContext[codec.CODEC_CONTEXT_KEY])
+        self.assertEquals('mycontextvalue', sent.userContext['mycontextkey'])
+        self.assertEquals(1, len(context))
+        self.assertEquals(data, codec.PayloadCodec().decode(sent.data, sent.userContext)[0])
+        self.assertEquals(util.calc_crc(sent.data, cherami.ChecksumOption.CRC32IEEE), sent.crc32IEEEDataChecksum)
+        self.assertEquals(cherami.Status.OK, ack.status)
+
+    def test_publisher_publish_schema_version(self):
+        self.mock_call.result.return_value = self.publisher_options
+
+        registry = serializer.SerializerRegistry()
+        registry.register_json(1)
+        client = Client(self.mock_tchannel, self.logger)
+        publisher = client.create_publisher(self.test_path, serializer_registry=registry)
+        publisher.open()
+
+        self.mock_call.result.return_value = self.send_ack_success
+        ack = publisher.publish(self.test_msg_id, {'k': 'v'}, schema_version=1)
+        publisher.close()
+
+        args, kwargs = self.mock_tchannel.thrift.call_args
+        sent = args[0].call_args.request.messages[0]
+        self.assertEquals(1, sent.schemaVersion)
+        self.assertEquals({'k': 'v'}, registry.decode(1, sent.data))
+        self.assertEquals(cherami.Status.OK, ack.status)
+
+    def test_publisher_publish_chunked(self):
+        self.mock_call.result.return_value = self.publisher_options
+
+        client = Client(self.mock_tchannel, self.logger)
+        publisher = client.create_publisher(self.test_path, chunk_size_bytes=4)
+        publisher.open()
+
+        self.mock_call.result.return_value = mock.Mock(body=cherami_input.PutMessageBatchResult(
+            successMessages=[cherami_input.PutMessageAck(
+                id='{0}#{1}'.format(self.test_msg_id, i),
+                status=cherami.Status.OK,
+                receipt=self.test_receipt,
+            ) for i in range(2)]
+        ))
+        ack = publisher.publish(self.test_msg_id, self.test_msg)
+        publisher.close()
+
+        args, kwargs = self.mock_tchannel.thrift.call_args
+        self.assertEquals('BIn::putMessageBatch', args[0].endpoint)
+        self.assertEquals(2, len(args[0].call_args.request.messages))
+        self.assertEquals(self.test_msg, ''.join(m.data for m in args[0].call_args.request.messages))
+        self.assertEquals(self.test_msg_id, ack.id)
+        self.assertEquals(cherami.Status.OK, ack.status)
+
+    def test_publisher_publish_delayed(self):
+        self.mock_call.result.return_value = self.publisher_options
+
+        client = Client(self.mock_tchannel, self.logger)
+        publisher = client.create_publisher(self.test_path)
+        publisher.open()
+
+        self.mock_call.result.return_value = mock.Mock(body=cherami.DestinationDescription(
+            path=self.test_path, type=cherami.DestinationType.TIMER))
+        publisher._check_delay(10)
+
+        self.mock_call.result.return_value = self.send_ack_success
+        ack = publisher.publish(self.test_msg_id, self.test_msg, delay_seconds=10)
+        publisher.close()
+
+        args, kwargs = self.mock_tchannel.thrift.call_args
+        self.assertEquals('BIn::putMessageBatch', args[0].endpoint)
+        self.assertEquals(10, args[0].call_args.request.messages[0].delayMessageInSeconds)
+        self.assertEquals(cherami.Status.OK, ack.status)
+
+    def test_publisher_publish_delayed_plain(self):
+        self.mock_call.result.return_value = self.publisher_options
+
+        client = Client(self.mock_tchannel, self.logger)
+        publisher = client.create_publisher(self.test_path)
+        publisher.open()
+
+        self.mock_call.result.return_value = mock.Mock(body=cherami.DestinationDescription(
+            path=self.test_path, type=cherami.DestinationType.PLAIN))
+        self.assertRaises(Exception, publisher.publish, self.test_msg_id, self.test_msg, delay_seconds=10)
+        self.assertRaises(Exception, publisher.publish, self.test_msg_id, self.test_msg, delay_seconds=-1)
+        publisher.close()
+
+    def test_publisher_schedule_many(self):
+        self.mock_call.result.return_value = self.publisher_options
+
+        client = Client(self.mock_tchannel, self.logger)
+        publisher = client.create_publisher(self.test_path)
+        publisher.destination_type = cherami.DestinationType.TIMER
+        publisher.open()
+
+        self.mock_call.result.return_value = mock.Mock(body=cherami_input.PutMessageBatchResult(
+            successMessages=[cherami_input.PutMessageAck(id=str(i), status=cherami.Status.OK) for i in range(5)]
+        ))
+        acks = publisher.schedule_many([(str(i), self.test_msg, i + 1) for i in range(5)], batch_size=2)
+        publisher.close()
+
+        self.assertEquals([str(i) for i in range(5)], [ack.id for ack in acks])
+        self.assertTrue(all(ack.status == cherami.Status.OK for ack in acks))
+        requests = [args[0].call_args.request for args, kwargs in self.mock_tchannel.thrift.call_args_list
+                    if args[0].endpoint == 'BIn::putMessageBatch']
+        self.assertEquals(3, len(requests))
+        self.assertEquals([1, 2, 3, 4, 5],
+                          sorted(m.delayMessageInSeconds for r in requests for m in r.messages))
+
+    def test_publisher_schedule_many_invalid(self):
+        client = Client(self.mock_tchannel, self.logger)
+        publisher = client.create_publisher(self.test_path)
+        publisher.destination_type = cherami.DestinationType.TIMER
+
+        messages = [(str(i), self.test_msg, 10) for i in range(4)] + [('bad', self.test_msg, -1)]
+        self.assertRaises(Exception, publisher.schedule_many_async, messages, None, batch_size=2)
+        # nothing is queued
+        self.assertTrue(publisher.task_queue.empty())
+
+        # no message, no wait
+        start_time = time.time()
+        self.assertEquals([], publisher.schedule_many([]))
+        self.assertLess(time.time() - start_time, 0.5)
+
     def test_crc32(self):
         s = 'aaa'
         self.assertEquals(util.calc_crc(s, cherami.ChecksumOption.CRC32IEEE), 4027020077)
@@ -296,3 +456,155 @@ class TestPublisher(unittest.TestCase):
     #
     #     time.sleep(15)
     #     self.assertEquals(8, len(publisher.workers))
+
+    def test_publisher_close_drains(self):
+        self.mock_call.result.return_value = self.publisher_options
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1)
+        publisher = client.create_publisher(self.test_path)
+        publisher.open()
+
+        acks = []
+        self.mock_call.result.return_value = self.send_ack_success
+        for i in range(20):
+            publisher.publish_async(self.test_msg_id, self.test_msg, acks.append)
+        publisher.close()
+
+        self.assertEquals(20, len(acks))
+        self.assertTrue(all(ack.status == cherami.Status.OK for ack in acks))
+        self.assertFalse(any(worker.is_alive() for worker in publisher.workers.values()))
+
+    def test_publisher_routing(self):
+        self.mock_call.result.return_value = self.publisher_options
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1)
+        publisher = client.create_publisher(self.test_path, routing=router.POWER_OF_TWO_CHOICES)
+        publisher.open()
+        self.assertEquals(10, len(publisher.router.host_queues))
+
+        acks = []
+        self.mock_call.result.return_value = self.send_ack_success
+        for i in range(20):
+            publisher.publish_async(self.test_msg_id, self.test_msg, acks.append)
+        publisher.close()
+
+        self.assertEquals(20, len(acks))
+        self.assertTrue(all(ack.status == cherami.Status.OK for ack in acks))
+        self.assertTrue(publisher.router.empty())
+        self.assertFalse(any(worker.is_alive() for worker in publisher.workers.values()))
+
+    def test_publisher_close_fails_unsent(self):
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1)
+        publisher = client.create_publisher(self.test_path)
+
+        acks = []
+        publisher.publish_async(self.test_msg_id, self.test_msg, acks.append)
+        publisher.close(drain_timeout_seconds=0)
+
+        self.assertEquals(1, len(acks))
+        self.assertEquals(cherami.Status.FAILED, acks[0].status)
+        self.assertEquals('publisher closed', acks[0].message)
+
+    def test_publisher_shared_pools(self):
+        self.mock_call.result.return_value = self.publisher_options
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1,
+                        shared_thread_pools=True, publish_pool_thread_count=2)
+        publisher = client.create_publisher(self.test_path)
+        publisher.open()
+        self.assertEquals(0, len(publisher.workers))
+        self.assertEquals(10, len(publisher.pool_hostports))
+
+        self.mock_call.result.return_value = self.send_ack_success
+        ack = publisher.publish(self.test_msg_id, self.test_msg)
+        publisher.close()
+        client.close()
+
+        self.assertEquals(cherami.Status.OK, ack.status)
+        args, kwargs = self.mock_tchannel.thrift.call_args
+        self.assertEquals('BIn::putMessageBatch', args[0].endpoint)
+        self.assertFalse(publisher.reconfigure_thread.is_alive())
+
+    def test_publisher_shared_pools_unsupported(self):
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1, shared_thread_pools=True)
+        self.assertRaises(ValueError, client.create_publisher, self.test_path, routing=router.LEAST_OUTSTANDING)
+        self.assertRaises(ValueError, client.create_publisher, self.test_path, hedge_percentile=95)
+        client.close()
+
+        self.assertRaises(ValueError, Client, self.mock_tchannel, self.logger, shared_thread_pools=True,
+                          local_zone='z1', zone_resolver=lambda hostport: 'z1')
+
+    def test_publish_pool_takes_turns(self):
+        self.mock_call.result.return_value = self.send_ack_success
+        pool = PublishPool(1, self.logger)
+        publishers = []
+        for path in ['/a', '/b']:
+            publisher = Publisher(self.logger, path, self.mock_tchannel, 'prod', {}, 1, 10, publish_pool=pool)
+            publisher.pool_hostports = ['0:0']
+            publishers.append(publisher)
+
+        done_signal = threading.Event()
+        acks = []
+
+        def callback(ack):
+            acks.append(ack)
+            if len(acks) == 4:
+                done_signal.set()
+
+        for i in range(3):
+            publishers[0].publish_async(self.test_msg_id, self.test_msg, callback)
+        publishers[1].publish_async(self.test_msg_id, self.test_msg, callback, timeout_seconds=0.5)
+
+        pool.start()
+        self.assertTrue(done_signal.wait(5))
+        pool.stop()
+
+        paths = [args[0].call_args.request.destinationPath for args, kwargs in self.mock_tchannel.thrift.call_args_list]
+        self.assertEquals(['/a', '/b', '/a', '/a'], paths)
+        # the call doesn't outlast the deadline of the messages
+        timeouts = [kwargs['timeout'] for args, kwargs in self.mock_tchannel.thrift.call_args_list]
+        self.assertTrue(0.5 < timeouts[0] <= 1)
+        self.assertTrue(0 < timeouts[1] <= 0.5)
+
+    def test_publish_pool_expired_task(self):
+        self.mock_call.result.return_value = self.send_ack_success
+        pool = PublishPool(1, self.logger)
+        publisher = Publisher(self.logger, self.test_path, self.mock_tchannel, 'prod', {}, 1, 10, publish_pool=pool)
+        publisher.pool_hostports = ['0:0']
+
+        acks = []
+        done_signal = threading.Event()
+
+        def callback(ack):
+            acks.append(ack)
+            if len(acks) == 2:
+                done_signal.set()
+
+        publisher.publish_async('expired', self.test_msg, callback, timeout_seconds=0.01)
+        publisher.publish_async(self.test_msg_id, self.test_msg, callback)
+        time.sleep(0.05)
+
+        # the message queued after the expired one is still sent
+        pool.start()
+        try:
+            self.assertTrue(done_signal.wait(2))
+        finally:
+            pool.stop()
+        self.assertEquals([cherami.Status.TIMEDOUT, cherami.Status.OK], [ack.status for ack in acks])
+        self.assertEquals(1, self.mock_tchannel.thrift.call_count)
+
+    def test_publisher_drops_expired(self):
+        # the expired message is never sent
+        self.mock_call.result.side_effect = [self.publisher_options, self.send_ack_success]
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1)
+        publisher = client.create_publisher(self.test_path)
+
+        acks = []
+        publisher.publish_async('expired', self.test_msg, acks.append, timeout_seconds=0.01)
+        publisher.publish_async(self.test_msg_id, self.test_msg, acks.append)
+        time.sleep(0.05)
+
+        # the workers start after the first message expired
+        publisher.open()
+        publisher.close()
+
+        self.assertEquals([('expired', cherami.Status.TIMEDOUT), (self.test_msg_id, cherami.Status.OK)],
+                          sorted([(ack.id, ack.status) for ack in acks]))
+        self.assertEquals(2, self.mock_call.result.call_count)
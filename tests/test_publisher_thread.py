@@ -0,0 +1,158 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import unittest
+import mock
+import threading
+import time
+
+from six.moves import queue
+
+from cherami_client.hedging import HedgePolicy
+from cherami_client.lib import cherami, cherami_input
+from cherami_client.publisher_thread import PublisherThread
+
+
+class TestPublisherThread(unittest.TestCase):
+
+    def setUp(self):
+        self.task_queue = queue.Queue()
+        self.mock_tchannel = mock.Mock()
+        self.calls = {}
+        self.call_timeouts = {}
+
+        # each call completes when its event is set. Calls to other inputhosts are keyed by id@hostport
+        def thrift(request, **kwargs):
+            msg_id = request.call_args.request.messages[0].id
+            id = msg_id if kwargs['hostport'] == '0:0' else '{0}@{1}'.format(msg_id, kwargs['hostport'])
+            self.calls[id] = threading.Event()
+            self.call_timeouts[id] = kwargs['timeout']
+            future = mock.Mock()
+            future.done.side_effect = self.calls[id].is_set
+
+            def result():
+                self.calls[id].wait(5)
+                return mock.Mock(body=cherami_input.PutMessageBatchResult(
+                    successMessages=[cherami_input.PutMessageAck(id=msg_id, status=cherami.Status.OK)]))
+            future.result.side_effect = result
+            return future
+        self.mock_tchannel.thrift.side_effect = thrift
+
+    def _start(self, max_inflight_batches, hedge_policy=None):
+        thread = PublisherThread(path='/test/path',
+                                 task_queue=self.task_queue,
+                                 tchannel=self.mock_tchannel,
+                                 hostport='0:0',
+                                 headers={},
+                                 timeout_seconds=1,
+                                 checksum_option=None,
+                                 max_inflight_batches=max_inflight_batches,
+                                 hedge_policy=hedge_policy)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _wait_for_calls(self, count):
+        for i in range(500):
+            if len(self.calls) >= count:
+                return
+            threading.Event().wait(0.01)
+
+    def test_inflight_window(self):
+        acks = []
+        done_signal = threading.Event()
+
+        def callback(ack):
+            acks.append(ack.id)
+            if len(acks) == 3:
+                done_signal.set()
+
+        for id in ['a', 'b', 'c']:
+            self.task_queue.put(([cherami_input.PutMessage(id=id, data='msg')], callback, None))
+        thread = self._start(max_inflight_batches=2)
+
+        # only two calls are in flight
+        self._wait_for_calls(2)
+        self.assertEquals(['a', 'b'], sorted(self.calls.keys()))
+
+        # acks are delivered as the calls complete
+        self.calls['b'].set()
+        self._wait_for_calls(3)
+        self.assertEquals(['b'], acks)
+
+        self.calls['a'].set()
+        self.calls['c'].set()
+        self.assertTrue(done_signal.wait(5))
+        thread.stop()
+        self.task_queue.put(None)
+        thread.join()
+        self.assertEquals(['b', 'a', 'c'], acks)
+
+    def test_hedge_slow_call(self):
+        policy = HedgePolicy()
+        policy.hostports = ['0:0', '1:1']
+        policy.delay = 0.01
+        policy.budget = 1
+
+        acks = []
+        done_signal = threading.Event()
+
+        def callback(ack):
+            acks.append(ack)
+            done_signal.set()
+
+        self.task_queue.put(([cherami_input.PutMessage(id='a', data='msg')], callback, time.time() + 0.5))
+        thread = self._start(max_inflight_batches=1, hedge_policy=policy)
+
+        # the slow call is sent again to the other inputhost, which acks first
+        self._wait_for_calls(2)
+        self.assertEquals(['a', 'a@1:1'], sorted(self.calls.keys()))
+        # the hedge call doesn't outlast the deadline of the messages either
+        self.assertTrue(0 < self.call_timeouts['a@1:1'] <= 0.5)
+        self.calls['a@1:1'].set()
+        self.assertTrue(done_signal.wait(5))
+
+        # the ack of the slow call is dropped
+        self.calls['a'].set()
+        thread.stop()
+        self.task_queue.put(None)
+        thread.join()
+        self.assertEquals(1, len(acks))
+        self.assertEquals(cherami.Status.OK, acks[0].status)
+        self.assertEquals(2, len(self.calls))
+
+    def test_call_timeout_follows_deadline(self):
+        acks = []
+        done_signal = threading.Event()
+
+        def callback(ack):
+            acks.append(ack)
+            done_signal.set()
+
+        self.task_queue.put(([cherami_input.PutMessage(id='a', data='msg')], callback, time.time() + 0.5))
+        thread = self._start(max_inflight_batches=1)
+        self._wait_for_calls(1)
+        self.calls['a'].set()
+        self.assertTrue(done_signal.wait(5))
+        thread.stop()
+        self.task_queue.put(None)
+        thread.join()
+
+        # the call timeout is the time left before the deadline, not the publisher timeout
+        self.assertTrue(0 < self.call_timeouts['a'] <= 0.5)
@@ -0,0 +1,140 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import unittest
+
+from six.moves import queue
+
+from cherami_client.lib import cherami, cherami_input, util
+from cherami_client import router
+from cherami_client.router import Router
+
+
+class TestRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.task_queue = queue.Queue()
+        self.acks = []
+
+    def _task(self, id):
+        return [cherami_input.PutMessage(id=str(id))], self.acks.append, None
+
+    def _get(self, router, hostport):
+        msgs, callback, deadline = router.get(hostport, 0)
+        return int(msgs[0].id), callback
+
+    def test_unknown_policy(self):
+        self.assertRaises(Exception, Router, 'test', self.task_queue, 'random')
+
+    def test_least_outstanding(self):
+        r = Router('test', self.task_queue, router.LEAST_OUTSTANDING)
+        r.set_hosts(['a', 'b'])
+        for id in range(4):
+            r.put(self._task(id))
+        self.assertEquals({'a': 2, 'b': 2}, r.outstanding)
+
+        id, callback = self._get(r, 'a')
+        ack = cherami_input.PutMessageAck(id=str(id), status=cherami.Status.OK)
+        callback(ack)
+        self.assertEquals([ack], self.acks)
+        self.assertEquals({'a': 1, 'b': 2}, r.outstanding)
+        self.assertIn('a', r.latencies)
+
+        r.put(self._task(4))
+        self.assertEquals({'a': 2, 'b': 2}, r.outstanding)
+
+    def test_power_of_two_choices_by_latency(self):
+        r = Router('test', self.task_queue, router.POWER_OF_TWO_CHOICES)
+        r.set_hosts(['fast', 'slow'])
+        r.latencies = {'fast': 0.01, 'slow': 1.0}
+        for id in range(3):
+            r.put(self._task(id))
+        self.assertEquals({'fast': 3, 'slow': 0}, r.outstanding)
+
+    def test_idle_host_steals(self):
+        r = Router('test', self.task_queue)
+        r.set_hosts(['a'])
+        for id in range(3):
+            r.put(self._task(id))
+        r.set_hosts(['a', 'b'])
+
+        id, callback = self._get(r, 'b')
+        self.assertEquals(0, id)
+        self.assertEquals({'a': 2, 'b': 1}, r.outstanding)
+        self.assertRaises(queue.Empty, r.get, 'c', 0)
+
+    def test_removed_host_tasks_requeued(self):
+        r = Router('test', self.task_queue)
+        r.put(self._task(0))
+        r.set_hosts(['a'])
+        r.put(self._task(1))
+        r.set_hosts(['b'])
+
+        self.assertEquals(2, self.task_queue.qsize())
+        self.assertEquals(0, self._get(r, 'b')[0])
+        self.assertEquals({'b': 1}, r.outstanding)
+        self.assertFalse(r.empty())
+
+    def test_take_all(self):
+        r = Router('test', self.task_queue)
+        r.set_hosts(['a', 'b'])
+        for id in range(3):
+            r.put(self._task(id))
+        r.wake('a')
+
+        self.assertEquals([0, 1, 2], sorted(int(msgs[0].id) for msgs, callback, deadline in r.take_all()))
+        self.assertTrue(r.empty())
+
+    def test_local_zone(self):
+        zones = {'a': 'z1', 'b': 'z2'}
+        r = Router('test', self.task_queue, local_zone='z1', zone_resolver=zones.get, spill_outstanding=2)
+        r.set_hosts(['a', 'b', 'c'])
+        self.assertEquals(set(['a']), r.local_hosts)
+
+        # the other zones get tasks once the local host is backed up
+        for id in range(4):
+            r.put(self._task(id))
+        self.assertEquals(2, r.outstanding['a'])
+        self.assertEquals(2, r.outstanding['b'] + r.outstanding['c'])
+
+        # and only take tasks from queues backed up as much
+        r.set_hosts(['a', 'b', 'c', 'd'])
+        self.assertEquals(0, self._get(r, 'd')[0])
+        self.assertRaises(queue.Empty, r.get, 'd', 0)
+
+    def test_failing_host_avoided(self):
+        r = Router('test', self.task_queue)
+        r.set_hosts(['a', 'b'])
+        r.put(self._task(0))
+        r.put(self._task(1))
+        for host in ['a', 'b']:
+            id, callback = self._get(r, host)
+            callback(util.create_failed_message_ack(str(id), 'failed') if host == 'a' else
+                     cherami_input.PutMessageAck(id=str(id), status=cherami.Status.OK))
+        self.assertEquals({'a': 1, 'b': 0}, r.failures)
+
+        r.failures['a'] = Router.max_failures
+        for id in range(2, 4):
+            r.put(self._task(id))
+        self.assertEquals({'a': 0, 'b': 2}, r.outstanding)
+
+        # all the hosts failing, any can be used
+        r.failures['b'] = Router.max_failures
+        r.put(self._task(4))
+        self.assertEquals({'a': 1, 'b': 2}, r.outstanding)
@@ -0,0 +1,66 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import unittest
+import threading
+import time
+from clay import config
+
+from cherami_client.scheduler import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler(config.get_logger('test'))
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.stop()
+        self.scheduler.join()
+
+    def test_schedule(self):
+        counts = {'fast': 0, 'failing': 0}
+        done_signal = threading.Event()
+
+        def fast():
+            counts['fast'] += 1
+            if counts['fast'] == 3:
+                done_signal.set()
+
+        def failing():
+            counts['failing'] += 1
+            raise Exception('failed')
+
+        slow_task = self.scheduler.schedule(60, fast)
+        fast_task = self.scheduler.schedule(0.01, fast)
+        failing_task = self.scheduler.schedule(0.01, failing)
+        self.assertTrue(done_signal.wait(5))
+
+        fast_task.stop()
+        fast_task.join(5)
+        self.assertFalse(fast_task.is_alive())
+        count = counts['fast']
+        time.sleep(0.05)
+        self.assertEquals(count, counts['fast'])
+
+        # an exception doesn't stop the task from being scheduled again
+        self.assertTrue(counts['failing'] > 1)
+        self.assertTrue(failing_task.is_alive())
+        self.assertTrue(slow_task.is_alive())
@@ -0,0 +1,66 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import unittest
+import mock
+
+from cherami_client import serializer
+from cherami_client.lib import cherami
+
+
+class TestSerializer(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = serializer.SerializerRegistry()
+        self.registry.register_json(1)
+        self.registry.register_thrift(2, cherami, cherami.HostAddress)
+
+    def test_registry_roundtrip(self):
+        value = {'city': 'sf', 'count': 3}
+        self.assertEquals(value, self.registry.decode(1, self.registry.encode(1, value)))
+
+        host = cherami.HostAddress(host='127.0.0.1', port=4922)
+        self.assertEquals(host, self.registry.decode(2, self.registry.encode(2, host)))
+
+    def test_json_encodes_bytes(self):
+        json_serializer = serializer.JsonSerializer(ensure_ascii=False)
+        value = {u'city': u'z\xfcrich'}
+        data = json_serializer.encode(value)
+        self.assertTrue(isinstance(data, bytes))
+        self.assertEquals(value, json_serializer.decode(data))
+        self.assertTrue(isinstance(self.registry.encode(1, value), bytes))
+
+    def test_registry_no_schema(self):
+        self.assertEquals('raw', self.registry.decode(0, 'raw'))
+        self.assertEquals('raw', self.registry.decode(None, 'raw'))
+        self.assertRaises(Exception, self.registry.encode, 3, {})
+        self.assertRaises(Exception, self.registry.decode, 3, '{}')
+        self.assertRaises(Exception, self.registry.register_json, 0)
+
+    def test_decoded_message_lazy(self):
+        registry = mock.Mock()
+        registry.decode.return_value = {'k': 'v'}
+        msg = cherami.ConsumerMessage(ackId='ack', payload=cherami.PutMessage(data='{"k": "v"}', schemaVersion=1))
+
+        decoded = serializer.DecodedMessage(('ack', '0:0'), msg, registry)
+        self.assertEquals(0, registry.decode.call_count)
+        self.assertEquals({'k': 'v'}, decoded.value)
+        self.assertEquals({'k': 'v'}, decoded.value)
+        registry.decode.assert_called_once_with(1, '{"k": "v"}')
@@ -0,0 +1,160 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import unittest
+import mock
+from clay import config
+
+from cherami_client import chunking
+from cherami_client.lib import cherami, cherami_output, util
+from cherami_client.client import Client
+
+
+class TestStreamingConsumer(unittest.TestCase):
+
+    def setUp(self):
+        self.test_path = '/test/path'
+        self.test_cg = 'test/cg'
+        self.logger = config.get_logger('test')
+
+        self.output_hosts = mock.Mock(body=cherami.ReadConsumerGroupHostsResult(
+            hostAddresses=[cherami.HostAddress(host='0', port=0)]
+        ))
+        self.no_msg = mock.Mock(body=cherami_output.ReceiveMessageBatchResult(messages=[]))
+
+        self.mock_call = mock.Mock()
+        self.mock_tchannel = mock.Mock()
+        self.mock_tchannel.thrift.return_value = self.mock_call
+
+    def _open_consumer(self, **kwargs):
+        self.mock_call.result.return_value = self.output_hosts
+        client = Client(self.mock_tchannel, self.logger, timeout_seconds=1)
+        consumer = client.create_streaming_consumer(self.test_path, self.test_cg,
+                                                    checkpoint_interval_seconds=60, **kwargs)
+        consumer._do_not_start_consumer_thread()
+        consumer.open()
+        self.mock_call.result.return_value = mock.Mock(body=None)
+        return consumer
+
+    def _deliver(self, consumer, lsn, user_context=None):
+        msg = cherami_output.ConsumerMessage(lsn=lsn, address=lsn * 100,
+                                             payload=cherami_output.PutMessage(data='msg', userContext=user_context))
+        consumer.msg_queue.put((util.create_streaming_delivery_token(lsn, '0:0', lsn * 100), msg))
+
+    def _checkpointed_addresses(self):
+        return [args[0].call_args.request.addressInclusive
+                for args, kwargs in self.mock_tchannel.thrift.call_args_list
+                if args[0].endpoint == 'BOut::setConsumedMessages']
+
+    def test_streaming_consumer_checkpoint(self):
+        consumer = self._open_consumer()
+        self.assertEquals(0, len(consumer.ack_threads))
+
+        for lsn in range(1, 4):
+            self._deliver(consumer, lsn)
+        msgs = consumer.receive(3)
+        self.assertEquals(3, len(msgs))
+
+        self.assertTrue(consumer.ack(msgs[0][0]))
+        self.assertTrue(consumer.ack(msgs[2][0]))
+        self.assertFalse(consumer.nack(msgs[1][0]))
+        consumer.checkpoint()
+        self.assertEquals([100], self._checkpointed_addresses())
+
+        # nothing new processed, no call
+        consumer.checkpoint()
+        self.assertEquals([100], self._checkpointed_addresses())
+
+        self.assertTrue(consumer.ack(msgs[1][0]))
+        consumer.close()
+        self.assertEquals([100, 300], self._checkpointed_addresses())
+
+    def test_streaming_consumer_lsn_gap(self):
+        consumer = self._open_consumer()
+        for lsn in [1, 2, 4]:
+            self._deliver(consumer, lsn)
+        msgs = consumer.receive(3)
+        for delivery_token, msg in msgs:
+            self.assertTrue(consumer.ack(delivery_token))
+
+        # the checkpoint stops before the missing lsn
+        consumer.checkpoint()
+        self.assertEquals([200], self._checkpointed_addresses())
+
+        # and moves on once it's delivered and processed
+        self._deliver(consumer, 3)
+        msgs = consumer.receive(1)
+        self.assertTrue(consumer.ack(msgs[0][0]))
+        consumer.close()
+        self.assertEquals([200, 400], self._checkpointed_addresses())
+
+    def test_streaming_consumer_ack_many(self):
+        consumer = self._open_consumer()
+        for lsn in range(1, 4):
+            self._deliver(consumer, lsn)
+        msgs = consumer.receive(3)
+
+        self.assertEquals([True, True], consumer.ack_many([msgs[0][0], msgs[1][0]]))
+        self.assertEquals([False], consumer.nack_many([msgs[2][0]]))
+        consumer.close()
+        self.assertEquals([200], self._checkpointed_addresses())
+
+    def test_streaming_consumer_start_address(self):
+        consumer = self._open_consumer(start_address=200)
+        for lsn in range(1, 4):
+            self._deliver(consumer, lsn)
+        msgs = consumer.receive(3)
+        self.assertEquals([200, 300], [msg.address for _, msg in msgs])
+
+        consumer.checkpoint()
+        consumer.close()
+        self.assertEquals([100], self._checkpointed_addresses())
+
+    def test_streaming_consumer_expired_chunks(self):
+        consumer = self._open_consumer(reassemble_chunks=True)
+        self._deliver(consumer, 1)
+        # one chunk of a message whose other chunk never arrives
+        self._deliver(consumer, 2, {chunking.CHUNK_GROUP_CONTEXT_KEY: 'group',
+                                    chunking.CHUNK_INDEX_CONTEXT_KEY: '0',
+                                    chunking.CHUNK_COUNT_CONTEXT_KEY: '2',
+                                    chunking.CHUNK_MESSAGE_ID_CONTEXT_KEY: 'id'})
+        self._deliver(consumer, 3)
+        msgs = consumer.receive(2)
+        self.assertEquals([100, 300], [msg.address for _, msg in msgs])
+        for delivery_token, msg in msgs:
+            self.assertTrue(consumer.ack(delivery_token))
+        consumer.checkpoint()
+
+        # once given up, the chunk no longer holds back the checkpoint
+        consumer.chunk_reassembler.timeout_seconds = 0
+        consumer._expire_chunks()
+        consumer.checkpoint()
+        consumer.close()
+        self.assertEquals([100, 300], self._checkpointed_addresses())
+
+    def test_streaming_consumer_end_of_stream(self):
+        consumer = self._open_consumer()
+        self.assertFalse(consumer.is_end_of_stream())
+
+        self.mock_call.result.return_value = self.no_msg
+        consumer.consumer_threads['0:0'].start()
+        consumer.consumer_threads['0:0'].caught_up.wait(5)
+        self.assertTrue(consumer.is_end_of_stream())
+        consumer.close()
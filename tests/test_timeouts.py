@@ -0,0 +1,83 @@
+# Copyright (c) 2017 Uber Technologies, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+import unittest
+import mock
+import time
+
+from cherami_client.lib import util
+from cherami_client.timeouts import AdaptiveTimeouts, get_call_timeout, MIN_CALL_TIMEOUT_SECONDS
+
+
+class TestTimeouts(unittest.TestCase):
+
+    def test_adaptive_timeout(self):
+        timeouts = AdaptiveTimeouts(min_timeout_seconds=0.5, max_timeout_seconds=30)
+        self.assertEquals(30, timeouts.get_timeout('0:0', 'ackMessages'))
+
+        for i in range(AdaptiveTimeouts.min_samples):
+            timeouts.record('0:0', 'ackMessages', 0.005)
+            timeouts.record('1:1', 'ackMessages', 2)
+        self.assertEquals(0.5, timeouts.get_timeout('0:0', 'ackMessages'))
+        self.assertEquals(6, timeouts.get_timeout('1:1', 'ackMessages'))
+        self.assertEquals(30, timeouts.get_timeout('0:0', 'putMessageBatch'))
+
+        for i in range(AdaptiveTimeouts.min_samples):
+            timeouts.record('1:1', 'ackMessages', 20)
+        self.assertEquals(30, timeouts.get_timeout('1:1', 'ackMessages'))
+
+    def test_timeout_recovers_after_failures(self):
+        timeouts = AdaptiveTimeouts(min_timeout_seconds=0.5, max_timeout_seconds=30)
+        for i in range(AdaptiveTimeouts.min_samples):
+            timeouts.record('0:0', 'ackMessages', 0.005)
+        self.assertEquals(0.5, timeouts.get_timeout('0:0', 'ackMessages'))
+
+        # the host got slower than its timeout: its calls time out and record no latency
+        for i in range(AdaptiveTimeouts.max_failures - 1):
+            timeouts.record('0:0', 'ackMessages', 0.5, failed=True)
+        self.assertEquals(0.5, timeouts.get_timeout('0:0', 'ackMessages'))
+        timeouts.record('0:0', 'ackMessages', 0.5, failed=True)
+        self.assertEquals(30, timeouts.get_timeout('0:0', 'ackMessages'))
+
+        # the timeout is learned again from the new latencies
+        for i in range(AdaptiveTimeouts.min_samples):
+            timeouts.record('0:0', 'ackMessages', 2)
+        self.assertEquals(6, timeouts.get_timeout('0:0', 'ackMessages'))
+
+    def test_deadline(self):
+        self.assertEquals(30, get_call_timeout(None, 30, '0:0', 'putMessageBatch'))
+        self.assertAlmostEquals(2, get_call_timeout(None, 30, '0:0', 'putMessageBatch', time.time() + 2), places=1)
+        self.assertEquals(MIN_CALL_TIMEOUT_SECONDS,
+                          get_call_timeout(None, 30, '0:0', 'putMessageBatch', time.time() - 1))
+
+    def test_latency_observer(self):
+        timeouts = mock.Mock()
+        mock_tchannel = mock.Mock()
+        mock_tchannel.thrift.return_value.result.return_value = mock.Mock(body=None)
+        util.execute_output_host(mock_tchannel, {}, '0:0', 1, 'ackMessages', None, timeouts.record)
+
+        hostport, method_name, latency = timeouts.record.call_args[0]
+        self.assertEquals(('0:0', 'ackMessages'), (hostport, method_name))
+        self.assertEquals(1, mock_tchannel.thrift.call_args[1]['timeout'])
+
+        # failed calls are recorded too
+        mock_tchannel.thrift.return_value.result.side_effect = Exception('timed out')
+        self.assertRaises(Exception, util.execute_output_host, mock_tchannel, {}, '0:0', 1, 'ackMessages', None,
+                          timeouts.record)
+        self.assertEquals({'failed': True}, timeouts.record.call_args[1])